@@ -0,0 +1,153 @@
+"""
+Admission control for heavy opportunity endpoints.
+
+Requests are admitted per (organization, endpoint class): up to `concurrency`
+run at once, up to `queue` more wait for a slot for at most `timeout`
+seconds, and anything beyond that is rejected so one organization can't
+starve the worker pool.
+
+A waiting request parks its worker thread, so the queues are kept short and
+at most `max_waiting` requests wait across all organizations; everything
+else is rejected right away with a Retry-After.
+
+All limits are per process: with N worker processes an organization can run
+up to N times `concurrency` requests of a class at once.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_ADMISSION_LIMITS = {
+    'bulk': {'concurrency': 2, 'queue': 1, 'timeout': 2, 'retry_after': 5},
+    'report': {'concurrency': 4, 'queue': 1, 'timeout': 2, 'retry_after': 5},
+    'list': {'concurrency': 8, 'queue': 2, 'timeout': 1, 'retry_after': 1},
+}
+
+# Requests allowed to wait for a slot at once in this process, over all
+# organizations and endpoint classes
+DEFAULT_MAX_WAITING = 2
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request can't be admitted; `retry_after` is in seconds.
+    """
+    def __init__(self, endpoint_class, retry_after):
+        message = 'Too many {} requests for this organization, please retry later.'.format(
+            endpoint_class)
+        super(AdmissionRejected, self).__init__(message)
+        self.message = message
+        self.endpoint_class = endpoint_class
+        self.retry_after = retry_after
+
+
+class _Gate(object):
+    def __init__(self, lock):
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition(lock)
+
+
+class AdmissionController(object):
+    """
+    Per-organization, per-endpoint-class concurrency limits with bounded
+    waiting queues.
+    """
+
+    def __init__(self, limits=None, max_waiting=DEFAULT_MAX_WAITING):
+        self._lock = threading.Lock()
+        self._gates = {}
+        self._metrics = {}
+        self._waiting = 0
+        self.limits = {}
+        self.max_waiting = max_waiting
+        self.configure(limits)
+
+    def configure(self, limits=None, max_waiting=None):
+        '''
+        :param limits: dict of endpoint class -> overrides of the default
+            `concurrency`, `queue`, `timeout` and `retry_after` settings
+        :param max_waiting: requests allowed to wait at once in this process;
+            keep it well below the number of worker threads
+        '''
+        if max_waiting is not None:
+            self.max_waiting = max_waiting
+        configured = dict((name, dict(limit))
+                          for name, limit in DEFAULT_ADMISSION_LIMITS.items())
+        for name, limit in (limits or {}).items():
+            configured[name] = dict(configured.get(name, DEFAULT_ADMISSION_LIMITS['report']),
+                                    **limit)
+        self.limits = configured
+
+    def _metric(self, endpoint_class):
+        return self._metrics.setdefault(endpoint_class, {
+            'admitted': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        })
+
+    def _reject(self, endpoint_class, limit, counter):
+        self._metric(endpoint_class)[counter] += 1
+        raise AdmissionRejected(endpoint_class, limit['retry_after'])
+
+    @contextmanager
+    def admit(self, organization_id, endpoint_class):
+        limit = self.limits[endpoint_class]
+        key = (organization_id, endpoint_class)
+
+        with self._lock:
+            gate = self._gates.get(key)
+            if gate is None:
+                gate = self._gates[key] = _Gate(self._lock)
+
+            if gate.active >= limit['concurrency'] and (
+                    gate.waiting >= limit['queue'] or self._waiting >= self.max_waiting):
+                self._reject(endpoint_class, limit, 'rejected')
+
+            started = time.time()
+            deadline = started + limit['timeout']
+            gate.waiting += 1
+            self._waiting += 1
+            try:
+                while gate.active >= limit['concurrency']:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._reject(endpoint_class, limit, 'timed_out')
+                    gate.condition.wait(remaining)
+            finally:
+                gate.waiting -= 1
+                self._waiting -= 1
+            gate.active += 1
+
+            waited = time.time() - started
+            metric = self._metric(endpoint_class)
+            metric['admitted'] += 1
+            metric['wait_seconds_total'] += waited
+            metric['wait_seconds_max'] = max(metric['wait_seconds_max'], waited)
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                gate.active -= 1
+                gate.condition.notify()
+                if not gate.active and not gate.waiting:
+                    del self._gates[key]
+
+    def metrics(self):
+        '''
+        Counters per endpoint class plus the current number of running and
+        queued requests.
+        '''
+        with self._lock:
+            result = dict((name, dict(metric, active=0, queue_depth=0))
+                          for name, metric in self._metrics.items())
+            for (organization_id, endpoint_class), gate in self._gates.items():
+                metric = result.setdefault(
+                    endpoint_class,
+                    dict(self._metric(endpoint_class), active=0, queue_depth=0))
+                metric['active'] += gate.active
+                metric['queue_depth'] += gate.waiting
+            return result
@@ -1,13 +1,18 @@
-import boto
+import hashlib
 import json
+import uuid
+from collections import OrderedDict
+from functools import wraps
 
 from bson.objectid import ObjectId
+from pymongo.errors import ExecutionTimeout, NetworkTimeout
+from werkzeug.exceptions import ClientDisconnected
 from werkzeug.local import LocalProxy
-from flask import abort, Blueprint, request, current_app, jsonify
+from flask import abort, Blueprint, request, current_app, jsonify, make_response
 from marshmallow import ValidationError
 
+from market_crm import signals
 from market_crm.application import sentry
-from market_crm.config import DAP_EIP_S3_ARCHIVE_BUCKET
 from market_crm.utils import validator
 from market_crm.database import db, PaginatedResults, CursorPaginatedResults
 from market_crm.utils.decorator import ResponseWrapper
@@ -19,12 +24,23 @@ from .schemas import (
     OpportunityMarketingSchema,
     GuestSheetSchema, UserDealSchema,
     OpportunitiesParamsSchema, OpportunitiesFilterSchema,
-    OpportunitiesByCursorParamsSchema,
+    OpportunitiesByCursorParamsSchema, StatusVelocityFilterSchema,
+    OpportunityBulkMutationSchema, OpportunityJobSchema,
+    OpportunitiesForLeadsSchema, OpportunityChangesParamsSchema,
 )
 from .model import Opportunity as OpportunityModel, OpportunityStockTypeOptions
 
-from .deal_converter import DealConverter
 from .authorization import can
+from . import budgets
+from .budgets import ReportTooLargeError
+from . import gross_profit
+from .admission import AdmissionController, AdmissionRejected
+from .dispatch import dispatcher
+from .propagation import customer_propagation
+from .jobs import JobFailed, JobRunner
+from . import sync
+from .live import FeedFull, live_feed, RETRY_FRAME, HEARTBEAT_FRAME
+from .routing import shard_routing
 
 def ensure(permission_check):
     if not permission_check:
@@ -50,6 +66,152 @@ rdr_schema = RDRPunchSchema()
 
 mod = Blueprint("opportunityv2", __name__)
 current_user = LocalProxy(get_current_user)
+admission = AdmissionController()
+jobs = JobRunner(lambda: db.opportunity_dao)
+job_schema = OpportunityJobSchema()
+# Roles allowed to read the process-wide metrics routes
+metrics_roles = set()
+
+
+@mod.record_once
+def configure_admission(state):
+    admission.configure(state.app.config.get('OPPORTUNITY_ADMISSION_LIMITS'),
+                        state.app.config.get('OPPORTUNITY_ADMISSION_MAX_WAITING'))
+
+
+@mod.record_once
+def configure_signal_dispatch(state):
+    dispatcher.configure(app=state.app,
+                         **state.app.config.get('OPPORTUNITY_SIGNAL_DISPATCH', {}))
+
+
+@mod.record_once
+def configure_customer_propagation(state):
+    # mode='async' keeps queued customer changes in process memory: they are
+    # lost if the process dies before the next flush (the window, or exit),
+    # and debouncing only merges changes made by the same process.
+    customer_propagation.configure(
+        **state.app.config.get('OPPORTUNITY_CUSTOMER_PROPAGATION', {}))
+
+
+@mod.record_once
+def configure_live_feed(state):
+    # source='change_stream' feeds every process from MongoDB change streams;
+    # the default 'signals' only sees this process's writes
+    config = dict(state.app.config.get('OPPORTUNITY_LIVE_FEED', {}))
+    source = config.pop('source', 'signals')
+    live_feed.configure(**config)
+    if source == 'change_stream':
+        live_feed.watch(lambda: db.opportunity_dao, app=state.app)
+    else:
+        live_feed.connect(signals)
+
+
+@mod.record_once
+def configure_shard_routing(state):
+    shard_routing.configure(**state.app.config.get('OPPORTUNITY_SHARD_ROUTING', {}))
+
+
+@mod.record_once
+def configure_metrics(state):
+    metrics_roles.update(state.app.config.get('OPPORTUNITY_METRICS_ROLES', []))
+
+
+@mod.record_once
+def configure_jobs(state):
+    jobs.configure(app=state.app, workers=state.app.config.get('OPPORTUNITY_JOB_WORKERS'))
+    # Jobs of a process that died would otherwise stay queued or running
+    with state.app.app_context():
+        jobs.recover()
+
+
+def admission_controlled(endpoint_class):
+    """
+    Run the view only once admitted for the current user's organization
+    under the limits of `endpoint_class`.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with admission.admit(current_user['organization']['id'], endpoint_class):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def metrics_view(view):
+    """
+    Restrict a metrics route to the roles in OPPORTUNITY_METRICS_ROLES. The
+    metrics cover every organization served by the process, so no role can
+    read them unless configured.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        ensure(current_user['role'] in metrics_roles)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _etag(*parts):
+    # Responses carry the user's permissions, so the tag is per user and
+    # changes with the user's role and dealer access
+    scope = json.dumps([current_user['role'], sorted(current_user['allowed_dealer_ids'] or [])],
+                       default=str)
+    parts = (request.path, current_user['username'], scope) + parts
+    return hashlib.sha1(u':'.join(u'{}'.format(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def _not_modified(etag, weak=False):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag, weak=weak)
+    return response
+
+
+def _tagged(response, etag, weak=False):
+    response = make_response(response)
+    if response.status_code == 200:
+        response.set_etag(etag, weak=weak)
+    return response
+
+
+def conditional_opportunity_get(view):
+    """
+    Answer GETs of an opportunity resource with 304 while the client's ETag,
+    derived from the opportunity's `updated` timestamp, is still current.
+    The check only reads `updated`, not the document.
+    """
+    @wraps(view)
+    def wrapper(opportunity_id, *args, **kwargs):
+        if request.method != 'GET':
+            return view(opportunity_id, *args, **kwargs)
+
+        version = db.opportunity_dao.get_opportunity_version(
+            opportunity_id, organization_id=current_user['organization']['id'])
+        if version is None:
+            return view(opportunity_id, *args, **kwargs)
+
+        etag = _etag(opportunity_id, version.isoformat())
+        if request.if_none_match.contains(etag):
+            return _not_modified(etag)
+        return _tagged(view(opportunity_id, *args, **kwargs), etag)
+    return wrapper
+
+
+def conditional_list_get(filters, *params):
+    """
+    Weak ETag of a list of opportunities. It changes with any change to the
+    organization's opportunities (see `get_list_version`), which costs a few
+    index reads instead of a scan of the matching opportunities.
+    :return: (etag, 304 response or None)
+    """
+    version = db.opportunity_dao.get_list_version(current_user['organization']['id'])
+    etag = _etag(json.dumps(filters, sort_keys=True, default=str),
+                 json.dumps(params, sort_keys=True, default=str),
+                 json.dumps(version, default=str))
+    if request.if_none_match.contains_weak(etag):
+        return etag, _not_modified(etag, weak=True)
+    return etag, None
+
 
 ROLE_ASSIGNMENT_FIELDS = {
     User.ROLE_SALES_REP: 'sales_reps',
@@ -66,8 +228,63 @@ def not_found_404(message=None):
     return jsonify(message=message), 404
 
 
+@mod.before_request
+def tag_operations():
+    # Tag the database operations of this request so they can be killed
+    # if the request is aborted
+    budgets.set_operation_tag('opportunity-api:{}'.format(uuid.uuid4().hex))
+
+
+# Failures that can leave other operations of the request running: a timed
+# out query of a parallel report, or a client that went away
+ABANDONING_ERRORS = (ReportTooLargeError, ExecutionTimeout, NetworkTimeout,
+                     ClientDisconnected, IOError)
+
+
+def kill_request_operations(error):
+    # The error handlers below swallow most exceptions, so teardown_request
+    # usually sees error=None; failed requests kill their operations here.
+    # Only requests that sent a tagged operation and failed with one of
+    # ABANDONING_ERRORS pay for the currentOp round trips.
+    # A client disconnect is not noticed by a sync worker until it writes
+    # the response, so those operations are only bounded by maxTimeMS.
+    tag = budgets.pop_operation_tag()
+    if tag and isinstance(error, ABANDONING_ERRORS):
+        db.opportunity_dao.kill_operations(tag)
+
+
+@mod.teardown_request
+def release_operations(error=None):
+    kill_request_operations(error)
+
+
+@mod.errorhandler(AdmissionRejected)
+def admission_rejected(error):
+    response = jsonify(message=error.message)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+
+@mod.errorhandler(sync.InvalidSyncToken)
+def invalid_sync_token(error):
+    return jsonify(message=error.message), 410
+
+
+@mod.errorhandler(ReportTooLargeError)
+def report_too_large(error):
+    kill_request_operations(error)
+    return jsonify(message=error.message), 400
+
+
 @mod.errorhandler(Exception)
 def handle_exceptions(error):
+    kill_request_operations(error)
+
+    if budgets.is_budget_error(error):
+        # Budget hit while iterating a cursor outside of the DAO
+        budgets.log_budget_hit(request.endpoint, budgets.get_fingerprint(), error)
+        return report_too_large(ReportTooLargeError())
+
     if current_app.config.get('TESTING'):
         raise error
     if 'sentry' in current_app.extensions:
@@ -131,7 +348,8 @@ def link_opportunity_to_lead(opportunity_id, lead_id):
     lead_id is the CRM lead id (lead['_id'])
     """
 
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     lead = db.lead_dao.get_lead(lead_id)
 
     if not lead or not opportunity:
@@ -197,25 +415,7 @@ def populate_guestsheet_preferences_from_lead(lead):
     return preferences
 
 
-@mod.route('/opportunities/lead/<lead_id>', methods=['POST'])
-def create_opportunity_for_lead(lead_id):
-    """
-    lead_id: lead_id is the CRM lead id (lead['_id'])
-
-    - if the user is a sales rep or internet_sales_rep, and the customer doesn't have anyone
-        from dealer_id assigned to them, assign the current_user (with dealer_id)
-
-    - desking sends a new notification IF user is BDC and dealer_id is not in HAPPY_TO_HELP_DEALER_IDS (4175, 4125)
-        - will restrict this for now so BDC can't create opportunities.  :(
-        - need to figure out how notifications will work to do this.
-    """
-    lead = db.lead_dao.get_lead(lead_id)
-    customer = db.customer_dao.get_customer(lead['customer_id'])
-
-    if not lead or not customer:
-        return not_found_404()
-
-    data = request.get_json() or {}
+def _opportunity_data_for_lead(lead_id, lead, customer, data):
     data['organization_id'] = current_user['organization']['id']
     data['creator'] = current_user['username']
     data['marketing'] = OpportunityMarketingSchema().load(lead.get('form_data', {})).data
@@ -236,15 +436,41 @@ def create_opportunity_for_lead(lead_id):
     if assign_to and not data.get(assign_to):
         data[assign_to] = [current_user['username']]
 
+    return data
+
+
+def _should_assign_salesperson(customer, dealer_id):
+    return (current_user['role'] in User.ROLES_SALES_REPS
+            and dealer_id not in customer.assigned_salespeople_dealer_ids
+            and dealer_id in current_user['allowed_dealer_ids'])
+
+
+@mod.route('/opportunities/lead/<lead_id>', methods=['POST'])
+def create_opportunity_for_lead(lead_id):
+    """
+    lead_id: lead_id is the CRM lead id (lead['_id'])
+
+    - if the user is a sales rep or internet_sales_rep, and the customer doesn't have anyone
+        from dealer_id assigned to them, assign the current_user (with dealer_id)
+
+    - desking sends a new notification IF user is BDC and dealer_id is not in HAPPY_TO_HELP_DEALER_IDS (4175, 4125)
+        - will restrict this for now so BDC can't create opportunities.  :(
+        - need to figure out how notifications will work to do this.
+    """
+    lead = db.lead_dao.get_lead(lead_id)
+    customer = db.customer_dao.get_customer(lead['customer_id'])
+
+    if not lead or not customer:
+        return not_found_404()
+
+    data = _opportunity_data_for_lead(lead_id, lead, customer, request.get_json() or {})
     params = OpportunitySchema(strict=True).load(data).data
 
     ensure(can(current_user).create(OpportunityModel(params)))
     opportunity = db.opportunity_dao.add_opportunity(**params)
     opportunity['permissions'] = permissions_for(opportunity)
 
-    if (opportunity and current_user['role'] in User.ROLES_SALES_REPS
-     and data['dealer_id'] not in customer.assigned_salespeople_dealer_ids
-     and data['dealer_id'] in current_user['allowed_dealer_ids']):
+    if opportunity and _should_assign_salesperson(customer, data['dealer_id']):
         customer = db.customer_dao.assign_salesperson(customer['_id'],
          data['dealer_id'], current_user['username'])
 
@@ -252,7 +478,72 @@ def create_opportunity_for_lead(lead_id):
     return jsonify({'opportunity': data}), 201
 
 
+@mod.route('/opportunities/leads', methods=['POST'])
+@admission_controlled('bulk')
+def create_opportunities_for_leads():
+    """
+    Batch version of create_opportunity_for_lead for lead imports.
+
+    Leads and customers are loaded with one $in query each, the
+    opportunities are inserted in chunks and salespeople are assigned with
+    one bulk write; leads that can't be converted or inserted are reported
+    in `errors` by lead id.
+    """
+    params = OpportunitiesForLeadsSchema().load(get_json_or_400()).data
+    lead_ids = params['lead_ids']
+
+    leads = dict((str(lead['_id']), lead)
+                 for lead in db.lead_dao.get_leads(list(set(lead_ids))))
+    customer_ids = list(set(lead['customer_id'] for lead in leads.values()))
+    customers = dict((customer['_id'], customer)
+                     for customer in db.customer_dao.get_customers(customer_ids))
+
+    converted = []
+    errors = {}
+    for lead_id in lead_ids:
+        lead = leads.get(lead_id)
+        customer = customers.get(lead['customer_id']) if lead else None
+        if not lead or not customer:
+            errors[lead_id] = 'Lead or customer not found.'
+            continue
+
+        data = _opportunity_data_for_lead(lead_id, lead, customer, dict(params['opportunity']))
+        try:
+            opportunity_params = OpportunitySchema(strict=True).load(data).data
+        except ValidationError as e:
+            errors[lead_id] = e.messages
+            continue
+        if not can(current_user).create(OpportunityModel(opportunity_params)):
+            errors[lead_id] = 'Not allowed to create this opportunity.'
+            continue
+        converted.append((lead_id, customer, opportunity_params))
+
+    failed = {}
+    opportunities = db.opportunity_dao.add_opportunities(
+        [opportunity_params for lead_id, customer, opportunity_params in converted],
+        errors=failed)
+    for index, message in failed.items():
+        errors[converted[index][0]] = message
+
+    # Assign the salesperson once per customer and dealer, in one bulk write
+    assignments = OrderedDict()
+    for index, (lead_id, customer, opportunity_params) in enumerate(converted):
+        if index in failed:
+            continue
+        key = (customer['_id'], opportunity_params['dealer_id'])
+        if key not in assignments and _should_assign_salesperson(customer, key[1]):
+            assignments[key] = True
+    if assignments:
+        db.customer_dao.assign_salespeople(list(assignments), current_user['username'])
+
+    for opportunity in opportunities:
+        opportunity['permissions'] = permissions_for(opportunity)
+    data = opportunity_schema.dump(opportunities, many=True).data
+    return jsonify({'opportunities': data, 'errors': errors}), 201
+
+
 @mod.route('/opportunities', methods=['GET'])
+@admission_controlled('list')
 def get_opportunities():
     args = request.args.to_dict()
     if 'filters' in args:
@@ -268,9 +559,14 @@ def get_opportunities():
     sort_by = params['sort_by']
 
     ensure(can(current_user).query(filters))
+    etag, not_modified = conditional_list_get(filters, page, page_size, sort_by)
+    if not_modified:
+        return not_modified
+
     opportunities_cursor = db.opportunity_dao._get_opportunities(
         filters=filters,
-        sort_by=sort_by
+        sort_by=sort_by,
+        list_rows=True
     )
     paginated = PaginatedResults(
         opportunities_cursor,
@@ -291,10 +587,11 @@ def get_opportunities():
         opportunity['permissions'] = permissions_for(
             OpportunityModel(opportunity)
         )
-    return jsonify(opportunity_results)
+    return _tagged(jsonify(opportunity_results), etag, weak=True)
 
 
 @mod.route('/opportunities-cursor', methods=['GET'])
+@admission_controlled('list')
 def get_opportunities_with_cursor_pagination():
     args = request.args.to_dict()
     if 'filters' in args:
@@ -311,7 +608,12 @@ def get_opportunities_with_cursor_pagination():
     sort_by = params['sort_by']
 
     ensure(can(current_user).query(filters))
-    opportunities_cursor = db.opportunity_dao._get_opportunities(filters=filters, sort_by=sort_by)
+    etag, not_modified = conditional_list_get(filters, cursor_key, get_more, size, sort_by)
+    if not_modified:
+        return not_modified
+
+    opportunities_cursor = db.opportunity_dao._get_opportunities(
+        filters=filters, sort_by=sort_by, list_rows=True)
 
     paginated = CursorPaginatedResults(
         opportunities_cursor,
@@ -323,16 +625,17 @@ def get_opportunities_with_cursor_pagination():
     filter_query = paginated.filter_query
     if filter_query:
         paginated.filtered_cursor = db.opportunity_dao._get_opportunities(
-          filter_query=filter_query, filters=filters, sort_by=sort_by)
+          filter_query=filter_query, filters=filters, sort_by=sort_by, list_rows=True)
 
     opportunity_results = paginated.dump(results_schema=OpportunitySchema(), model=OpportunityModel)
 
     for opportunity in opportunity_results['results']:
         opportunity['permissions'] = permissions_for(OpportunityModel(opportunity))
         ensure(can(current_user).read(OpportunityModel(opportunity)))
-    return jsonify(opportunity_results)
+    return _tagged(jsonify(opportunity_results), etag, weak=True)
 
 @mod.route('/opportunities-bulk', methods=['POST'])
+@admission_controlled('bulk')
 def get_opportunities_bulk():
     args = request.get_json()
     args['filters'].update({'organization_id': current_user['organization']['id']})
@@ -351,9 +654,170 @@ def get_opportunities_bulk():
     return jsonify({'opportunities': data})
 
 
+def bulk_update_job(dao, filters, operation, progress, user=None, **params):
+    # The user only reaches workers of the submitting process
+    if user is None:
+        raise JobFailed('The bulk update was interrupted. Please submit it again.')
+
+    def permission_check(opportunity):
+        if not can(user).update(opportunity):
+            return False
+        if operation == 'replace_assignee':
+            return can(user).assign_user(opportunity)
+        return True
+
+    try:
+        return dao.bulk_mutate_opportunities(
+            filters, operation, permission_check=permission_check, progress=progress, **params)
+    except ValueError as e:
+        raise JobFailed(str(e))
+
+
+jobs.register('bulk_update', bulk_update_job, progress=True)
+
+
+@mod.route('/opportunities-bulk-update', methods=['POST'])
+@admission_controlled('bulk')
+def bulk_update_opportunities():
+    """
+    Reassign, re-status or move the reporting period of many opportunities,
+    selected by `filters` or by `ids`.
+
+    The update runs as a background job; poll /opportunities/jobs/<job_id>
+    for its progress (matched, modified and skipped so far) and summary.
+    :return: the queued job
+    """
+    data = get_json_or_400()
+    organization_id = current_user['organization']['id']
+    if 'filters' in data:
+        data['filters'].update({'organization_id': organization_id})
+    params = OpportunityBulkMutationSchema().load(data).data
+
+    if params.get('filters'):
+        filters = params.pop('filters')
+        ensure(can(current_user).query(filters))
+    elif params.get('ids'):
+        filters = {'organization_id': organization_id}
+    else:
+        return jsonify(message='Either filters or ids are required.'), 400
+
+    ids = params.pop('ids', None)
+    if ids:
+        filters['ids'] = ids
+
+    job = jobs.submit('bulk_update', organization_id=organization_id,
+                      context={'user': current_user._get_current_object()},
+                      filters=filters, **params)
+    return jsonify({'job': job_schema.dump(job).data}), 202
+
+
+@mod.route('/opportunities/status-velocity', methods=['GET'])
+@admission_controlled('report')
+def status_velocity():
+    """Time in status and conversion rates from the status transition history"""
+    filters = json.loads(request.args.get('filters', '{}'))
+    filters.update({'organization_id': current_user['organization']['id']})
+    filters = StatusVelocityFilterSchema().load(filters).data
+
+    ensure(can(current_user).query(filters))
+    report = db.opportunity_dao.get_status_velocity_report(**filters)
+    return jsonify(report)
+
+
+def _subscribed_dealer_ids(params):
+    dealer_ids = current_user['allowed_dealer_ids']
+    if params.get('dealer_ids'):
+        dealer_ids = [dealer_id for dealer_id in params['dealer_ids'] if dealer_id in dealer_ids]
+    return dealer_ids
+
+
+@mod.route('/opportunities/changes', methods=['GET'])
+def get_opportunity_changes():
+    """
+    Opportunities created or updated, and ids of those deleted, archived or
+    no longer visible to the user, since the `since` token, for the current
+    user's dealers.
+
+    Without `since` only a token is returned; take it before loading the
+    full list and sync from it afterwards. A 410 means the token expired
+    and the list has to be reloaded.
+    """
+    params = OpportunityChangesParamsSchema().load(request.args.to_dict()).data
+    dealer_ids = _subscribed_dealer_ids(params)
+
+    if not params.get('since'):
+        position = db.opportunity_dao.sync_start_position()
+        return jsonify({'changed': [], 'deleted': [], 'has_more': False,
+                        'token': sync.encode_token(position)})
+
+    changes = db.opportunity_dao.get_opportunity_changes(
+        current_user['organization']['id'], dealer_ids,
+        sync.decode_token(params['since']), limit=params['limit'])
+
+    changed = []
+    deleted = [str(opportunity_id) for opportunity_id in changes['deleted']]
+    for opportunity in changes['changed']:
+        if can(current_user).read(opportunity):
+            opportunity['permissions'] = permissions_for(opportunity)
+            changed.append(opportunity)
+        else:
+            # Fell out of the user's scope, e.g. reassigned: the client has
+            # to drop it like a deleted one
+            deleted.append(str(opportunity['_id']))
+    # Moved between two of the user's dealers: changed wins over the old
+    # dealer's tombstone
+    kept = set(str(opportunity['_id']) for opportunity in changed)
+    deleted = [opportunity_id for opportunity_id in deleted if opportunity_id not in kept]
+
+    return jsonify({
+        'changed': opportunity_schema.dump(changed, many=True).data,
+        'deleted': deleted,
+        'has_more': changes['has_more'],
+        'token': sync.encode_token(changes['position']),
+    })
+
+
+@mod.route('/opportunities/live', methods=['GET'])
+def live_opportunity_changes():
+    """
+    Server-sent events of opportunity changes for the current user's
+    dealers. On a `reset` event the client missed changes and should catch
+    up through /opportunities/changes.
+
+    The stream holds its worker until the client disconnects; run this
+    endpoint on gevent workers rather than sync ones.
+    """
+    params = OpportunityChangesParamsSchema(only=('dealer_ids',)).load(
+        request.args.to_dict()).data
+    try:
+        subscription = live_feed.subscribe(current_user['organization']['id'],
+                                           _subscribed_dealer_ids(params))
+    except FeedFull:
+        raise AdmissionRejected('live', live_feed.heartbeat)
+
+    def stream():
+        try:
+            yield RETRY_FRAME
+            while True:
+                frames = subscription.pull(live_feed.heartbeat)
+                if not frames:
+                    yield HEARTBEAT_FRAME
+                for frame in frames:
+                    yield frame
+        finally:
+            live_feed.unsubscribe(subscription)
+
+    response = current_app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @mod.route('/opportunities/<objectid:opportunity_id>', methods=['GET'])
+@conditional_opportunity_get
 def get_opportunity(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     ensure(can(current_user).read(opportunity))
 
     if opportunity:
@@ -367,7 +831,8 @@ def get_opportunity(opportunity_id):
 @mod.route('/opportunities/<objectid:opportunity_id>/'
            'deal_data/<field_name>', methods=['POST'])
 def update_opportunity_deal_data(opportunity_id, field_name):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     ensure(can(current_user).update(opportunity))
 
     data = request.get_json()
@@ -385,7 +850,8 @@ def update_opportunity_deal_data(opportunity_id, field_name):
 
 @mod.route('/opportunities/<objectid:opportunity_id>', methods=['PATCH'])
 def update_opportunity(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
 
     if not opportunity:
         return not_found_404('Opportunity not found.')
@@ -420,8 +886,10 @@ def update_opportunity(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/sales-reps', methods=['GET', 'PUT'])
+@conditional_opportunity_get
 def sales_reps(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404('Opportunity not found.')
 
@@ -439,8 +907,10 @@ def sales_reps(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/sales-managers', methods=['GET', 'PUT'])
+@conditional_opportunity_get
 def sales_managers(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404('Opportunity not found.')
 
@@ -459,8 +929,10 @@ def sales_managers(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/bdc-reps', methods=['GET', 'PUT'])
+@conditional_opportunity_get
 def bdc_reps(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404('Opportunity not found.')
 
@@ -479,8 +951,10 @@ def bdc_reps(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/finance-managers', methods=['GET', 'PUT'])
+@conditional_opportunity_get
 def finance_managers(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404('Opportunity not found.')
 
@@ -499,8 +973,10 @@ def finance_managers(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/customer-reps', methods=['GET', 'PUT'])
+@conditional_opportunity_get
 def customer_reps(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404('Opportunity not found.')
 
@@ -519,8 +995,10 @@ def customer_reps(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/preferences', methods=['GET', 'PATCH'])
+@conditional_opportunity_get
 def preferences(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404()
 
@@ -542,8 +1020,10 @@ def preferences(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/marketing', methods=['GET', 'PATCH'])
+@conditional_opportunity_get
 def marketing_data(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404()
     ensure(can(current_user).read(opportunity))
@@ -565,7 +1045,8 @@ def marketing_data(opportunity_id):
 
 @mod.route('/opportunities/<objectid:opportunity_id>/attachment', methods=['PUT'])
 def add_attachment(opportunity_id):
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404()
     ensure(can(current_user).add_attachment(opportunity))
@@ -588,7 +1069,8 @@ def update_attachment(opportunity_id, attachment_id):
 
     if not validator.check_object_id(attachment_id):
         return ResponseWrapper.error(status=400, message='Invalid Attachment Id')
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404()
     ensure(can(current_user).add_attachment(opportunity))
@@ -612,35 +1094,55 @@ def update_attachment(opportunity_id, attachment_id):
         return not_found_404()
 
 
+def edit_deal_number_job(dao, opportunity_id, deal_number):
+    # edit_deal_number raises JobFailed with the reason the DMS pull failed
+    dao.edit_deal_number(opportunity_id, deal_number)
+    return {'opportunity_id': str(opportunity_id)}
+
+
+jobs.register('edit_deal_number', edit_deal_number_job)
+
+
 @mod.route('/opportunities/<objectid:opportunity_id>/edit_deal_number', methods=['POST'])
 def edit_deal_number(opportunity_id):
     """
     MPDESK-1376 Temporary functionality to edit deal number
+
+    The DMS pull runs as a background job; poll /opportunities/jobs/<job_id>
+    for its completion.
     :param opportunity_id: string, opportunity ID
-    :return:
+    :return: the queued job
     """
     data = get_json_or_400()
     data = EditDealNumberSchema().load(data).data
 
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404()
     ensure(can(current_user).edit_deal_number(opportunity))
 
-    opportunity = db.opportunity_dao.edit_deal_number(opportunity_id, data['deal_number'])
+    job = jobs.submit('edit_deal_number',
+                      organization_id=current_user['organization']['id'],
+                      opportunity_id=opportunity_id, deal_number=data['deal_number'])
+    return jsonify({'job': job_schema.dump(job).data}), 202
 
-    if opportunity:
-        response_data = opportunity_schema.dump(opportunity).data
-        return jsonify({'opportunity': response_data})
-    else:
-        return not_found_404()
+
+@mod.route('/opportunities/jobs/<objectid:job_id>', methods=['GET'])
+def get_job(job_id):
+    job = db.opportunity_dao.get_job(job_id)
+    if not job:
+        return not_found_404('Job not found.')
+    ensure(job.get('organization_id') == current_user['organization']['id'])
+    return jsonify({'job': job_schema.dump(job).data})
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/rdr_punch',
            methods=['POST', 'DELETE'])
 def rdr_punch(opportunity_id):
     """Set or clear opportunity RDR punch"""
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
     if not opportunity:
         return not_found_404()
     ensure(can(current_user).view_deal_log(opportunity))
@@ -663,11 +1165,13 @@ def rdr_punch(opportunity_id):
 
 
 @mod.route('/opportunities/<objectid:opportunity_id>/gross-profit')
+@admission_controlled('report')
 def gross_profit_for_deal(opportunity_id):
-    """Fetch Gross Profit of opportunity deal from S3"""
+    """Gross Profit of opportunity deal, converted from the S3 deal XML once per ETag"""
     debug = request.args.get('debug', False)
 
-    opportunity = db.opportunity_dao.get_opportunity(opportunity_id)
+    opportunity = db.opportunity_dao.get_opportunity(
+        opportunity_id, organization_id=current_user['organization']['id'])
 
     if not opportunity:
         return not_found_404('Opportunity not found.')
@@ -676,19 +1180,60 @@ def gross_profit_for_deal(opportunity_id):
     dealer_id = opportunity['dealer_id']
     deal_id = opportunity['dms_deal'].get('deal_number')
 
+    response_data = {}
+
     try:
-        conn = boto.connect_s3()
-        bucket = conn.get_bucket(DAP_EIP_S3_ARCHIVE_BUCKET, validate=False)
-        key = '/{0}/VehicleSales/FI-WIP*{1}'.format(dealer_id, deal_id)
-        s3_item = bucket.get_key(key)
+        if debug:
+            # Debug output is never stored
+            s3_item = gross_profit.get_deal_item(dealer_id, deal_id)
+            if s3_item:
+                response_data = gross_profit.convert_deal(s3_item, debug=debug)
+        elif deal_id:
+            response_data = gross_profit.deal_gross_profit(
+                db.opportunity_dao, dealer_id, deal_id)
     except Exception:
         sentry.captureException()
-        s3_item = None
 
-    response_data = {}
+    return jsonify({'gross_profit': response_data})
 
-    if s3_item:
-        deal = DealConverter(xml_string=s3_item.get_contents_as_string(), debug=debug)
-        response_data = deal.to_representation()
 
-    return jsonify({'gross_profit': response_data})
+@mod.route('/opportunities/admission-metrics')
+@metrics_view
+def admission_metrics():
+    """Queue depth, wait time and rejection counters of the admission controller"""
+    return jsonify({'admission': admission.metrics()})
+
+
+@mod.route('/opportunities/single-flight-metrics')
+@metrics_view
+def single_flight_metrics():
+    """Executed and coalesced counts of identical concurrent queries"""
+    return jsonify({'single_flight': db.opportunity_dao.single_flight.stats()})
+
+
+@mod.route('/opportunities/signal-metrics')
+@metrics_view
+def signal_metrics():
+    """Queue lag and delivery counters of the signal dispatcher"""
+    return jsonify({'signals': dispatcher.stats()})
+
+
+@mod.route('/opportunities/customer-propagation-metrics')
+@metrics_view
+def customer_propagation_metrics():
+    """Lag, debounce and throughput counters of customer change propagation"""
+    return jsonify({'customer_propagation': customer_propagation.stats()})
+
+
+@mod.route('/opportunities/live-metrics')
+@metrics_view
+def live_metrics():
+    """Subscriber and fan-out counters of the live change feed"""
+    return jsonify({'live': live_feed.stats()})
+
+
+@mod.route('/opportunities/shard-routing-metrics')
+@metrics_view
+def shard_routing_metrics():
+    """Targeted and scatter-gather query counts per DAO method"""
+    return jsonify({'shard_routing': shard_routing.stats()})
@@ -0,0 +1,82 @@
+"""
+Server side time budgets and cancellation for expensive opportunity queries.
+
+Every budgeted operation carries the current request's operation tag as its
+`comment`, so the operations a request started can be found in `currentOp`
+and killed when the request is aborted.
+"""
+import logging
+import threading
+
+from pymongo.errors import ExecutionTimeout, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Server error codes for pipelines that ran out of memory without allowDiskUse.
+MEMORY_LIMIT_ERROR_CODES = (292, 16819, 16945)
+
+_local = threading.local()
+
+
+class ReportTooLargeError(Exception):
+    """
+    Raised when a report or list query exceeds its budget.
+    """
+    def __init__(self, message=None):
+        message = message or 'This report is too large. Please narrow your filters and try again.'
+        super(ReportTooLargeError, self).__init__(message)
+        self.message = message
+
+
+def set_operation_tag(tag):
+    _local.tag = tag
+    _local.used = False
+
+
+def get_operation_tag():
+    return getattr(_local, 'tag', None)
+
+
+def use_operation_tag():
+    '''
+    The tag to attach to an operation about to be sent. Marks the request as
+    having operations that may need killing.
+    '''
+    tag = get_operation_tag()
+    if tag:
+        _local.used = True
+    return tag
+
+
+def pop_operation_tag():
+    '''
+    :return: the tag if any operation was sent with it, else None
+    '''
+    tag = get_operation_tag() if getattr(_local, 'used', False) else None
+    _local.tag = None
+    _local.used = False
+    _local.fingerprint = None
+    return tag
+
+
+def note_fingerprint(fingerprint):
+    '''
+    Remember the filter fingerprint of the last budgeted cursor, for
+    operations whose budget is only hit while the caller iterates them.
+    '''
+    _local.fingerprint = fingerprint
+
+
+def get_fingerprint():
+    return getattr(_local, 'fingerprint', None)
+
+
+def is_budget_error(error):
+    if isinstance(error, ExecutionTimeout):
+        return True
+    return isinstance(error, OperationFailure) and error.code in MEMORY_LIMIT_ERROR_CODES
+
+
+def log_budget_hit(name, fingerprint, error):
+    logger.warning('Query budget exceeded for %s (filters %s): %s',
+                   name, fingerprint, error)
@@ -1,12 +1,33 @@
 import shlex
 import re
 import copy
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from datetime import datetime, timedelta
 
 from market_crm import signals
 from .model import Opportunity as OpportunityModel, OpportunityStockTypeOptions
 from .schemas import OpportunitySchema
+from .singleflight import SingleFlight, coalesced, fingerprint
+from . import budgets
+from .budgets import ReportTooLargeError
+from .dispatch import dispatcher
+from .propagation import customer_propagation
+from .cache import LRUCache
+from .dealers import DealerDirectory
+from .jobs import JobFailed
+from .pivots import pivot_lead_channels, pivot_status_channels
+from . import snapshots
+from .sync import InvalidSyncToken, SyncPosition
+from .routing import SHARD_KEY, shard_routing
 from market_crm.database.base_dao_pymongo import MongoDAO
 from market_crm.utils.helper import (reporting_period,
                                      get_date_filter,
@@ -14,6 +35,251 @@ from market_crm.utils.helper import (reporting_period,
                                      dictdelta)
 
 OPPORTUNITY = "opportunity"
+CUSTOMER = "customer"
+REPORT_SNAPSHOT = "opportunity_report_snapshot"
+CLOSED_PERIOD = "opportunity_closed_period"
+STATUS_EVENT = "opportunity_status_event"
+GROSS_PROFIT = "opportunity_gross_profit"
+JOB = "opportunity_job"
+MAINTENANCE_PROGRESS = "opportunity_maintenance_progress"
+TOMBSTONE = "opportunity_tombstone"
+LIST_ROW = "opportunity_list_row"
+ARCHIVE = "opportunity_archive"
+DEALER_RENAME = "opportunity_dealer_rename"
+LIST_VERSION = "opportunity_list_version"
+# Collections sharded on SHARD_KEY in a sharded deployment
+SHARDED_COLLECTIONS = (OPPORTUNITY, STATUS_EVENT, TOMBSTONE)
+# Views adding archived opportunities to the opportunities and list rows
+OPPORTUNITY_WITH_ARCHIVE = "opportunity_with_archive"
+LIST_ROW_WITH_ARCHIVE = "opportunity_list_row_with_archive"
+
+CUSTOMER_KEYWORD_FIELDS = [
+    'first_name',
+    'last_name',
+    'company_name',
+    'drivers_license',
+    'phone',
+    'work_phone',
+    'cell_phone',
+    'home_phone',
+]
+
+CUSTOMER_PHONE_FIELDS = ['cell_phone', 'work_phone', 'home_phone', 'phone']
+
+# maintenance_progress run of `backfill_customer_contact_flags`
+CONTACT_FLAGS_BACKFILL = 'customer_contact_flags'
+
+
+def _customer_contact_flags(customer):
+    '''
+    Whether a customer can be reached by phone and by email, denormalized onto
+    their opportunities for the employee report.
+
+    These are the rules the report applied when it joined the customer: a
+    phone field only counts as absent when it is None or 'None', so a missing
+    or empty one counts as a phone, and emails count unless the list is
+    missing, empty or [None]. A missing customer is passed as {}.
+    '''
+    has_phone = any(customer.get(f, '') not in (None, 'None')
+                    for f in CUSTOMER_PHONE_FIELDS)
+    has_email = 'emails' in customer and customer['emails'] not in ([], [None])
+    return {
+        'customer_has_phone': has_phone,
+        'customer_has_email': has_email,
+    }
+
+
+def _customer_fields(customer):
+    '''
+    The customer derived fields stored on each of the customer's opportunities.
+    '''
+    customer_name = u'{} {}'.format(customer.get('first_name', ''),
+                                    customer.get('last_name', ''))
+
+    keywords = [customer.get(f)
+                for f in CUSTOMER_KEYWORD_FIELDS] + [customer_name]
+    keywords = filter(bool, keywords)  # remove empty values
+    for email in customer.get('emails') or []:
+        keywords.append(email['email'])
+
+    return dict(_customer_contact_flags(customer),
+                customer_name=customer_name.strip(),
+                customer_keywords=keywords)
+
+
+def _record_status_change(last_status_change, status, changed_at):
+    last_status_change[str(status)] = changed_at
+
+    # if settings the status to pending and there is no sent to fi date,
+    # we want to fill the sent to fi date with the pending date.
+    _is_pending = str(status) == str(OpportunityModel.STATUS.PENDING)
+    _has_fi_date = bool(last_status_change.get(str(OpportunityModel.STATUS.FI)))
+    if _is_pending and not _has_fi_date:
+        last_status_change[str(OpportunityModel.STATUS.FI)] = changed_at
+
+
+def _status_event(opportunity, from_status, from_entered, to_status, changed_at):
+    '''
+    An entry of the append-only status transition history. The time spent in
+    the previous status is stored with the event so stage durations don't
+    need the opportunity's earlier events.
+    '''
+    duration = None
+    if from_entered is not None:
+        duration = (changed_at - from_entered).total_seconds()
+        # A backdated status_date_change can precede the previous change;
+        # such an event has no meaningful duration
+        if duration < 0:
+            duration = None
+
+    return {
+        'opportunity_id': opportunity['_id'],
+        'organization_id': opportunity.get('organization_id'),
+        'dealer_id': opportunity.get('dealer_id'),
+        'from_status': from_status,
+        'to_status': to_status,
+        'from_status_entered': from_entered,
+        'changed_at': changed_at,
+        'duration_seconds': duration,
+    }
+
+
+# Fields of an opportunity copied to its list row: what the grid shows,
+# filters and sorts on, and what the permission checks read.
+LIST_ROW_FIELDS = (
+    '_id', 'organization_id', 'dealer_id', 'dealer_name', 'customer_id',
+    'customer_name', 'customer_keywords', 'name', 'status', 'sub_status',
+    'lost_reason', 'creator', 'stock_type', 'primary_pitch_id',
+    'sales_managers', 'sales_reps', 'customer_reps', 'bdc_reps',
+    'finance_managers', 'pitches', 'leads', 'crm_lead_ids',
+    'credit_applications', 'marketing', 'created', 'updated', 'denormalized',
+    'last_status_change', 'reporting_period', 'carryover_date',
+    'alert_types', 'test_drive_number',
+)
+
+
+def _list_row(opportunity):
+    row = dict((field, opportunity[field]) for field in LIST_ROW_FIELDS if field in opportunity)
+    deal_number = (opportunity.get('dms_deal') or {}).get('deal_number')
+    if deal_number:
+        row['dms_deal'] = {'deal_number': deal_number}
+    return row
+
+
+def _shard_key(organization_id=None, dealer_id=None):
+    key = {}
+    if organization_id is not None:
+        key['organization_id'] = organization_id
+    if dealer_id is not None:
+        key['dealer_id'] = dealer_id
+    return key
+
+
+def _shard_key_of(opportunity):
+    '''
+    The shard key of a loaded opportunity, to target writes to it.
+    '''
+    return dict((field, opportunity[field]) for field, _ in SHARD_KEY if field in opportunity)
+
+
+def _list_version_bump(organization_id=None):
+    '''
+    The write marking the lists of an organization, or of every organization
+    if None, as changed.
+    '''
+    return UpdateOne({'_id': organization_id or '*'},
+                     {'$set': {'bumped': datetime.utcnow()}}, upsert=True)
+
+
+def _list_row_projection():
+    projection = dict((field, 1) for field in LIST_ROW_FIELDS)
+    projection['dms_deal.deal_number'] = 1
+    return projection
+
+
+def _stock_type_for_deal(dms_deal):
+    stock_type = (dms_deal.get('deal_type') or '').lower()
+    if stock_type not in OpportunityStockTypeOptions.ALL:
+        stock_type = OpportunityStockTypeOptions.UNKNOWN
+    return stock_type
+
+
+def _month_date_filter(year, month):
+    '''
+    `created` date filter covering a whole month; date_to is inclusive.
+    '''
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return {'date_from': start, 'date_to': end - timedelta(days=1)}
+
+
+def _day(value):
+    # date_to is inclusive by day, so bounds compare by calendar day whether
+    # they come as dates, midnights or end of day datetimes
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        return value.date()
+    return value
+
+
+def _closed_month(created):
+    '''
+    (year, month) of the past month exactly covered by a `created` date
+    filter, or None.
+    '''
+    start = _day(created.get('date_from'))
+    end = _day(created.get('date_to'))
+    if not start or not end:
+        return None
+
+    month = _month_date_filter(start.year, start.month)
+    if (start, end) != (month['date_from'].date(), month['date_to'].date()):
+        return None
+
+    now = datetime.utcnow()
+    if (start.year, start.month) >= (now.year, now.month):
+        return None
+    return start.year, start.month
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+def _merge_group_results(results):
+    '''
+    Merge $group results computed over separate partitions. Rows with the same
+    `_id` are combined by summing numeric fields and unioning list ($addToSet)
+    fields.
+    '''
+    merged = OrderedDict()
+    seen = {}
+    for row in results:
+        key = _hashable(row['_id'])
+        current = merged.get(key)
+        if current is None:
+            current = merged[key] = {'_id': row['_id']}
+
+        for field, value in row.items():
+            if field == '_id':
+                continue
+            if isinstance(value, list):
+                values = current.setdefault(field, [])
+                field_seen = seen.setdefault((key, field), set())
+                for item in value:
+                    item_key = _hashable(item)
+                    if item_key not in field_seen:
+                        field_seen.add(item_key)
+                        values.append(item)
+            else:
+                current[field] = current.get(field, 0) + (value or 0)
+
+    return list(merged.values())
 
 
 class MongoOpportunity(MongoDAO):
@@ -87,6 +353,91 @@ class MongoOpportunity(MongoDAO):
         test_drive_number=0,
     )
 
+    # Reports over more dealer_ids than this are split into partitions of this
+    # size and run concurrently on a pool of REPORT_PARALLELISM threads.
+    # None runs every report as a single aggregation.
+    REPORT_PARTITION_SIZE = None
+    REPORT_PARALLELISM = 4
+
+    _report_pool = None
+    _report_pool_lock = threading.Lock()
+
+    # Identical concurrent report and list queries in this process share one
+    # execution. Give it a FileLockStore to also coalesce across the workers
+    # of a host.
+    single_flight = SingleFlight()
+
+    # Server side budgets for expensive operations, keyed by DAO method name.
+    # `max_time_ms` becomes maxTimeMS; `allow_disk_use` lets aggregation stages
+    # spill to disk instead of failing once they hit the in-memory limit.
+    QUERY_BUDGETS = {
+        'default': {'max_time_ms': 30000, 'allow_disk_use': False},
+        '_get_opportunities': {'max_time_ms': 15000},
+        'aggregate_opportunity_data_by_dealer': {'max_time_ms': 60000, 'allow_disk_use': True},
+        'aggregate_opportunity_sales_funnel_reports': {'max_time_ms': 60000, 'allow_disk_use': True},
+        'aggregate_deallog_recap_reports': {'max_time_ms': 60000, 'allow_disk_use': True},
+        'aggregate_employee_opportunity_report': {'max_time_ms': 60000},
+    }
+
+    # Signals go through this dispatcher; in 'async' mode subscribers run off
+    # the request path (see `dispatch.SignalDispatcher`).
+    signal_dispatcher = dispatcher
+
+    # Customer changes are written onto opportunities through this queue;
+    # in 'async' mode they are debounced per customer and batched. See
+    # `propagation` for what 'async' gives up.
+    customer_propagation = customer_propagation
+
+    dealer_directory = DealerDirectory(dealer_name)
+    # dealer_id -> organization_id, to add the whole shard key to queries
+    # by dealer. A dealer never changes organization.
+    dealer_organizations = LRUCache(maxsize=4096)
+
+    # Counts queries by whether they carry the shard key and flags the ones
+    # broadcast to every shard (see `routing.ShardRouting`)
+    shard_routing = shard_routing
+
+    # Finished background jobs are removed after this long
+    JOB_RETENTION_SECONDS = 7 * 24 * 3600
+    # Jobs queued or silent this long are taken to be lost with their process
+    JOB_STALE_SECONDS = 3600
+
+    # Deletions are kept for delta sync this long; older sync tokens expire
+    TOMBSTONE_RETENTION_SECONDS = 30 * 24 * 3600
+    # Delta sync leaves out the most recent changes, whose writes may still
+    # be in flight with an earlier `updated`
+    SYNC_SETTLE_SECONDS = 5
+
+    # Maintain the `opportunity_list_row` read model on every write and serve
+    # the grid from it. Run `rebuild_list_rows` before turning this on.
+    LIST_ROWS_ENABLED = False
+
+    # Closed opportunities untouched for ARCHIVE_AFTER_DAYS are moved to the
+    # `opportunity_archive` collection by `archive_opportunities`. Lists and
+    # reports only read the archive when their filters can match archived
+    # opportunities. Needs the views from `create_archive_views`.
+    ARCHIVE_ENABLED = False
+    ARCHIVE_AFTER_DAYS = 365
+    ARCHIVE_STATUSES = (OpportunityModel.STATUS.LOST,
+                        OpportunityModel.STATUS.TUBED,
+                        OpportunityModel.STATUS.POSTED)
+
+    # Sales funnel, deallog recap and daily operations reports over whole
+    # past months are served from the columnar snapshots under this directory
+    # when set. `refresh_snapshots` keeps them current and should run daily;
+    # partitions not refreshed within SNAPSHOT_MAX_AGE seconds are ignored.
+    SNAPSHOT_ROOT = None
+    SNAPSHOT_MAX_AGE = 2 * 24 * 3600
+    SNAPSHOT_MONTHS = 24
+
+    # Stored gross profits are re-validated against the deal XML's ETag once
+    # DMS ingestion marks them stale, and at the latest after this many
+    # seconds, for XML that lands without going through the ingest paths.
+    GROSS_PROFIT_MAX_AGE = 6 * 3600
+
+    BULK_OPERATIONS = ('replace_assignee', 'set_status', 'set_reporting_period')
+    BULK_CHUNK_SIZE = 500
+
     @property
     def opportunities(self):
         return self.db[OPPORTUNITY]
@@ -95,6 +446,103 @@ class MongoOpportunity(MongoDAO):
     def opportunities_secondary(self):
         return self.db_secondary[OPPORTUNITY]
 
+    @property
+    def report_snapshots(self):
+        return self.db[REPORT_SNAPSHOT]
+
+    @property
+    def closed_periods(self):
+        return self.db[CLOSED_PERIOD]
+
+    @property
+    def status_events(self):
+        return self.db[STATUS_EVENT]
+
+    @property
+    def gross_profits(self):
+        return self.db[GROSS_PROFIT]
+
+    @property
+    def jobs(self):
+        return self.db[JOB]
+
+    @property
+    def maintenance_progress(self):
+        return self.db[MAINTENANCE_PROGRESS]
+
+    @property
+    def tombstones(self):
+        return self.db[TOMBSTONE]
+
+    @property
+    def list_rows(self):
+        return self.db[LIST_ROW]
+
+    @property
+    def list_rows_secondary(self):
+        return self.db_secondary[LIST_ROW]
+
+    @property
+    def archive(self):
+        return self.db[ARCHIVE]
+
+    @property
+    def dealer_renames(self):
+        return self.db[DEALER_RENAME]
+
+    @property
+    def list_versions(self):
+        return self.db[LIST_VERSION]
+
+    def _opportunity_source(self, filters):
+        '''
+        Where queries for opportunities matching `filters` read from.
+        '''
+        if self.needs_archive(filters):
+            return self.db_secondary[OPPORTUNITY_WITH_ARCHIVE]
+        return self.opportunities_secondary
+
+    def _list_collection(self, filters):
+        '''
+        Where the grid's list queries read from.
+        '''
+        if self.LIST_ROWS_ENABLED:
+            if self.needs_archive(filters):
+                return self.db_secondary[LIST_ROW_WITH_ARCHIVE]
+            return self.list_rows_secondary
+        return self._opportunity_source(filters)
+
+    def _write_list_rows(self, opportunities):
+        '''
+        Replace the list rows of these opportunities, whose documents are
+        already written, with fresh copies.
+        '''
+        if self.LIST_ROWS_ENABLED and opportunities:
+            self.list_rows.bulk_write(
+                [ReplaceOne({'_id': opportunity['_id']}, _list_row(opportunity), upsert=True)
+                 for opportunity in opportunities], ordered=False)
+
+    def _mirror_list_rows(self, requests):
+        '''
+        Apply writes made to opportunities to their list rows as well. Only
+        for writes whose filters and updates use list row fields alone.
+        '''
+        if self.LIST_ROWS_ENABLED and requests:
+            self.list_rows.bulk_write(requests, ordered=False)
+
+    def _update_archive(self, query, fields):
+        '''
+        Apply a multi-document $set to archived opportunities too. `updated`
+        is left alone so they stay out of queries for recent changes.
+        '''
+        if self.ARCHIVE_ENABLED:
+            result = self.archive.update_many(query, {'$set': fields})
+            if result.modified_count:
+                self.bump_list_version(query.get('organization_id'))
+
+    def _send(self, signal, **kwargs):
+        self.signal_dispatcher.send(signal, self, **kwargs)
+
     def iter_all(self):
         """
         Return an cusor for iterating over all opportunities.
@@ -106,15 +554,85 @@ class MongoOpportunity(MongoDAO):
         self.opportunities.create_index(
             [('customer_keywords', 'text'), ('dms_deal.deal_number', 'text')])
         self.opportunities.create_index([('dms_deal.deal_number', 1)])
+        self.opportunities.create_index([('dealer_id', 1), ('dms_deal.deal_number', 1)])
+        self.opportunities.create_index([('organization_id', 1), ('dealer_id', 1), ('updated', 1)])
+        self.report_snapshots.create_index(
+            [('organization_id', 1), ('year', 1), ('month', 1), ('dealer_id', 1)],
+            unique=True)
+        self.closed_periods.create_index(
+            [('organization_id', 1), ('year', 1), ('month', 1)], unique=True)
+        self.status_events.create_index(
+            [('organization_id', 1), ('dealer_id', 1), ('changed_at', 1)])
+        self.status_events.create_index([('opportunity_id', 1), ('changed_at', 1)])
+        self.gross_profits.create_index([('dealer_id', 1), ('deal_number', 1)], unique=True)
+        self.jobs.create_index([('finished', 1)], expireAfterSeconds=self.JOB_RETENTION_SECONDS)
+        self.jobs.create_index([('status', 1), ('heartbeat', 1)])
+        self.maintenance_progress.create_index([('run', 1), ('partition', 1)], unique=True)
+        self.tombstones.create_index([('organization_id', 1), ('dealer_id', 1), ('deleted', 1)])
+        self.tombstones.create_index([('deleted', 1)],
+                                     expireAfterSeconds=self.TOMBSTONE_RETENTION_SECONDS)
+        self.list_rows.create_index([('organization_id', 1), ('dealer_id', 1), ('created', -1)])
+        self.list_rows.create_index(
+            [('organization_id', 1), ('dealer_id', 1), ('status', 1), ('created', -1)])
+        self.list_rows.create_index([('organization_id', 1), ('customer_name', 1)])
+        self.list_rows.create_index([('organization_id', 1), ('dealer_name', 1)])
+        self.list_rows.create_index([('organization_id', 1), ('updated', -1)])
+        self.list_rows.create_index([('organization_id', 1), ('sales_reps', 1)])
+        self.list_rows.create_index([('organization_id', 1), ('bdc_reps', 1)])
+        self.list_rows.create_index([('customer_id', 1)])
+        self.list_rows.create_index([('dms_deal.deal_number', 1)])
+        self.opportunities.create_index([('status', 1), ('updated', 1)])
+        self.opportunities.create_index([('organization_id', 1), ('updated', -1)])
+        self.tombstones.create_index([('organization_id', 1), ('deleted', -1)])
+        self.archive.create_index([('organization_id', 1), ('dealer_id', 1), ('created', -1)])
+        self.archive.create_index([('customer_id', 1)])
+        self.dealer_renames.create_index([('renamed', 1)])
+        if self.ARCHIVE_ENABLED:
+            self.create_archive_views()
+
+    def create_archive_views(self):
+        '''
+        Create or update the views reading the hot collections and the
+        archive together. $unionWith needs MongoDB 4.4, and 5.1 once the
+        collections are sharded (see `shard_collections`).
+        '''
+        views = {
+            OPPORTUNITY_WITH_ARCHIVE: (OPPORTUNITY, [{'$unionWith': ARCHIVE}]),
+            LIST_ROW_WITH_ARCHIVE: (LIST_ROW, [{'$unionWith': {
+                'coll': ARCHIVE,
+                'pipeline': [{'$project': _list_row_projection()}],
+            }}]),
+        }
+        existing = set(self.db.collection_names())
+        for name, (view_on, pipeline) in views.items():
+            command = 'collMod' if name in existing else 'create'
+            self.db.command(command, name, viewOn=view_on, pipeline=pipeline)
+
+    def shard_collections(self):
+        '''
+        Shard SHARDED_COLLECTIONS on SHARD_KEY. Run through mongos after
+        `create_indexes`, which creates the indexes starting with the key.
+
+        With ARCHIVE_ENABLED the archive views $unionWith the opportunity
+        collection, and $unionWith can only read a sharded collection from
+        MongoDB 5.1 on; don't shard an archive enabled deployment on older
+        servers.
+        '''
+        admin = self.db.client.admin
+        admin.command('enableSharding', self.db.name)
+        for name in SHARDED_COLLECTIONS:
+            admin.command('shardCollection', '{}.{}'.format(self.db.name, name),
+                          key=SON(SHARD_KEY))
 
     def get_opportunities_for_maintenance(self, limit=None,
-                                          batch_size=None):
+                                          batch_size=None, projection=None):
         """ Gets customers by last_maintenance, and updates the datetime.
+        For large runs prefer `maintenance.PartitionedScan`.
         :param limit: The limit of customers to retrieve.
         :param batch_size: The size number of records to retrieve per request
-        :param distinct: A field of an opportunity to get distinct records on
+        :param projection: Only read these fields
         """
-        cursor = self.iter_all()
+        cursor = self.opportunities.find(projection=projection)
 
         if limit:
             limit = int(limit)
@@ -125,13 +643,239 @@ class MongoOpportunity(MongoDAO):
 
         return cursor
 
-    def add_opportunity(self, **kwargs):
+    def opportunity_id_ranges(self, partitions):
+        """
+        Split the collection into about `partitions` ranges of `_id` with
+        similar numbers of opportunities.
+        :return: list of (lower, upper) with `lower` inclusive and `upper`
+            exclusive; the last range has no upper bound
+        """
+        buckets = list(self.opportunities_secondary.aggregate([
+            {'$bucketAuto': {'groupBy': '$_id', 'buckets': partitions}},
+        ], allowDiskUse=True))
+        bounds = [bucket['_id']['min'] for bucket in buckets]
+        return list(zip(bounds, bounds[1:] + [None]))
+
+    def count_opportunity_range(self, lower, upper):
+        """
+        Number of opportunities with `_id` in [lower, upper), counted on the
+        `_id` index.
+        """
+        id_range = {'$gte': lower}
+        if upper is not None:
+            id_range['$lt'] = upper
+        return self.opportunities_secondary.find({'_id': id_range}).count()
+
+    def iter_opportunity_range(self, lower, upper, after=None, projection=None, limit=None):
+        """
+        Opportunities with `_id` in [lower, upper), after `after`, in `_id` order.
+        """
+        id_range = {'$gt': after} if after is not None else {'$gte': lower}
+        if upper is not None:
+            id_range['$lt'] = upper
+        cursor = self.opportunities.find({'_id': id_range}, projection=projection).sort('_id', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def get_maintenance_progress(self, run):
+        return list(self.maintenance_progress.find({'run': run}).sort('partition', 1))
+
+    def save_maintenance_progress(self, run, partition, owner=None, **fields):
+        '''
+        :param owner: only save if `owner` holds the partition's lease
+        :return: the progress document, or None if the lease was lost
+        '''
+        query = {'run': run, 'partition': partition}
+        if owner is not None:
+            query['owner'] = owner
+        return self.maintenance_progress.find_one_and_update(
+            query,
+            {'$set': dict(fields, updated=datetime.utcnow())},
+            upsert=owner is None, return_document=ReturnDocument.AFTER)
+
+    def lease_maintenance_partition(self, run, partition, owner, seconds):
+        '''
+        Take the lease on an unfinished partition for `seconds`, unless
+        another owner holds an unexpired one.
+        :return: the progress document, or None if it is leased or done
+        '''
+        now = datetime.utcnow()
+        return self.maintenance_progress.find_one_and_update(
+            {'run': run, 'partition': partition, 'done': False,
+             '$or': [{'owner': owner},
+                     {'lease_expires': None},
+                     {'lease_expires': {'$lt': now}}]},
+            {'$set': {'owner': owner,
+                      'lease_expires': now + timedelta(seconds=seconds),
+                      'updated': now}},
+            return_document=ReturnDocument.AFTER)
+
+    def reset_maintenance_progress(self, run):
+        self.maintenance_progress.delete_many({'run': run})
+
+    def rebuild_list_rows(self, batch_size=1000):
+        """
+        Rewrite every list row from its opportunity and remove the rows of
+        opportunities that no longer exist.
+        :return: dict with the number of rows `written` and `removed`
+        """
+        projection = list(LIST_ROW_FIELDS) + ['dms_deal.deal_number']
+        written = 0
+        requests = []
+        for opportunity in self.opportunities.find({}, projection, batch_size=batch_size):
+            requests.append(
+                ReplaceOne({'_id': opportunity['_id']}, _list_row(opportunity), upsert=True))
+            if len(requests) >= batch_size:
+                self.list_rows.bulk_write(requests, ordered=False)
+                written += len(requests)
+                requests = []
+        if requests:
+            self.list_rows.bulk_write(requests, ordered=False)
+            written += len(requests)
+
+        removed = 0
+        ids = []
+        for row in self.list_rows.find({}, {'_id': 1}, batch_size=batch_size):
+            ids.append(row['_id'])
+            if len(ids) >= batch_size:
+                removed += self._remove_orphaned_list_rows(ids)
+                ids = []
+        if ids:
+            removed += self._remove_orphaned_list_rows(ids)
+
+        return {'written': written, 'removed': removed}
+
+    def _remove_orphaned_list_rows(self, ids):
+        existing = set(opportunity['_id'] for opportunity
+                       in self.opportunities.find({'_id': {'$in': ids}}, {'_id': 1}))
+        orphaned = [id for id in ids if id not in existing]
+        if not orphaned:
+            return 0
+        return self.list_rows.delete_many({'_id': {'$in': orphaned}}).deleted_count
+
+    def detect_list_row_drift(self, sample_size=1000, repair=False):
+        """
+        Compare a random sample of opportunities with their list rows.
+        Writes racing with the check can show up as false positives.
+        :param repair: rewrite the rows found missing or different
+        :return: dict with the number of opportunities `checked`, the ids of
+            `missing` and `mismatched` rows and the difference in size
+            between the two collections
+        """
+        projection = _list_row_projection()
+        sample = list(self.opportunities.aggregate([
+            {'$sample': {'size': sample_size}},
+            {'$project': projection},
+        ]))
+        rows = dict((row['_id'], row) for row in self.list_rows.find(
+            {'_id': {'$in': [opportunity['_id'] for opportunity in sample]}}))
+
+        missing = []
+        mismatched = []
+        for opportunity in sample:
+            row = rows.get(opportunity['_id'])
+            if row is None:
+                missing.append(opportunity)
+                continue
+            # Rows also pick up fields set by mirrored multi-updates; only the
+            # list row fields count
+            row = dict((field, value) for field, value in row.items()
+                       if field in LIST_ROW_FIELDS or field == 'dms_deal')
+            if row != _list_row(opportunity):
+                mismatched.append(opportunity)
+
+        if repair and (missing or mismatched):
+            self.list_rows.bulk_write(
+                [ReplaceOne({'_id': opportunity['_id']}, _list_row(opportunity), upsert=True)
+                 for opportunity in missing + mismatched], ordered=False)
+
+        return {
+            'checked': len(sample),
+            'missing': [opportunity['_id'] for opportunity in missing],
+            'mismatched': [opportunity['_id'] for opportunity in mismatched],
+            'size_difference': self.opportunities.count() - self.list_rows.count(),
+        }
+
+    def _archive_cutoff(self):
+        return datetime.utcnow() - timedelta(days=self.ARCHIVE_AFTER_DAYS)
+
+    def _archive_query(self, cutoff):
+        # Every condition `needs_archive` relies on to leave the archive out
+        return {
+            'status': {'$in': list(self.ARCHIVE_STATUSES)},
+            'created': {'$lt': cutoff},
+            'updated': {'$lt': cutoff},
+            '$or': [
+                {'reporting_period.year': {'$lt': cutoff.year}},
+                {'reporting_period.year': cutoff.year,
+                 'reporting_period.month': {'$lt': cutoff.month}},
+            ],
+        }
+
+    def archive_opportunities(self, batch_size=500, throttle=1.0, limit=None):
+        '''
+        Move closed opportunities untouched for ARCHIVE_AFTER_DAYS to the
+        archive, `batch_size` at a time, sleeping `throttle` seconds between
+        batches to leave room for the regular load.
+        :param limit: stop after about this many opportunities
+        :return: number of opportunities archived
+        '''
+        if not self.ARCHIVE_ENABLED:
+            raise RuntimeError("Archived opportunities would be unreachable, "
+                               "set ARCHIVE_ENABLED first")
+
+        query = self._archive_query(self._archive_cutoff())
+        archived = 0
+        while limit is None or archived < limit:
+            batch = list(self.opportunities.find(query).sort('_id', 1).limit(batch_size))
+            if not batch:
+                break
+            archived += self._archive_batch(query, batch)
+            if len(batch) < batch_size:
+                break
+            time.sleep(throttle)
+        return archived
+
+    def _archive_batch(self, query, batch):
+        ids = [opportunity['_id'] for opportunity in batch]
+        self.archive.bulk_write(
+            [ReplaceOne({'_id': opportunity['_id']}, opportunity, upsert=True)
+             for opportunity in batch], ordered=False)
+
+        # Opportunities written to since they were read no longer match and
+        # stay; drop their copy from the archive again
+        deleted = self.opportunities.delete_many(dict(query, _id={'$in': ids})).deleted_count
+        if deleted < len(ids):
+            kept = set(opportunity['_id'] for opportunity
+                       in self.opportunities.find({'_id': {'$in': ids}}, {'_id': 1}))
+            self.archive.delete_many({'_id': {'$in': list(kept)}})
+            ids = [id for id in ids if id not in kept]
+
+        self.list_rows.delete_many({'_id': {'$in': ids}})
+        moved = set(ids)
+        self._write_tombstones(
+            [opportunity for opportunity in batch if opportunity['_id'] in moved], 'archived')
+        for organization_id in set(opportunity.get('organization_id') for opportunity in batch
+                                   if opportunity['_id'] in moved):
+            self.bump_list_version(organization_id)
+        return len(ids)
+
+    def _restore_opportunity(self, opportunity):
+        '''
+        Move an archived opportunity back to the hot collection.
+        '''
+        match = dict(_shard_key_of(opportunity), _id=opportunity['_id'])
+        self.opportunities.replace_one(match, opportunity, upsert=True)
+        self.archive.delete_one({'_id': opportunity['_id']})
+        self._write_list_rows([opportunity])
+
+    def _new_opportunity(self, now, **kwargs):
         default = self.OPPORTUNITY_DEFAULTS
 
         opportunity = dict(default, **kwargs)
         opportunity = dict(opportunity, _id=ObjectId())
 
-        now = datetime.utcnow()
         opportunity['created'] = now
         opportunity['updated'] = now
         opportunity['reporting_period'] = reporting_period(now.year, now.month)
@@ -150,19 +894,195 @@ class MongoOpportunity(MongoDAO):
         if not kwargs.get('dealer_id'):
             raise TypeError("dealer_id is required to create an opportunity")
 
+        return opportunity
+
+    def add_opportunity(self, **kwargs):
+        now = datetime.utcnow()
+        opportunity = self._new_opportunity(now, **kwargs)
+
+        if 'customer_has_phone' not in kwargs:
+            opportunity.update(self.get_customer_contact_flags(opportunity.get('customer_id')))
+
         self.opportunities.insert_one(opportunity)
+        self._write_list_rows([opportunity])
+        self.status_events.insert_one(
+            _status_event(opportunity, None, None, opportunity['status'], now))
 
-        signals.opportunity_created.send(self, opportunity=opportunity)
+        self._send(signals.opportunity_created, opportunity=opportunity)
         return OpportunityModel(opportunity)
 
-    def get_opportunity(self, id):
+    def add_opportunities(self, opportunities, chunk_size=None, errors=None):
+        """
+        Create many opportunities, e.g. for a lead import, with one
+        insert_many per chunk.
+        :param opportunities: list of dicts of the `add_opportunity` arguments
+        :param errors: dict to fill with the index in `opportunities` -> error
+            message of each opportunity that could not be inserted. Without
+            it, the last insert error is raised once every chunk is written.
+        :return: list of the created opportunities
+        """
+        chunk_size = chunk_size or self.BULK_CHUNK_SIZE
+        now = datetime.utcnow()
+        created = [self._new_opportunity(now, **kwargs) for kwargs in opportunities]
+
+        needs_flags = [opportunity for opportunity in created
+                       if 'customer_has_phone' not in opportunity]
+        flags = self.get_customers_contact_flags(
+            list(set(opportunity['customer_id'] for opportunity in needs_flags
+                     if opportunity.get('customer_id'))))
+        for opportunity in needs_flags:
+            opportunity.update(flags.get(opportunity.get('customer_id')) or
+                               _customer_contact_flags({}))
+
+        inserted = []
+        insert_error = None
+        for start in range(0, len(created), chunk_size):
+            chunk = created[start:start + chunk_size]
+            try:
+                self.opportunities.insert_many(chunk, ordered=False)
+            except BulkWriteError as e:
+                # Unordered: everything but the failed documents went in
+                insert_error = e
+                failed = dict((error['index'], error.get('errmsg'))
+                              for error in e.details.get('writeErrors', []))
+                if errors is not None:
+                    errors.update((start + index, message) for index, message in failed.items())
+                chunk = [opportunity for index, opportunity in enumerate(chunk)
+                         if index not in failed]
+                if not chunk:
+                    continue
+
+            self._write_list_rows(chunk)
+            self.status_events.insert_many(
+                [_status_event(opportunity, None, None, opportunity['status'], now)
+                 for opportunity in chunk], ordered=False)
+
+            # Signals go out once the whole chunk is written
+            for opportunity in chunk:
+                self._send(signals.opportunity_created, opportunity=opportunity)
+            inserted.extend(chunk)
+
+        if insert_error is not None and errors is None:
+            raise insert_error
+        return [OpportunityModel(opportunity) for opportunity in inserted]
+
+    def get_opportunity(self, id, restore=False, organization_id=None, dealer_id=None):
+        '''
+        :param restore: move the opportunity back out of the archive if it
+            is there, before writing to it
+        :param organization_id: with `dealer_id`, the shard key of the
+            opportunity if known, to read it from its shard only
+        '''
         match = OpportunitySchema(only=['_id']).load({'_id': id}).data
+        match.update(self._shard_key_for_id(match['_id'], organization_id, dealer_id))
+        self.shard_routing.note('get_opportunity', match)
         opportunity = self.opportunities.find_one(match)
+        if opportunity is None and self.ARCHIVE_ENABLED:
+            opportunity = self.archive.find_one(match)
+            if opportunity and restore:
+                self._restore_opportunity(opportunity)
         if opportunity:
             opportunity = OpportunityModel(opportunity)
 
         return opportunity
 
+    def get_opportunity_version(self, id, organization_id=None, dealer_id=None):
+        '''
+        The latest of the `updated` and `denormalized` timestamps of an
+        opportunity, read without loading the document; None if it doesn't
+        exist.
+        '''
+        match = OpportunitySchema(only=['_id']).load({'_id': id}).data
+        match.update(self._shard_key_for_id(match['_id'], organization_id, dealer_id))
+        self.shard_routing.note('get_opportunity_version', match)
+        projection = {'updated': 1, 'denormalized': 1}
+        opportunity = self.opportunities.find_one(match, projection)
+        if opportunity is None and self.ARCHIVE_ENABLED:
+            opportunity = self.archive.find_one(match, projection)
+        if opportunity:
+            updated = opportunity.get('updated') or opportunity['_id'].generation_time
+            return max(updated, opportunity.get('denormalized') or updated)
+        return None
+
+    def get_list_version(self, organization_id):
+        '''
+        A marker that changes whenever any opportunity list of the organization
+        may have: the latest `updated`, the latest deletion, and the list
+        version bumped by writes that leave `updated` alone. Each part is one
+        index read.
+        '''
+        query = {'organization_id': organization_id}
+        self.shard_routing.note('get_list_version', query)
+        # Same source as the lists, so the version never runs ahead of them
+        rows = self.list_rows_secondary if self.LIST_ROWS_ENABLED else self.opportunities_secondary
+        latest = list(rows.find(query, {'updated': 1}).sort('updated', -1).limit(1))
+        deleted = list(self.tombstones.find(query, {'deleted': 1}).sort('deleted', -1).limit(1))
+        bumped = sorted(version['bumped'] for version in self.list_versions.find(
+            {'_id': {'$in': [organization_id, '*']}}))
+        return [latest[0].get('updated') if latest else None,
+                deleted[0]['deleted'] if deleted else None,
+                bumped[-1] if bumped else None]
+
+    def bump_list_version(self, organization_id=None):
+        '''
+        Mark the lists of an organization, or of every organization, changed
+        by a write that leaves `updated` alone, e.g. a backfill, an archive
+        move or a denormalized field update.
+        '''
+        self.list_versions.bulk_write([_list_version_bump(organization_id)])
+
+    def get_customer_contact_flags(self, customer_id):
+        '''
+        :return: the contact flags of a customer, those of a missing one if
+            `customer_id` is None
+        '''
+        if customer_id is None:
+            return _customer_contact_flags({})
+        projection = dict((f, 1) for f in CUSTOMER_PHONE_FIELDS + ['emails'])
+        customer = self.db[CUSTOMER].find_one({'_id': customer_id}, projection)
+        return _customer_contact_flags(customer or {})
+
+    def get_customers_contact_flags(self, customer_ids):
+        '''
+        :return: dict of customer id -> contact flags, read with one query
+        '''
+        projection = dict((f, 1) for f in CUSTOMER_PHONE_FIELDS + ['emails'])
+        customers = self.db[CUSTOMER].find({'_id': {'$in': customer_ids}}, projection)
+        flags = dict((customer_id, _customer_contact_flags({})) for customer_id in customer_ids)
+        for customer in customers:
+            flags[customer['_id']] = _customer_contact_flags(customer)
+        return flags
+
+    def needs_archive(self, filters):
+        '''
+        Whether opportunities matching `filters` can be in the archive. Only
+        status filters leaving out the archived statuses, and created, updated
+        or reporting period ranges starting after the archive cutoff, rule
+        it out.
+        '''
+        if not self.ARCHIVE_ENABLED:
+            return False
+
+        statuses = filters.get('statuses')
+        if statuses is not None and not set(statuses) & set(self.ARCHIVE_STATUSES):
+            return False
+
+        cutoff = self._archive_cutoff()
+        for filter_type in ('created', 'updated'):
+            date_from = (filters.get(filter_type) or {}).get('date_from')
+            if date_from and date_from >= cutoff:
+                return False
+
+        period = filters.get('reporting_period') or {}
+        if period.get('year'):
+            month = period.get('month')
+            if not month and period.get('quarter'):
+                month = (period['quarter'] - 1) * 3 + 1
+            if (period['year'], month or 1) >= (cutoff.year, cutoff.month):
+                return False
+
+        return True
+
     def make_query(self, filters):
         '''
         Given a dict of filters like {'type': value} return
@@ -320,15 +1240,32 @@ class MongoOpportunity(MongoDAO):
 
         return qry
 
-    def _get_opportunities(self, filters, sort_by=None, page=None, page_size=None, filter_query=None):
+    def _get_opportunities(self, filters, sort_by=None, page=None, page_size=None,
+                           filter_query=None, list_rows=False):
+        '''
+        :param list_rows: read the grid's list rows instead of full documents
+            when the read model is enabled
+        '''
         query = self.make_query(filters)
         if not query:
             raise ValueError("Invalid query: {}".format(query))
+        self.shard_routing.note('_get_opportunities', query)
         conditions = []
         conditions.append(query)
         if filter_query:
             conditions.append(filter_query)
-        cursor = self.opportunities_secondary.find({'$and': conditions})
+        if list_rows:
+            collection = self._list_collection(filters)
+        else:
+            collection = self._opportunity_source(filters)
+        cursor = collection.find({'$and': conditions})
+
+        budget = self._budget('_get_opportunities')
+        cursor = cursor.max_time_ms(budget['max_time_ms'])
+        if budget.get('comment'):
+            cursor = cursor.comment(budget['comment'])
+        budgets.note_fingerprint(fingerprint('_get_opportunities', filters))
+
         if page and page_size:
             cursor = cursor.skip(page_size * (page - 1)) \
                            .limit(page_size)
@@ -338,27 +1275,36 @@ class MongoOpportunity(MongoDAO):
 
         return cursor
 
+    @coalesced
     def get_opportunities(self, **kwargs):
-        return list(self._get_opportunities(**kwargs))
+        with self._budget_errors('_get_opportunities', kwargs.get('filters')):
+            return list(self._get_opportunities(**kwargs))
 
+    @coalesced
     def get_opportunities_count(self, **kwargs):
-        return self._get_opportunities(**kwargs).count()
+        with self._budget_errors('_get_opportunities', kwargs.get('filters')):
+            return self._get_opportunities(**kwargs).count()
 
-    def get_active_opportunities_by_deal_number(self, deal_number, dealer_id=None):
+    def get_active_opportunities_by_deal_number(self, deal_number, dealer_id=None,
+                                                organization_id=None):
         qry = {'dms_deal.deal_number': deal_number}
         if dealer_id:
             qry['dealer_id'] = dealer_id
             qry['status'] = {
                 '$nin': [OpportunityModel.STATUS.LOST, OpportunityModel.STATUS.TUBED]}
+        qry.update(_shard_key(organization_id))
+        self.shard_routing.note('get_active_opportunities_by_deal_number', qry)
         return self.opportunities_secondary.find(qry)
 
-    def get_active_opportunites_by_customer(self, dealer_id, customer_id):
+    def get_active_opportunites_by_customer(self, dealer_id, customer_id, organization_id=None):
         qry = {'customer_id': customer_id, 'dealer_id': dealer_id}
         qry['status'] = {
             '$nin': [OpportunityModel.STATUS.LOST,
                      OpportunityModel.STATUS.TUBED,
                      OpportunityModel.STATUS.POSTED,
                 ]}
+        qry.update(_shard_key(organization_id))
+        self.shard_routing.note('get_active_opportunites_by_customer', qry)
         return list(self.opportunities_secondary.find(qry))
 
     def get_deallog_delivered_by_date(self, dealer_id, date_from, date_to):
@@ -372,18 +1318,91 @@ class MongoOpportunity(MongoDAO):
         if opportunity:
             match_schema = OpportunitySchema(only=['_id'])
             match = match_schema.load({'_id': id}).data
+            match.update(_shard_key_of(opportunity))
             self.opportunities.delete_one(match)
+            self._mirror_list_rows([DeleteOne(match)])
+            if self.ARCHIVE_ENABLED:
+                self.archive.delete_one(match)
+            self._write_tombstones([opportunity], 'deleted')
 
-            signals.opportunity_deleted.send(self, opportunity=opportunity)
+            self._send(signals.opportunity_deleted, opportunity=opportunity)
             return True
         return False
 
+    def _write_tombstones(self, opportunities, reason, dealer_id=None):
+        '''
+        Record that these opportunities left the changes feed of their
+        organization and dealer: deleted, archived, or moved to another
+        dealer (pass the old `dealer_id`).
+        '''
+        now = datetime.utcnow()
+        if opportunities:
+            self.tombstones.insert_many([{
+                'opportunity_id': opportunity['_id'],
+                'organization_id': opportunity.get('organization_id'),
+                'dealer_id': dealer_id if dealer_id is not None else opportunity.get('dealer_id'),
+                'reason': reason,
+                'deleted': now,
+            } for opportunity in opportunities], ordered=False)
+
+    def sync_start_position(self):
+        '''
+        Position for a client about to load its full list; syncing from it
+        returns everything that changes after the load started.
+        '''
+        return SyncPosition(datetime.utcnow() - timedelta(seconds=self.SYNC_SETTLE_SECONDS))
+
+    def get_opportunity_changes(self, organization_id, dealer_ids, position, limit=500):
+        """
+        Opportunities created or updated, and the ids of those deleted,
+        archived or moved to a dealer outside `dealer_ids`, after `position`,
+        in `updated` order.
+        :return: dict with `changed`, `deleted`, the new `position` and
+            `has_more` if the client should sync again right away
+        """
+        now = datetime.utcnow()
+        if position.updated < now - timedelta(seconds=self.TOMBSTONE_RETENTION_SECONDS):
+            raise InvalidSyncToken()
+        upper = now - timedelta(seconds=self.SYNC_SETTLE_SECONDS)
+
+        scope = {'organization_id': organization_id, 'dealer_id': {'$in': dealer_ids}}
+        query = dict(scope)
+        if position.last_id:
+            query['$or'] = [{'updated': {'$gt': position.updated, '$lte': upper}},
+                            {'updated': position.updated, '_id': {'$gt': position.last_id}}]
+        else:
+            query['updated'] = {'$gt': position.updated, '$lte': upper}
+
+        # Read from the primary: a lagging secondary could skip changes for good
+        changed = list(self.opportunities.find(query)
+                                         .sort([('updated', 1), ('_id', 1)])
+                                         .limit(limit + 1))
+        has_more = len(changed) > limit
+        changed = [OpportunityModel(opportunity) for opportunity in changed[:limit]]
+
+        deleted_query = dict(scope, deleted={'$gt': position.deleted, '$lte': upper})
+        deleted = [tombstone['opportunity_id'] for tombstone
+                   in self.tombstones.find(deleted_query, {'opportunity_id': 1})]
+
+        if has_more:
+            new_position = SyncPosition(changed[-1]['updated'], changed[-1]['_id'], upper)
+        else:
+            new_position = SyncPosition(max(upper, position.updated), None, upper)
+
+        return {
+            'changed': changed,
+            'deleted': deleted,
+            'position': new_position,
+            'has_more': has_more,
+        }
+
     def drop_opportunity_collection(self):
         self.opportunities.delete_many({})
+        self.list_rows.delete_many({})
 
     def update_opportunity_deal_data(self, id, data, field_name):
         if id and data and field_name in ['sales_deal', 'accounting_deal']:
-            opportunity = self.get_opportunity(id)
+            opportunity = self.get_opportunity(id, restore=True)
             updated_data = copy.deepcopy(opportunity.get(field_name, {}))
             data['_id'] = ObjectId(id)
 
@@ -416,23 +1435,29 @@ class MongoOpportunity(MongoDAO):
 
                 match_schema = OpportunitySchema(only=['_id'])
                 match = match_schema.load({'_id': id}).data
+                match.update(_shard_key_of(opportunity))
 
                 opportunity.update({field_name: updated_data})
+                opportunity['updated'] = datetime.utcnow()
                 res = self.opportunities.update(
                     match, {"$set": dict(opportunity)})
+                self._write_list_rows([opportunity])
 
-                signals.opportunity_updated.send(self,
-                                                 opportunity=opportunity,
-                                                 delta=delta)
+                self._send(signals.opportunity_updated,
+                           opportunity=opportunity,
+                           delta=delta)
 
             return opportunity
 
     def update_opportunity(self, id, status_date_change=None, **kwargs):
         if id and kwargs:
-            opportunity = self.get_opportunity(id)
+            opportunity = self.get_opportunity(id, restore=True)
             # Check if the status is changing and get the old_status_name.
             if kwargs.get('status') is not None and kwargs['status'] != opportunity.get('status'):
                 old_status_name = opportunity.status_name
+                old_status = opportunity.get('status')
+                old_status_entered = (opportunity.get('last_status_change') or {}).get(
+                    str(old_status))
                 if status_date_change is None:
                     status_date_change = datetime.utcnow()
 
@@ -442,18 +1467,8 @@ class MongoOpportunity(MongoDAO):
 
                 last_status_change = opportunity.setdefault(
                     'last_status_change', {})
-                last_status_change[str(kwargs.get('status'))
-                                   ] = status_date_change
-
-                # if settings the status to pending and there is no sent to fi date,
-                # we want to fill the sent to fi date with the pending date.
-                _is_pending = str(kwargs.get('status')) == str(
-                    OpportunityModel.STATUS.PENDING)
-                _has_fi_date = bool(last_status_change.get(
-                    str(OpportunityModel.STATUS.FI)))
-                if _is_pending and not _has_fi_date:
-                    last_status_change[str(
-                        OpportunityModel.STATUS.FI)] = status_date_change
+                _record_status_change(last_status_change, kwargs['status'],
+                                      status_date_change)
 
                 # Each time an opportunity's status is changed we update the reporting period
                 if kwargs.get('reporting_period') is None:
@@ -469,7 +1484,7 @@ class MongoOpportunity(MongoDAO):
             if assignee_keys and len(assignee_keys) == 1:
                 #if one of assignees has been added or removed, send notifications
                 field = { assignee_keys[0]: kwargs[assignee_keys[0]] }
-                signals.opportunity_assignment.send(self, opportunity=opportunity, field=field)
+                self._send(signals.opportunity_assignment, opportunity=opportunity, field=field)
                 
             # only allow changing dealer id if no dms deal number has been asigned
             if ('dealer_id' in kwargs and
@@ -492,32 +1507,191 @@ class MongoOpportunity(MongoDAO):
                 opportunity['reporting_period'] = reporting_period(
                     **kwargs['reporting_period'])
 
+            # The contact flags follow the customer
+            if ('customer_id' in kwargs and 'customer_has_phone' not in kwargs and
+                    kwargs['customer_id'] != opportunity.get('customer_id')):
+                kwargs.update(self.get_customer_contact_flags(kwargs['customer_id']))
+
             if not kwargs.get('updated'):
                 opportunity['updated'] = datetime.utcnow()
 
             old_sub_status = opportunity.get('sub_status', '')
             delta = dictdelta(opportunity, kwargs)
-            opportunity.update(kwargs)
-
+            # Matched on the stored shard key, before a dealer change applies
             match_schema = OpportunitySchema(only=['_id'])
             match = match_schema.load({'_id': id}).data
+            match.update(_shard_key_of(opportunity))
+
+            old_dealer_id = opportunity.get('dealer_id')
+            opportunity.update(kwargs)
             res = self.opportunities.update(match, {"$set": dict(opportunity)})
-            signals.opportunity_updated.send(self, opportunity=opportunity,
-                                             delta=delta)
+            self._write_list_rows([opportunity])
+            if opportunity.get('dealer_id') != old_dealer_id:
+                # Gone from the changes feed of the old dealer
+                self._write_tombstones([opportunity], 'moved', dealer_id=old_dealer_id)
+            if updated_status:
+                self.status_events.insert_one(_status_event(
+                    opportunity, old_status, old_status_entered,
+                    opportunity['status'], status_date_change))
+
+            self._send(signals.opportunity_updated, opportunity=opportunity,
+                       delta=delta)
 
             # Send the updated status with the old_status_name.
             if updated_status:
-                signals.opportunity_status_updated.send(self,
-                                                        opportunity=opportunity,
-                                                        old_opportunity_status_name=old_status_name)
+                self._send(signals.opportunity_status_updated,
+                           opportunity=opportunity,
+                           old_opportunity_status_name=old_status_name)
             # Send signal if sub_status has changed
             if old_sub_status != opportunity.get('sub_status', ''):
-                signals.opportunity_sub_status_updated.send(self, opportunity=opportunity)
+                self._send(signals.opportunity_sub_status_updated, opportunity=opportunity)
 
             return opportunity
         else:
             raise Exception('No data provided, or invalid arguments')
 
+    def _bulk_mutation(self, opportunity, operation, params, now):
+        '''
+        The fields `operation` changes on one opportunity, or an empty dict
+        if it doesn't apply to it.
+        '''
+        changes = {}
+
+        if operation == 'replace_assignee':
+            assignee_from = params['assignee_from']
+            assignee_to = params.get('assignee_to')
+            for role in opportunity.assignee_roles:
+                assignees = opportunity.get(role) or []
+                if assignee_from in assignees:
+                    replaced = []
+                    for username in assignees:
+                        username = assignee_to if username == assignee_from else username
+                        if username and username not in replaced:
+                            replaced.append(username)
+                    changes[role] = replaced
+
+        elif operation == 'set_status':
+            if params['status'] != opportunity.get('status'):
+                last_status_change = dict(opportunity.get('last_status_change') or {})
+                _record_status_change(last_status_change, params['status'], now)
+                changes['status'] = params['status']
+                changes['last_status_change'] = last_status_change
+                # Each time an opportunity's status is changed we update the reporting period
+                changes['reporting_period'] = reporting_period(year=now.year, month=now.month)
+
+        elif operation == 'set_reporting_period':
+            if params['reporting_period'] != opportunity.get('reporting_period'):
+                changes['reporting_period'] = params['reporting_period']
+
+        return changes
+
+    def bulk_mutate_opportunities(self, filters, operation, permission_check=None,
+                                  progress=None, chunk_size=None, **params):
+        '''
+        Apply one operation to every opportunity matching `filters` with
+        chunked bulk writes.
+        :param operation: one of BULK_OPERATIONS:
+            'replace_assignee' with `assignee_from` and `assignee_to` (None removes),
+            'set_status' with `status`,
+            'set_reporting_period' with `reporting_period` ({year, month})
+        :param permission_check: callable(opportunity) -> bool, opportunities
+            failing it are skipped
+        :param progress: callable(summary) called after each chunk
+        :return: summary of matched, modified and skipped opportunities
+        '''
+        if operation not in self.BULK_OPERATIONS:
+            raise ValueError("Unknown bulk operation: {}".format(operation))
+        if operation == 'replace_assignee' and not params.get('assignee_from'):
+            raise ValueError("replace_assignee requires assignee_from")
+        if operation == 'set_status' and params.get('status') is None:
+            raise ValueError("set_status requires status")
+        if operation == 'set_reporting_period':
+            if not params.get('reporting_period'):
+                raise ValueError("set_reporting_period requires reporting_period")
+            params['reporting_period'] = reporting_period(**params['reporting_period'])
+
+        query = self.make_query(filters)
+        if not query:
+            raise ValueError("Invalid query: {}".format(query))
+
+        chunk_size = chunk_size or self.BULK_CHUNK_SIZE
+        summary = {'matched': 0, 'modified': 0, 'skipped': 0, 'chunks': 0}
+
+        cursor = self.opportunities.find(query, batch_size=chunk_size)
+        chunk = []
+        # The writes move documents within indexes on `updated` and the
+        # mutated fields, so the cursor can return an opportunity again
+        seen = set()
+        for opportunity in cursor:
+            if opportunity['_id'] in seen:
+                continue
+            seen.add(opportunity['_id'])
+            chunk.append(OpportunityModel(opportunity))
+            if len(chunk) >= chunk_size:
+                self._bulk_mutate_chunk(chunk, operation, params, permission_check, summary)
+                chunk = []
+                if progress:
+                    progress(dict(summary))
+
+        if chunk:
+            self._bulk_mutate_chunk(chunk, operation, params, permission_check, summary)
+            if progress:
+                progress(dict(summary))
+
+        return summary
+
+    def _bulk_mutate_chunk(self, chunk, operation, params, permission_check, summary):
+        now = datetime.utcnow()
+        summary['matched'] += len(chunk)
+        summary['chunks'] += 1
+
+        requests = []
+        changed = []
+        for opportunity in chunk:
+            if permission_check and not permission_check(opportunity):
+                summary['skipped'] += 1
+                continue
+
+            changes = self._bulk_mutation(opportunity, operation, params, now)
+            if not changes:
+                continue
+
+            changes['updated'] = now
+            match = dict(_shard_key_of(opportunity), _id=opportunity['_id'])
+            requests.append(UpdateOne(match, {'$set': changes}))
+            changed.append((opportunity, changes))
+
+        if not requests:
+            return
+
+        result = self.opportunities.bulk_write(requests, ordered=False)
+        self._mirror_list_rows(requests)
+        summary['modified'] += result.modified_count
+
+        events = [
+            _status_event(opportunity, opportunity.get('status'),
+                          (opportunity.get('last_status_change') or {}).get(
+                              str(opportunity.get('status'))),
+                          changes['status'], now)
+            for opportunity, changes in changed if 'status' in changes]
+        if events:
+            self.status_events.insert_many(events, ordered=False)
+
+        # Signals go out once the whole chunk is written
+        for opportunity, changes in changed:
+            old_status_name = opportunity.status_name
+            delta = dictdelta(opportunity, changes)
+            for role in set(changes) & set(opportunity.assignee_roles):
+                self._send(signals.opportunity_assignment,
+                           opportunity=opportunity, field={role: changes[role]})
+
+            opportunity.update(changes)
+            self._send(signals.opportunity_updated, opportunity=opportunity, delta=delta)
+            if 'status' in changes:
+                self._send(signals.opportunity_status_updated,
+                           opportunity=opportunity,
+                           old_opportunity_status_name=old_status_name)
+
     def merge_customer_opportunities(self, merge_customer, source_customers):
         """
         Transfer all opportunities from the source customers to the merge customer.
@@ -526,8 +1700,25 @@ class MongoOpportunity(MongoDAO):
         """
         source_customer_ids = [c['_id'] for c in source_customers]
         query = {'customer_id': {'$in': source_customer_ids}}
-        update = {'$set': {'customer_id': merge_customer['_id']}}
-        self.opportunities.update(query, update, multi=True)
+        update = {'$set': dict(_customer_contact_flags(merge_customer),
+                               customer_id=merge_customer['_id'],
+                               updated=datetime.utcnow())}
+        if self.customer_propagation.is_async:
+            # Keyed like `update_customer_opportunities`, so the merge
+            # replaces a pending field update of a source customer
+            for customer_id in source_customer_ids:
+                source_query = {'customer_id': customer_id}
+                self.customer_propagation.enqueue(
+                    self.opportunities, UpdateMany(source_query, update), key=customer_id)
+                if self.LIST_ROWS_ENABLED:
+                    self.customer_propagation.enqueue(
+                        self.list_rows, UpdateMany(source_query, update),
+                        key=(LIST_ROW, customer_id))
+        else:
+            self.opportunities.update(query, update, multi=True)
+            self._mirror_list_rows([UpdateMany(query, update)])
+        self._update_archive(query, dict(_customer_contact_flags(merge_customer),
+                                         customer_id=merge_customer['_id']))
 
     def edit_deal_number(self, id, deal_number):
         """
@@ -538,10 +1729,13 @@ class MongoOpportunity(MongoDAO):
 
         :param id: string, Opportunity ID
         :param deal_number: string, deal number value
+        :raises JobFailed: if the opportunity is gone or the DMS pull failed
         :return: updated opportunity
         """
         # Try updating the dms_deal from CDK
         opportunity = self.get_opportunity(id)
+        if not opportunity:
+            raise JobFailed('Opportunity {} not found.'.format(id))
 
         from market_crm import dap
         deal_host_item_id = 'FI-WIP*{}'.format(deal_number)
@@ -549,19 +1743,12 @@ class MongoOpportunity(MongoDAO):
         try:
             dap.handle_vehicle_sale(
                 opportunity['dealer_id'], 'VehicleSales', deal_host_item_id)
+        except Exception as e:
+            raise JobFailed('Could not pull deal {} from the DMS: {}'.format(deal_number, e))
 
-            dms_deal = {'deal_number': deal_number}
-            opportunity['dms_deal'] = dms_deal
-            self.update_opportunity(id, dms_deal=dms_deal)
-
-            signals.opportunity_updated.send(
-                self, opportunity=opportunity, delta={'dms_deal': dms_deal})
-
-            opportunity = self.get_opportunity(id)
-        except:
-            return None
-
-        return opportunity
+        dms_deal = {'deal_number': deal_number}
+        self.update_opportunity(id, dms_deal=dms_deal)
+        return self.get_opportunity(id)
 
 
     def update_dms_deal(self, id, deal_data):
@@ -575,16 +1762,184 @@ class MongoOpportunity(MongoDAO):
         assert 'deal_number' not in deal_data
 
         dms_deal.update(deal_data)
-        stock_type = (dms_deal.get('deal_type') or '').lower()
-        if stock_type not in OpportunityStockTypeOptions.ALL:
-            stock_type = OpportunityStockTypeOptions.UNKNOWN
+        stock_type = _stock_type_for_deal(dms_deal)
 
+        # update_opportunity sends opportunity_updated
         self.update_opportunity(id, dms_deal=dms_deal, stock_type=stock_type)
-
-        signals.opportunity_updated.send(
-            self, opportunity=opportunity, delta={'dms_deal': deal_data})
+        self.mark_gross_profits_stale([(opportunity['dealer_id'], dms_deal['deal_number'])])
         return opportunity
 
+    def bulk_update_dms_deals(self, deals, chunk_size=None):
+        '''
+        Apply a batch of DMS deal records to their opportunities.
+
+        Each chunk of records is resolved to active opportunities with one
+        query over (dealer_id, dms_deal.deal_number) and written with one
+        bulk_write; a record updates every active opportunity of its deal.
+
+        :param deals: iterable of dicts with `dealer_id`, `deal_number` and
+            the deal data to merge into `dms_deal`
+        :return: summary with `received`, `matched`, `modified` counts and
+            the (dealer_id, deal_number) pairs that matched no opportunity
+        '''
+        chunk_size = chunk_size or self.BULK_CHUNK_SIZE
+        summary = {'received': 0, 'matched': 0, 'modified': 0, 'unmatched': []}
+
+        chunk = []
+        for deal in deals:
+            chunk.append(deal)
+            if len(chunk) >= chunk_size:
+                self._bulk_update_dms_chunk(chunk, summary)
+                chunk = []
+        if chunk:
+            self._bulk_update_dms_chunk(chunk, summary)
+
+        return summary
+
+    def _bulk_update_dms_chunk(self, chunk, summary):
+        now = datetime.utcnow()
+        summary['received'] += len(chunk)
+
+        # Later records of the same deal win
+        deal_data = OrderedDict()
+        for deal in chunk:
+            data = dict(deal)
+            key = (data.pop('dealer_id'), data.pop('deal_number'))
+            deal_data.setdefault(key, {}).update(data)
+
+        deal_numbers = OrderedDict()
+        for dealer_id, deal_number in deal_data:
+            deal_numbers.setdefault(dealer_id, []).append(deal_number)
+
+        query = {
+            '$or': [dict(_shard_key(self._dealer_organization(dealer_id), dealer_id),
+                         **{'dms_deal.deal_number': {'$in': numbers}})
+                    for dealer_id, numbers in deal_numbers.items()],
+            'status': {'$nin': [OpportunityModel.STATUS.LOST, OpportunityModel.STATUS.TUBED]},
+        }
+        requests = []
+        changed = []
+        found = set()
+        for opportunity in self.opportunities.find(query):
+            opportunity = OpportunityModel(opportunity)
+            key = (opportunity['dealer_id'], opportunity['dms_deal']['deal_number'])
+            found.add(key)
+
+            dms_deal = dict(opportunity['dms_deal'], **deal_data[key])
+            changes = {'dms_deal': dms_deal,
+                       'stock_type': _stock_type_for_deal(dms_deal),
+                       'updated': now}
+            match = dict(_shard_key_of(opportunity), _id=opportunity['_id'])
+            requests.append(UpdateOne(match, {'$set': changes}))
+            changed.append((opportunity, changes, deal_data[key]))
+
+        summary['unmatched'].extend(key for key in deal_data if key not in found)
+        if not requests:
+            return
+
+        result = self.opportunities.bulk_write(requests, ordered=False)
+        summary['matched'] += result.matched_count
+        summary['modified'] += result.modified_count
+        self.mark_gross_profits_stale(found)
+
+        for opportunity, changes, data in changed:
+            opportunity.update(changes)
+        self._write_list_rows([opportunity for opportunity, changes, data in changed])
+
+        # Signals go out once the whole chunk is written
+        for opportunity, changes, data in changed:
+            self._send(signals.opportunity_updated, opportunity=opportunity,
+                       delta={'dms_deal': data})
+
+    def create_job(self, name, params, organization_id=None):
+        now = datetime.utcnow()
+        job = {
+            '_id': ObjectId(),
+            'name': name,
+            'params': params,
+            'status': 'queued',
+            'organization_id': organization_id,
+            'created': now,
+            'heartbeat': now,
+        }
+        self.jobs.insert_one(job)
+        return job
+
+    def get_job(self, id):
+        return self.jobs.find_one({'_id': id})
+
+    def start_job(self, id):
+        """
+        Mark a queued job as running.
+        :return: the job, or None if it isn't queued anymore
+        """
+        now = datetime.utcnow()
+        return self.jobs.find_one_and_update(
+            {'_id': id, 'status': 'queued'},
+            {'$set': {'status': 'running', 'started': now, 'heartbeat': now}},
+            return_document=ReturnDocument.AFTER)
+
+    def save_job_progress(self, id, progress):
+        self.jobs.update_one({'_id': id, 'status': 'running'},
+                             {'$set': {'progress': progress, 'heartbeat': datetime.utcnow()}})
+
+    def recover_jobs(self):
+        """
+        Deal with jobs whose process died: fail the running ones not heard
+        from in JOB_STALE_SECONDS, since they may have partly run, and
+        return the ids of the queued ones waiting that long to queue again.
+        """
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.JOB_STALE_SECONDS)
+        self.jobs.update_many(
+            {'status': 'running', 'heartbeat': {'$lt': cutoff}},
+            {'$set': {'status': 'failed',
+                      'error': 'The job was interrupted. Please submit it again.',
+                      'finished': now}})
+        queued = self.jobs.find({'status': 'queued', 'heartbeat': {'$lt': cutoff}}, {'_id': 1})
+        return [job['_id'] for job in queued]
+
+    def finish_job(self, id, result=None, error=None):
+        return self.jobs.find_one_and_update(
+            {'_id': id},
+            {'$set': {'status': 'failed' if error else 'succeeded',
+                      'result': result,
+                      'error': error,
+                      'finished': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER)
+
+    def get_gross_profit(self, dealer_id, deal_number):
+        return self.gross_profits.find_one(
+            {'dealer_id': dealer_id, 'deal_number': deal_number})
+
+    def save_gross_profit(self, dealer_id, deal_number, etag, gross_profit):
+        """
+        Store the gross profit converted from the deal XML with the given ETag.
+        `updated` is when it was last validated against that ETag.
+        """
+        self.gross_profits.update_one(
+            {'dealer_id': dealer_id, 'deal_number': deal_number},
+            {'$set': {'etag': etag,
+                      'gross_profit': gross_profit,
+                      'stale': False,
+                      'updated': datetime.utcnow()}},
+            upsert=True)
+
+    def mark_gross_profits_stale(self, deals):
+        """
+        Flag stored gross profits for re-validation against the deal XML's ETag.
+        :param deals: iterable of (dealer_id, deal_number)
+        """
+        deal_numbers = OrderedDict()
+        for dealer_id, deal_number in deals:
+            deal_numbers.setdefault(dealer_id, []).append(deal_number)
+        if not deal_numbers:
+            return
+
+        query = {'$or': [{'dealer_id': dealer_id, 'deal_number': {'$in': numbers}}
+                         for dealer_id, numbers in deal_numbers.items()]}
+        self.gross_profits.update_many(query, {'$set': {'stale': True}})
+
     def add_attachment(self, opportunity_id, attachment_type, key, **kwargs):
         """
         Add an Attachment to an opportunity
@@ -635,14 +1990,19 @@ class MongoOpportunity(MongoDAO):
         attachment_id = ObjectId(attachment_id)
 
         # Find the opportunity with matching attachment_id
-        opportunity = self.opportunities.find_one({
+        query = {
             '_id': opportunity_id,
             'attachments': {
                 '$elemMatch': {
                     '_id': attachment_id
                 }
             }
-        })
+        }
+        opportunity = self.opportunities.find_one(query)
+        if opportunity is None and self.ARCHIVE_ENABLED:
+            opportunity = self.archive.find_one(query)
+            if opportunity:
+                self._restore_opportunity(opportunity)
 
         if opportunity:
             for attachment in opportunity.get('attachments'):
@@ -704,59 +2064,106 @@ class MongoOpportunity(MongoDAO):
         '''
         :param customer: A customer document
         '''
-        customer_keyword_fields = [
-            'first_name',
-            'last_name',
-            'company_name',
-            'drivers_license',
-            'phone',
-            'work_phone',
-            'cell_phone',
-            'home_phone',
-        ]
-
         if delta is not None:
             # we can check the delta to see if this is necessary.
             # If the delta does not contain any of out keyword fields
             # we can exit early.
-            if not any(delta.get(f) for f in customer_keyword_fields):
+            # Membership, not truthiness: a cleared phone or email has to
+            # reset the contact flags
+            if not any(f in delta for f in CUSTOMER_KEYWORD_FIELDS + ['emails']):
                 return
 
         qry = {
             'customer_id': customer['_id']
         }
 
-        customer_name = u'{} {}'.format(customer.get('first_name', ''),
-                                        customer.get('last_name', ''))
-
-        keywords = [customer.get(f)
-                    for f in customer_keyword_fields] + [customer_name]
-        keywords = filter(bool, keywords)  # remove empty values
-        for email in customer.get('emails') or []:
-            keywords.append(email['email'])
-
-        update = {'$set': {
-            'customer_name': customer_name.strip(),
-            'customer_keywords': keywords
-        }}
-        self.opportunities.update(qry, update, multi=True)
+        update = {'$set': dict(_customer_fields(customer), denormalized=datetime.utcnow())}
+        organization_id = customer.get('organization_id')
+        if self.customer_propagation.is_async:
+            self.customer_propagation.enqueue(self.opportunities, UpdateMany(qry, update),
+                                              key=customer['_id'])
+            if self.LIST_ROWS_ENABLED:
+                self.customer_propagation.enqueue(self.list_rows, UpdateMany(qry, update),
+                                                  key=(LIST_ROW, customer['_id']))
+            # Queued last, so list ETags only change once the writes are applied
+            self.customer_propagation.enqueue(self.list_versions,
+                                              _list_version_bump(organization_id),
+                                              key=(LIST_VERSION, organization_id))
+        else:
+            self.opportunities.update(qry, update, multi=True)
+            self._mirror_list_rows([UpdateMany(qry, update)])
+            self.bump_list_version(organization_id)
+        self._update_archive(qry, _customer_fields(customer))
 
-    def update_opportunities_with_dealer_name(self, dealer_id):
+    def backfill_customer_contact_flags(self, batch_size=1000):
         '''
+        Set `customer_has_phone` and `customer_has_email` on every opportunity
+        from its customer document. Goes through the customers opportunities
+        point to, so opportunities of missing customers are set as well. The
+        employee report reads the flags once this has finished.
+        :return: number of customers processed
+        '''
+        collections = [self.opportunities]
+        if self.ARCHIVE_ENABLED:
+            collections.append(self.archive)
+
+        processed = 0
+        for collection in collections:
+            groups = collection.aggregate([{'$group': {'_id': '$customer_id'}}],
+                                          allowDiskUse=True, batchSize=batch_size)
+            customer_ids = []
+            for group in groups:
+                customer_ids.append(group['_id'])
+                if len(customer_ids) >= batch_size:
+                    processed += self._backfill_contact_flags(collection, customer_ids)
+                    customer_ids = []
+            if customer_ids:
+                processed += self._backfill_contact_flags(collection, customer_ids)
+
+        self.save_maintenance_progress(CONTACT_FLAGS_BACKFILL, 0, finished=datetime.utcnow())
+        self.bump_list_version()
+        return processed
+
+    def _backfill_contact_flags(self, collection, customer_ids):
+        # A null _id groups the opportunities without a customer_id
+        flags = self.get_customers_contact_flags(
+            [customer_id for customer_id in customer_ids if customer_id is not None])
+        collection.bulk_write(
+            [UpdateMany({'customer_id': customer_id},
+                        {'$set': flags.get(customer_id) or _customer_contact_flags({})})
+             for customer_id in customer_ids], ordered=False)
+        return len(customer_ids)
+
+    def contact_flags_backfilled(self):
+        if not getattr(self, '_contact_flags_backfilled', False):
+            self._contact_flags_backfilled = bool(self.maintenance_progress.find_one(
+                {'run': CONTACT_FLAGS_BACKFILL, 'finished': {'$exists': True}}))
+        return self._contact_flags_backfilled
+
+    def update_opportunities_with_dealer_name(self, dealer_id, organization_id=None):
+        '''
+        Called when a dealer is renamed.
         :param dealer_id: The dealership id
+        :param organization_id: the dealer's organization, looked up if not given
         '''
 
-        qry = {
-            'dealer_id': dealer_id
-        }
+        qry = _shard_key(organization_id or self._dealer_organization(dealer_id), dealer_id)
 
-        dealer = dealer_name(dealer_id)
+        # Other processes forget their cached name on their next sync
+        self.dealer_renames.update_one(
+            {'_id': dealer_id}, {'$set': {'renamed': datetime.utcnow()}}, upsert=True)
+        self.dealer_directory.invalidate(dealer_id)
+        dealer = self.dealer_directory.name(dealer_id)
 
         update = {'$set': {
-            'dealer_name': dealer
+            'dealer_name': dealer,
+            'denormalized': datetime.utcnow()
         }}
 
         self.opportunities.update(qry, update, multi=True)
+        self._mirror_list_rows([UpdateMany(qry, update)])
+        self._update_archive(qry, {'dealer_name': dealer})
+        self.bump_list_version(qry.get('organization_id'))
 
     def update_opportunity_with_dealer_name(self, opportunity):
         '''
@@ -768,13 +2175,108 @@ class MongoOpportunity(MongoDAO):
             'dealer_id': opportunity['dealer_id']
         }
 
-        dealer = dealer_name(opportunity['dealer_id'])
+        dealer = self._dealer_name(opportunity['dealer_id'])
 
         update = {'$set': {
-            'dealer_name': dealer
+            'dealer_name': dealer,
+            'denormalized': datetime.utcnow()
         }}
 
         self.opportunities.update(qry, update)
+        self._mirror_list_rows([UpdateOne(qry, update)])
+        self.bump_list_version(opportunity.get('organization_id'))
+
+    def update_opportunities_with_dealer_names(self, opportunities, batch_size=1000):
+        '''
+        Backfill `dealer_name` with one update per dealer instead of one per
+        opportunity.
+        :param opportunities: iterable of opportunities with `_id`, `dealer_id` and
+            `organization_id`
+        :return: number of opportunities updated
+        '''
+        ids_by_dealer = OrderedDict()
+        for opportunity in opportunities:
+            key = (opportunity.get('organization_id'), opportunity['dealer_id'])
+            ids_by_dealer.setdefault(key, []).append(opportunity['_id'])
+
+        requests = []
+        modified = 0
+        now = datetime.utcnow()
+        for (organization_id, dealer_id), ids in ids_by_dealer.items():
+            dealer = self._dealer_name(dealer_id)
+            match = _shard_key(organization_id or self._dealer_organization(dealer_id), dealer_id)
+            for start in range(0, len(ids), batch_size):
+                requests.append(UpdateMany(
+                    dict(match, _id={'$in': ids[start:start + batch_size]}),
+                    {'$set': {'dealer_name': dealer, 'denormalized': now}}))
+
+        for start in range(0, len(requests), batch_size):
+            result = self.opportunities.bulk_write(requests[start:start + batch_size],
+                                                   ordered=False)
+            self._mirror_list_rows(requests[start:start + batch_size])
+            modified += result.modified_count
+        for organization_id in set(key[0] for key in ids_by_dealer):
+            self.bump_list_version(organization_id)
+        return modified
+
+    def backfill_dealer_names(self, organization_id):
+        '''
+        Set `dealer_name` on all opportunities of an organization, resolving
+        each of its dealers once.
+        '''
+        dealer_ids = self.opportunities_secondary.distinct(
+            'dealer_id', {'organization_id': organization_id})
+        self._sync_dealer_directory()
+        names = self.dealer_directory.preload(dealer_ids)
+
+        now = datetime.utcnow()
+        requests = [UpdateMany({'organization_id': organization_id, 'dealer_id': dealer_id},
+                               {'$set': {'dealer_name': name, 'denormalized': now}})
+                    for dealer_id, name in names.items()]
+        if not requests:
+            return 0
+        result = self.opportunities.bulk_write(requests, ordered=False)
+        self._mirror_list_rows(requests)
+        for dealer_id, name in names.items():
+            self._update_archive({'organization_id': organization_id, 'dealer_id': dealer_id},
+                                 {'dealer_name': name})
+        self.bump_list_version(organization_id)
+        return result.modified_count
+
+    def _dealer_organization(self, dealer_id):
+        '''
+        The organization of a dealer, read from one of its opportunities the
+        first time, or None if it has none.
+        '''
+        organization_id = self.dealer_organizations.get(dealer_id)
+        if organization_id is None:
+            opportunity = self.opportunities_secondary.find_one(
+                {'dealer_id': dealer_id}, {'organization_id': 1})
+            if opportunity and opportunity.get('organization_id'):
+                organization_id = opportunity['organization_id']
+                self.dealer_organizations.set(dealer_id, organization_id)
+        return organization_id
+
+    def _shard_key_for_id(self, id, organization_id=None, dealer_id=None):
+        '''
+        The shard key to read opportunity `id` with. Views only know the
+        organization; its list row, read from the unsharded list row
+        collection, has the dealer too.
+        '''
+        if organization_id is not None and dealer_id is None and self.LIST_ROWS_ENABLED:
+            row = self.list_rows.find_one({'_id': id}, {'organization_id': 1, 'dealer_id': 1})
+            if row and row.get('organization_id') == organization_id:
+                dealer_id = row.get('dealer_id')
+        return _shard_key(organization_id, dealer_id)
+
+    def _sync_dealer_directory(self):
+        self.dealer_directory.sync(lambda since: [
+            rename['_id'] for rename in self.dealer_renames.find(
+                {'renamed': {'$gt': since}}, {'_id': 1})])
+
+    def _dealer_name(self, dealer_id):
+        self._sync_dealer_directory()
+        return self.dealer_directory.name(dealer_id)
 
     def set_reporting_period(self, opportunity_id, year, month):
         '''
@@ -785,7 +2287,327 @@ class MongoOpportunity(MongoDAO):
             reporting_period=reporting_period(year=year, month=month))
         return opportunity
 
+    def _get_report_pool(self):
+        cls = type(self)
+        if cls._report_pool is None:
+            with cls._report_pool_lock:
+                if cls._report_pool is None:
+                    cls._report_pool = ThreadPool(self.REPORT_PARALLELISM)
+        return cls._report_pool
+
+    def _budget(self, name):
+        budget = dict(self.QUERY_BUDGETS['default'], **self.QUERY_BUDGETS.get(name, {}))
+        budget['comment'] = budgets.use_operation_tag()
+        return budget
+
+    def _aggregate_options(self, name):
+        budget = self._budget(name)
+        options = {
+            'maxTimeMS': budget['max_time_ms'],
+            'allowDiskUse': budget['allow_disk_use'],
+        }
+        if budget['comment']:
+            options['comment'] = budget['comment']
+        return options
+
+    def kill_operations(self, tag):
+        '''
+        Best effort kill of the server side operations tagged with `tag`, e.g.
+        the queries of an aborted request.
+        :return: number of operations killed
+        '''
+        killed = 0
+        for database in (self.db, self.db_secondary):
+            admin = database.client.admin
+            try:
+                # getMore operations carry the tag on their originating command
+                current = admin.command(
+                    SON([('currentOp', 1), ('$or', [
+                        {'command.comment': tag},
+                        {'originatingCommand.comment': tag},
+                    ])]),
+                    read_preference=database.read_preference)
+                for operation in current.get('inprog', []):
+                    admin.command('killOp', op=operation['opid'],
+                                  read_preference=database.read_preference)
+                    killed += 1
+            except PyMongoError:
+                pass
+        return killed
+
+    @contextmanager
+    def _budget_errors(self, name, *fingerprint_args):
+        '''
+        Turn server side budget errors raised inside the block into
+        ReportTooLargeError, logging the filter fingerprint.
+        '''
+        try:
+            yield
+        except PyMongoError as e:
+            if not budgets.is_budget_error(e):
+                raise
+            budgets.log_budget_hit(name, fingerprint(name, *fingerprint_args), e)
+            raise ReportTooLargeError()
+
+    def _partitioned(self, name, fingerprint_args, dealer_ids, run):
+        '''
+        Call `run(dealer_ids)` once, or once per partition of dealer_ids on the
+        report pool when there are more than REPORT_PARTITION_SIZE of them.
+        :return: list of $group results, merged across partitions
+        '''
+        with self._budget_errors(name, *fingerprint_args):
+            size = self.REPORT_PARTITION_SIZE
+            if not size or not dealer_ids or len(dealer_ids) <= size:
+                return list(run(dealer_ids))
+
+            partitions = [dealer_ids[i:i + size]
+                          for i in range(0, len(dealer_ids), size)]
+            results = self._get_report_pool().map(
+                lambda partition: list(run(partition)), partitions)
+            return _merge_group_results(chain.from_iterable(results))
+
+    def _aggregate_report(self, name, filters, stages):
+        '''
+        Run a report pipeline made of the $match for `filters` followed by
+        `stages` on the secondary, within the report's budget.
+        '''
+        options = self._aggregate_options(name)
+
+        def run(dealer_ids):
+            partition_filters = filters
+            if dealer_ids is not None:
+                partition_filters = dict(filters, dealer_ids=dealer_ids)
+            match = {'$match': self.make_query(partition_filters)}
+            self.shard_routing.note(name, match['$match'])
+            return self._opportunity_source(filters).aggregate([match] + stages, **options)
+
+        return self._partitioned(name, [filters], filters.get('dealer_ids'), run)
+
+    def get_status_velocity_report(self, organization_id, dealer_ids, changed=None):
+        '''
+        Time spent in each status and status-to-status conversion rates, from
+        the status transitions recorded in the given period.
+        :param changed: optional date filter on when the transitions happened
+        '''
+        match = {'$match': {
+            'organization_id': organization_id,
+            'dealer_id': {'$in': dealer_ids},
+        }}
+        if changed:
+            match['$match']['changed_at'] = get_date_filter(
+                changed.get('date_from'), changed.get('date_to'))
+
+        # Events recorded before negative durations were dropped on write
+        # may still carry one; they count as untimed. null and missing sort
+        # below numbers, so $gte 0 also leaves those out.
+        timed = {'$gte': ['$duration_seconds', 0]}
+        group = {
+            '$group': {
+                '_id': {'from_status': '$from_status', 'to_status': '$to_status'},
+                'transitions': {'$sum': 1},
+                'total_seconds': {'$sum': {'$cond': [timed, '$duration_seconds', 0]}},
+                'timed_transitions': {'$sum': {'$cond': [timed, 1, 0]}},
+                'max_seconds': {'$max': {'$cond': [timed, '$duration_seconds', None]}},
+            }
+        }
+
+        options = self._aggregate_options('get_status_velocity_report')
+        with self._budget_errors('get_status_velocity_report', organization_id,
+                                 dealer_ids, changed):
+            groups = list(self.status_events.aggregate([match, group], **options))
+
+        stages = {}
+        for g in groups:
+            from_status = g['_id'].get('from_status')
+            if from_status is None:
+                # Opportunity creation, not a move out of a status
+                continue
+            stage = stages.setdefault(from_status, {
+                'status': from_status,
+                'transitions': 0,
+                'timed_transitions': 0,
+                'total_seconds': 0,
+                'max_seconds': None,
+            })
+            stage['transitions'] += g['transitions']
+            stage['timed_transitions'] += g['timed_transitions']
+            stage['total_seconds'] += g['total_seconds']
+            if g['max_seconds'] is not None and (
+                    stage['max_seconds'] is None or g['max_seconds'] > stage['max_seconds']):
+                stage['max_seconds'] = g['max_seconds']
+
+        conversions = []
+        for g in groups:
+            from_status = g['_id'].get('from_status')
+            if from_status is None:
+                continue
+            conversions.append({
+                'from_status': from_status,
+                'to_status': g['_id'].get('to_status'),
+                'transitions': g['transitions'],
+                'rate': float(g['transitions']) / stages[from_status]['transitions'],
+            })
+
+        for stage in stages.values():
+            timed = stage.pop('timed_transitions')
+            total = stage.pop('total_seconds')
+            stage['average_seconds'] = float(total) / timed if timed else None
+
+        return {'stages': list(stages.values()), 'conversions': conversions}
+
+    def close_reporting_period(self, organization_id, year, month):
+        '''
+        Freeze the per-dealer report of a closed reporting period. Frozen
+        periods are served from the snapshot until they are re-opened.
+        :return: False if the period was already closed
+        '''
+        period = {'organization_id': organization_id, 'year': year, 'month': month}
+        if self.closed_periods.find_one(period, {'_id': 1}):
+            return False
+
+        now = datetime.utcnow()
+        if (year, month) >= (now.year, now.month):
+            raise ValueError(
+                "Reporting period {}-{} has not closed yet".format(year, month))
+
+        dealer_ids = self.opportunities_secondary.distinct(
+            'dealer_id', {'organization_id': organization_id})
+        created = _month_date_filter(year, month)
+        rows = self._aggregate_opportunity_data_by_dealer(
+            organization_id, dealer_ids, created)
+
+        # Upserts, so a concurrent close of the same period writes the same
+        # rows instead of failing on the unique index; then clear rows left
+        # by an interrupted close for dealers that have none now.
+        written = [row['_id']['dealer_id'] for row in rows]
+        if rows:
+            self.report_snapshots.bulk_write([
+                ReplaceOne(dict(period, dealer_id=row['_id']['dealer_id']),
+                           dict(period, dealer_id=row['_id']['dealer_id'], data=row),
+                           upsert=True)
+                for row in rows], ordered=False)
+        self.report_snapshots.delete_many(dict(period, dealer_id={'$nin': written}))
+
+        # The closed period document is written last and marks the snapshot
+        # as complete for these dealers.
+        try:
+            result = self.closed_periods.update_one(
+                period,
+                {'$setOnInsert': dict(period, dealer_ids=dealer_ids, closed=now)},
+                upsert=True)
+        except DuplicateKeyError:
+            # Lost the race to a concurrent close
+            return False
+        return result.upserted_id is not None
+
+    def close_previous_reporting_period(self):
+        '''
+        Month-close job: freeze last month's report for every organization
+        and bring the report snapshots up to date.
+        :return: list of organization ids that were closed
+        '''
+        now = datetime.utcnow()
+        year, month = (now.year, now.month - 1) if now.month > 1 else (now.year - 1, 12)
+        closed = [organization_id
+                  for organization_id in self.opportunities_secondary.distinct('organization_id')
+                  if organization_id and self.close_reporting_period(organization_id, year, month)]
+        self.refresh_snapshots()
+        return closed
+
+    def refresh_snapshots(self):
+        '''
+        Export the report snapshots of the last SNAPSHOT_MONTHS complete
+        months of every organization whose opportunities changed since.
+        :return: number of partitions exported
+        '''
+        if not self.SNAPSHOT_ROOT:
+            return 0
+
+        now = datetime.utcnow()
+        periods = []
+        for back in range(1, self.SNAPSHOT_MONTHS + 1):
+            start = snapshots.month_start(now.year, now.month - back)
+            periods.append((start.year, start.month))
+
+        exporter = snapshots.OpportunitySnapshotExporter(self, self.SNAPSHOT_ROOT)
+        exported = 0
+        for organization_id in self.opportunities_secondary.distinct('organization_id'):
+            if organization_id:
+                for year, month in periods:
+                    exported += exporter.refresh_period(organization_id, year, month)
+        return exported
+
+    def _snapshot_engine(self, filters):
+        '''
+        A report engine over the snapshots covering `filters`, or None if the
+        report has to run on the database.
+        '''
+        if not self.SNAPSHOT_ROOT or set(filters) - set(snapshots.SUPPORTED_FILTERS):
+            return None
+        organization_id = filters.get('organization_id')
+        periods = snapshots.created_months(filters.get('created'))
+        if not organization_id or not periods:
+            return None
+
+        now = datetime.utcnow()
+        for year, month in periods:
+            if (year, month) >= (now.year, now.month):
+                return None
+            age = snapshots.partition_age(self.SNAPSHOT_ROOT, organization_id, year, month)
+            if age is None or age > self.SNAPSHOT_MAX_AGE:
+                return None
+        try:
+            return snapshots.SnapshotReportEngine.from_snapshots(
+                self.SNAPSHOT_ROOT, organization_id, periods, OpportunityModel.STATUS)
+        except IOError:
+            # Removed since the check
+            return None
+
+    def reopen_reporting_period(self, organization_id, year, month):
+        '''
+        Drop the snapshot of a closed period so its reports are computed from
+        the live opportunities again, e.g. for late adjustments.
+        '''
+        period = {'organization_id': organization_id, 'year': year, 'month': month}
+        self.closed_periods.delete_one(period)
+        self.report_snapshots.delete_many(period)
+
+    def recompute_reporting_period(self, organization_id, year, month):
+        self.reopen_reporting_period(organization_id, year, month)
+        return self.close_reporting_period(organization_id, year, month)
+
+    @coalesced
     def aggregate_opportunity_data_by_dealer(self, organization_id, dealer_ids, created):
+        period = _closed_month(created)
+        closed = period and self.closed_periods.find_one(
+            {'organization_id': organization_id, 'year': period[0], 'month': period[1]})
+        if not closed:
+            return self._aggregate_opportunity_data_by_dealer(
+                organization_id, dealer_ids, created)
+
+        snapshots = self.report_snapshots.find({
+            'organization_id': organization_id,
+            'year': period[0],
+            'month': period[1],
+            'dealer_id': {'$in': dealer_ids},
+        })
+        rows = [snapshot['data'] for snapshot in snapshots]
+
+        # Dealers that didn't exist when the period was closed have no snapshot
+        frozen = set(closed['dealer_ids'])
+        missing = [dealer_id for dealer_id in dealer_ids if dealer_id not in frozen]
+        if missing:
+            rows += self._aggregate_opportunity_data_by_dealer(
+                organization_id, missing, created)
+        return rows
+
+    def _aggregate_opportunity_data_by_dealer(self, organization_id, dealer_ids, created):
+        # Past months carry nothing over, so their snapshots can answer
+        engine = self._snapshot_engine(
+            {'organization_id': organization_id, 'dealer_ids': dealer_ids, 'created': created})
+        if engine is not None:
+            return engine.opportunity_data_by_dealer(dealer_ids, created)
+
         carryover_value = 0
         open_status_filter = []
         start_date = created['date_from']
@@ -812,17 +2634,6 @@ class MongoOpportunity(MongoDAO):
             open_status_filter.append(
                 {'status': {'$in': OpportunityModel.STATUS.OPEN}})
 
-        # Select oppourtunity documents based off of dealer and status
-        match = {
-            '$match': {
-                '$and': [
-                    {'organization_id': organization_id},
-                    {'dealer_id': {'$in': dealer_ids}},
-                    {'$or': [closed_status_filter] + open_status_filter}
-                ]
-            }
-        }
-
         IS_OPEN = {'$setIsSubset': [['$status'], OpportunityModel.STATUS.OPEN]}
 
         # Unassigned Opportunities are of status OPEN with no
@@ -836,108 +2647,60 @@ class MongoOpportunity(MongoDAO):
             ]
         }
 
-        # Project new summable fields based off of conditionals
+        # Project the per-document flags once; the lead direction/channel breakdown
+        # is produced by grouping on those fields and pivoting in python, so new
+        # channels show up without adding another column here.
         project = {
             '$project': {
                 'dealer_id': 1,
+                'lead_direction': '$marketing.lead_direction',
+                'lead_channel': '$marketing.lead_channel',
                 'is_open': {'$cond': [IS_OPEN, 1, 0]},
                 'is_carryover': {'$cond': [{'$lt': ['$created', start_date]}, carryover_value, 0]},
                 'is_unassigned': {'$cond': [IS_UNASSIGNED, 1, 0]},
-                'is_this_period': {'$cond': [{'$and': created_date_filters}, 1, 0]},
-                'inbound_web': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "web"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_phone': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "phone"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_walk': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "walk"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_chat': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "chat"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_sms': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "sms"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_email': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "email"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_event': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "event"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_social': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "social"]}
-                    ] + created_date_filters}, 1, 0]},
-                'inbound_service': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "inbound"]},
-                        {'$eq': ['$marketing.lead_channel', "service"]}
-                    ] + created_date_filters}, 1, 0]},
-                'outbound_phone': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "outbound"]},
-                        {'$eq': ['$marketing.lead_channel', "phone"]}
-                    ] + created_date_filters}, 1, 0]},
-                'outbound_sms': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "outbound"]},
-                        {'$eq': ['$marketing.lead_channel', "sms"]}
-                    ] + created_date_filters}, 1, 0]},
-                'outbound_email': {'$cond': [
-                    {'$and': [
-                        {'$eq': ['$marketing.lead_direction', "outbound"]},
-                        {'$eq': ['$marketing.lead_channel', "email"]}
-                    ] + created_date_filters}, 1, 0]}
+                'in_period': {'$and': created_date_filters},
             }
         }
 
-        # Group all documents by dealer_id and sum the results
         group = {
             '$group': {
-                '_id': {'dealer_id': '$dealer_id'},
+                '_id': {
+                    'dealer_id': '$dealer_id',
+                    'lead_direction': '$lead_direction',
+                    'lead_channel': '$lead_channel',
+                    'in_period': '$in_period',
+                },
                 'opportunity_ids': {'$addToSet': '$_id'},
-                'total_opportunities': {'$sum': 1},
+                'count': {'$sum': 1},
                 'total_open': {'$sum': '$is_open'},
                 'total_carryover': {'$sum': '$is_carryover'},
-                'total_this_period': {'$sum': '$is_this_period'},
                 'total_unassigned': {'$sum': '$is_unassigned'},
-                'total_inbound_web': {'$sum': '$inbound_web'},
-                'total_inbound_phone': {'$sum': '$inbound_phone'},
-                'total_inbound_walk': {'$sum': '$inbound_walk'},
-                'total_inbound_chat': {'$sum': '$inbound_chat'},
-                'total_inbound_sms': {'$sum': '$inbound_sms'},
-                'total_inbound_email': {'$sum': '$inbound_email'},
-                'total_inbound_event': {'$sum': '$inbound_event'},
-                'total_inbound_social': {'$sum': '$inbound_social'},
-                'total_inbound_service': {'$sum': '$inbound_service'},
-                'total_outbound_phone': {'$sum': '$outbound_phone'},
-                'total_outbound_sms': {'$sum': '$outbound_sms'},
-                'total_outbound_email': {'$sum': '$outbound_email'},
             }
         }
 
-        data = self.opportunities_secondary.aggregate([match, project, group])
-        return list(data)
+        options = self._aggregate_options('aggregate_opportunity_data_by_dealer')
 
-    def aggregate_opportunity_assignees(self, filters):
-        match = {'$match': self.make_query(filters)}
+        # Select oppourtunity documents based off of dealer and status
+        def run(dealer_ids):
+            match = {
+                '$match': {
+                    '$and': [
+                        {'organization_id': organization_id},
+                        {'dealer_id': {'$in': dealer_ids}},
+                        {'$or': [closed_status_filter] + open_status_filter}
+                    ]
+                }
+            }
+            self.shard_routing.note('aggregate_opportunity_data_by_dealer', match['$match'])
+            source = self._opportunity_source({'created': created})
+            return source.aggregate([match, project, group], **options)
+
+        data = self._partitioned('aggregate_opportunity_data_by_dealer',
+                                 [organization_id, dealer_ids, created], dealer_ids, run)
+        return pivot_lead_channels(data)
 
+    @coalesced
+    def aggregate_opportunity_assignees(self, filters):
         project = {
             '$project': {
                 'assignees': {
@@ -952,12 +2715,14 @@ class MongoOpportunity(MongoDAO):
             '$group': {'_id': None, 'assignees': {'$addToSet': '$assignees'}}
         }
 
-        data = self.opportunities_secondary.aggregate(
-            [match, project, unwind, group])
-        return list(data)
+        return self._aggregate_report(
+            'aggregate_opportunity_assignees', filters, [project, unwind, group])
 
+    @coalesced
     def aggregate_opportunity_sales_funnel_reports(self, filters):
-        match = {'$match': self.make_query(filters)}
+        engine = self._snapshot_engine(filters)
+        if engine is not None:
+            return engine.sales_funnel(filters)
 
         # Project new summable fields based off of conditionals
         project = {
@@ -1020,11 +2785,14 @@ class MongoOpportunity(MongoDAO):
             }
         }
 
-        data = self.opportunities_secondary.aggregate([match, project, group])
-        return list(data)
+        return self._aggregate_report(
+            'aggregate_opportunity_sales_funnel_reports', filters, [project, group])
 
+    @coalesced
     def aggregate_deallog_recap_reports(self, filters):
-        match = {'$match': self.make_query(filters)}
+        engine = self._snapshot_engine(filters)
+        if engine is not None:
+            return engine.deallog_recap(filters)
 
         # Project new summable fields based off of conditionals
         project = {
@@ -1062,11 +2830,14 @@ class MongoOpportunity(MongoDAO):
             }
         }
 
-        data = self.opportunities_secondary.aggregate([match, project, group])
-        return list(data)
+        return self._aggregate_report(
+            'aggregate_deallog_recap_reports', filters, [project, group])
 
+    @coalesced
     def aggregate_daily_operations_reports(self, filters):
-        match = {'$match': self.make_query(filters)}
+        engine = self._snapshot_engine(filters)
+        if engine is not None:
+            return engine.daily_operations(filters)
 
         # Project new summable fields based off of conditionals
         project = {
@@ -1104,12 +2875,11 @@ class MongoOpportunity(MongoDAO):
             }
         }
 
-        data = self.opportunities_secondary.aggregate([match, project, group])
-        return list(data)
+        return self._aggregate_report(
+            'aggregate_daily_operations_reports', filters, [project, group])
 
+    @coalesced
     def aggregate_h2h_opportunity_leads_report_data(self, filters):
-        match = {'$match': self.make_query(filters)}
-
         project = {
             '$project': {
                 '_id': 1,
@@ -1132,13 +2902,11 @@ class MongoOpportunity(MongoDAO):
             }
         }
 
-        data = self.opportunities_secondary.aggregate(
-            [match, project, unwind, group])
-        return list(data)
+        return self._aggregate_report(
+            'aggregate_h2h_opportunity_leads_report_data', filters, [project, unwind, group])
 
+    @coalesced
     def aggregate_h2h_opportunity_delivered_report_data(self, filters):
-        match = {'$match': self.make_query(filters)}
-
         project = {
             '$project': {
                 '_id': 1,
@@ -1178,49 +2946,81 @@ class MongoOpportunity(MongoDAO):
             }
         }
 
-        data = self.opportunities_secondary.aggregate(
-            [match, project, unwind, group])
-        return list(data)
+        return self._aggregate_report(
+            'aggregate_h2h_opportunity_delivered_report_data', filters, [project, unwind, group])
 
+    @coalesced
     def aggregate_dealership_status_report(self, filters):
-        match = {'$match': self.make_query(filters)}
-
         project = {
             '$project': {
                 'dealer_id': 1,
                 'credit_applications': 1,
-                'chat': {'$cond': [
-                    {'$eq': ['$marketing.lead_channel', "chat"]}, 1, 0]},
-                'phone': {'$cond': [
-                    {'$eq': ['$marketing.lead_channel', "phone"]}, 1, 0]},
-                'email': {'$cond': [
-                    {'$eq': ['$marketing.lead_channel', "email"]}, 1, 0]},
-                'sms': {'$cond': [
-                    {'$eq': ['$marketing.lead_channel', "sms"]}, 1, 0]},
+                'lead_channel': '$marketing.lead_channel',
                 'completed': {'$cond': [
                     {'$setIsSubset': [['$status'], OpportunityModel.STATUS.COMPLETED]}, 1, 0]}
             }
         }
 
+        # Group per channel and pivot the channel totals into columns in python
         group = {
             '$group': {
-                '_id': {'dealer_id': '$dealer_id'},
+                '_id': {'dealer_id': '$dealer_id', 'lead_channel': '$lead_channel'},
                 'opportunity_ids': {'$addToSet': '$_id'},
                 'credit_applications': {'$addToSet': '$credit_applications'},
-                'total_chat': {'$sum': '$chat'},
-                'total_phone': {'$sum': '$phone'},
-                'total_email': {'$sum': '$email'},
-                'total_sms': {'$sum': '$sms'},
                 'total_completed': {'$sum': '$completed'},
-                'total_count': {'$sum': 1},
+                'count': {'$sum': 1},
             }
         }
 
-        data = self.opportunities_secondary.aggregate([match, project, group])
-        return list(data)
+        data = self._aggregate_report(
+            'aggregate_dealership_status_report', filters, [project, group])
+        return pivot_status_channels(data)
 
+    @coalesced
     def aggregate_employee_opportunity_report(self, filters):
-        match = {'$match': self.make_query(filters)}
+        if self.contact_flags_backfilled():
+            # Customer contactability is denormalized onto the opportunity by
+            # `update_opportunities_for_customer`, so no join with customer is
+            # needed
+            stages = [{
+                '$project': {
+                    'creator': 1,
+                    'customer_phones': {'$cond': ['$customer_has_phone', 1, 0]},
+                    'customer_emails': {'$cond': ['$customer_has_email', 1, 0]},
+                }
+            }]
+        else:
+            stages = self._customer_contact_lookup_stages()
+
+        # Group all customer values per staff member (creator)
+        group = {
+            '$group': {
+                '_id': {
+                    'creator': '$creator',
+                },
+                'customer_phones': {
+                    '$sum': '$customer_phones',
+                },
+                'customer_emails': {
+                    '$sum': '$customer_emails',
+                },
+                'customer_phones_and_emails': {
+                    '$sum': {
+                        '$min': ['$customer_phones', '$customer_emails']
+                    }
+                },
+                'opportunities': {'$sum': 1},
+            }
+        }
+
+        return self._aggregate_report(
+            'aggregate_employee_opportunity_report', filters, stages + [group])
+
+    def _customer_contact_lookup_stages(self):
+        '''
+        The employee report's customer contact columns from a join with the
+        customer, until the flags are backfilled.
+        '''
         # Join the customer information with the opportunity data
         lookup = {
             '$lookup': {
@@ -1284,28 +3084,4 @@ class MongoOpportunity(MongoDAO):
             }
         }
 
-        # Group all customer values per staff member (creator)
-        group = {
-            '$group': {
-                '_id': {
-                    'creator': '$creator',
-                },
-                'customer_phones': {
-                    '$sum': '$customer_phones',
-                },
-                'customer_emails': {
-                    '$sum': '$customer_emails',
-                },
-                'customer_phones_and_emails': {
-                    '$sum': {
-                        '$min': ['$customer_phones', '$customer_emails']
-                    }
-                },
-                'opportunities': {'$sum': 1},
-            }
-        }
-
-        data = self.opportunities_secondary.aggregate(
-            [match, lookup, project, project_reduce, group]
-        )
-        return list(data)
+        return [lookup, project, project_reduce]
@@ -0,0 +1,76 @@
+"""
+In-process directory of dealer names for denormalizing them onto
+opportunities without a lookup per opportunity.
+
+Every process has its own cache. Renames are recorded in the database and
+each process forgets the renamed dealers when it next syncs, at most every
+`sync_interval` seconds, so other processes see a new name within seconds
+instead of after `ttl`.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .cache import LRUCache
+
+_MISSING = object()
+
+
+class DealerDirectory(object):
+    """
+    Caches `resolve(dealer_id)` for at most `ttl` seconds and `maxsize`
+    dealers. Dealers without a name are cached too.
+    """
+
+    def __init__(self, resolve, maxsize=2048, ttl=600, sync_interval=10):
+        self.resolve = resolve
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._synced = datetime.utcnow()
+        self._next_sync = 0
+
+    def name(self, dealer_id):
+        name = self.cache.get(dealer_id, _MISSING)
+        if name is _MISSING:
+            name = self.resolve(dealer_id)
+            self.cache.set(dealer_id, name)
+        return name
+
+    def sync(self, renamed_since):
+        '''
+        Forget the dealers renamed by any process since the last sync. Only
+        queries once per `sync_interval`.
+        :param renamed_since: callable(datetime) returning the ids of the
+            dealers renamed after it
+        '''
+        with self._lock:
+            now = time.time()
+            if now < self._next_sync:
+                return
+            self._next_sync = now + self.sync_interval
+            # Overlap the previous sync to allow for clock skew between hosts
+            since = self._synced - timedelta(seconds=self.sync_interval)
+            self._synced = datetime.utcnow()
+
+        for dealer_id in renamed_since(since):
+            self.invalidate(dealer_id)
+
+    def preload(self, dealer_ids):
+        '''
+        Resolve every dealer not cached yet, e.g. all dealers of an
+        organization before a backfill.
+        '''
+        return dict((dealer_id, self.name(dealer_id)) for dealer_id in dealer_ids)
+
+    def invalidate(self, dealer_id=None):
+        '''
+        Forget one dealer, e.g. after it was renamed, or every dealer.
+        '''
+        if dealer_id is None:
+            self.cache.clear()
+        else:
+            self.cache.delete(dealer_id)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,222 @@
+"""
+Delivery of opportunity signals off the request path.
+
+In 'sync' mode signals are sent inline exactly like `signal.send`. In 'async'
+mode they are put on an in-process queue; `opportunity_updated` signals for
+the same opportunity arriving within `window` seconds are coalesced into one
+with the latest opportunity and the merged delta, and a pool of workers
+delivers them. Receivers registered with `connect_sync` are still called
+inline in both modes.
+
+Queued signals keep a shallow copy of their arguments, so senders must not
+change nested values of an opportunity after sending it. Deferred receivers
+run inside an app context of the configured `app`, but outside of any
+request.
+"""
+import atexit
+import copy
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+# Only these signals are coalesced; every other signal is delivered once per send
+COALESCED_SIGNALS = ('opportunity_updated',)
+
+
+class _Pending(object):
+    def __init__(self, signal, sender, kwargs, enqueued_at):
+        self.signal = signal
+        self.sender = sender
+        self.kwargs = kwargs
+        self.enqueued_at = enqueued_at
+
+
+class SignalDispatcher(object):
+    """
+    Sends signals inline or through the coalescing queue, depending on `mode`.
+    """
+
+    def __init__(self, mode='sync', window=0.25, workers=2):
+        self.mode = mode
+        self.window = window
+        self.workers = workers
+        self.app = None
+        self._sync_receivers = set()
+        self._pending = OrderedDict()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._flusher = None
+        self._pool = None
+        self._pool_size = None
+        # Serializes deliveries from the flusher and `flush`, and pool swaps
+        self._delivery_lock = threading.Lock()
+        self.counters = {
+            'enqueued': 0,
+            'coalesced': 0,
+            'delivered': 0,
+            'failed': 0,
+        }
+
+    def configure(self, mode=None, window=None, workers=None, app=None):
+        '''
+        :param workers: size of the delivery pool; a running pool is replaced
+            before the next batch
+        :param app: Flask app whose context deferred receivers run in
+        '''
+        if app is not None:
+            self.app = app
+        if mode is not None:
+            if mode not in ('sync', 'async'):
+                raise ValueError("Unknown signal dispatch mode: {}".format(mode))
+            if self.mode == 'async' and mode == 'sync':
+                self.flush()
+            self.mode = mode
+        if window is not None:
+            self.window = window
+        if workers is not None:
+            self.workers = workers
+
+    def connect_sync(self, signal, receiver, **kwargs):
+        '''
+        Connect a critical receiver that is always called inline, inside the
+        request that sent the signal.
+        '''
+        signal.connect(receiver, **kwargs)
+        self._sync_receivers.add((id(signal), id(receiver)))
+        return receiver
+
+    def _is_sync(self, signal, receiver):
+        return (id(signal), id(receiver)) in self._sync_receivers
+
+    def send(self, signal, sender, **kwargs):
+        if self.mode == 'sync':
+            signal.send(sender, **kwargs)
+            return
+
+        for receiver in signal.receivers_for(sender):
+            if self._is_sync(signal, receiver):
+                receiver(sender, **kwargs)
+
+        # Callers go on changing the opportunity after sending it; a shallow
+        # copy of each argument is enough to keep what was sent.
+        self._enqueue(signal, sender, dict(
+            (name, copy.copy(value)) for name, value in kwargs.items()))
+
+    def _key(self, signal, kwargs):
+        name = getattr(signal, 'name', None)
+        opportunity = kwargs.get('opportunity') or {}
+        if name in COALESCED_SIGNALS and opportunity.get('_id') is not None:
+            return (name, opportunity['_id'])
+        return (name, next(self._sequence))
+
+    def _enqueue(self, signal, sender, kwargs):
+        key = self._key(signal, kwargs)
+        with self._condition:
+            self.counters['enqueued'] += 1
+            pending = self._pending.pop(key, None)
+            if pending is not None:
+                # Keep the latest opportunity and merge the deltas. The merged
+                # signal moves behind everything sent since, so it is not
+                # delivered ahead of later signals of the same opportunity.
+                self.counters['coalesced'] += 1
+                delta = dict(pending.kwargs.get('delta') or {}, **(kwargs.get('delta') or {}))
+                pending.kwargs = dict(kwargs, delta=delta)
+                self._pending[key] = pending
+            else:
+                self._pending[key] = _Pending(signal, sender, kwargs, time.time())
+            self._ensure_flusher()
+            self._condition.notify()
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._run, name='opportunity-signal-dispatch')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                remaining = self._oldest() + self.window - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                batch = self._take()
+            self._deliver_batch(batch)
+
+    def _oldest(self):
+        return min(pending.enqueued_at for pending in self._pending.values())
+
+    def _take(self):
+        batch = list(self._pending.values())
+        self._pending = OrderedDict()
+        return batch
+
+    def _deliver_batch(self, batch):
+        # Signals of one opportunity are delivered in order by one worker;
+        # different opportunities are delivered concurrently.
+        per_opportunity = OrderedDict()
+        for pending in batch:
+            opportunity = pending.kwargs.get('opportunity') or {}
+            per_opportunity.setdefault(opportunity.get('_id'), []).append(pending)
+
+        with self._delivery_lock:
+            if self._pool is None or self._pool_size != self.workers:
+                if self._pool is not None:
+                    self._pool.close()
+                self._pool = ThreadPool(self.workers)
+                self._pool_size = self.workers
+            self._pool.map(self._deliver_in_context, per_opportunity.values())
+
+    def _deliver_in_context(self, pendings):
+        if self.app is None:
+            return self._deliver(pendings)
+        with self.app.app_context():
+            return self._deliver(pendings)
+
+    def _deliver(self, pendings):
+        for pending in pendings:
+            for receiver in pending.signal.receivers_for(pending.sender):
+                if self._is_sync(pending.signal, receiver):
+                    continue
+                try:
+                    receiver(pending.sender, **pending.kwargs)
+                    counter = 'delivered'
+                except Exception:
+                    counter = 'failed'
+                    logger.exception('Signal receiver %r failed for %s',
+                                     receiver, getattr(pending.signal, 'name', pending.signal))
+                with self._condition:
+                    self.counters[counter] += 1
+
+    def flush(self):
+        '''
+        Deliver everything pending now, in the calling thread.
+        '''
+        with self._condition:
+            batch = self._take()
+        if batch:
+            self._deliver_batch(batch)
+
+    def lag(self):
+        '''
+        Seconds the oldest undelivered signal has been waiting.
+        '''
+        with self._condition:
+            if not self._pending:
+                return 0.0
+            return time.time() - self._oldest()
+
+    def stats(self):
+        with self._condition:
+            return dict(self.counters, pending=len(self._pending), lag=self.lag())
+
+
+dispatcher = SignalDispatcher()
+atexit.register(dispatcher.flush)
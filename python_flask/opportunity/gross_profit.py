@@ -0,0 +1,105 @@
+"""
+Gross profit of DMS deals.
+
+The FI-WIP XML of a deal is converted once and stored with the ETag of the
+S3 object it came from; a deal without XML is stored as an empty result.
+DMS ingestion marks the stored copy stale, and a copy older than the DAO's
+GROSS_PROFIT_MAX_AGE counts as stale too; the next read then only downloads
+and converts the XML again if the ETag changed.
+
+boto connections are not thread safe, so each thread keeps its own S3
+connection (and the HTTP connections boto pools on it) across requests.
+Recent conversions are kept in an LRU cache keyed by (bucket, key, ETag).
+"""
+import threading
+from datetime import datetime, timedelta
+
+import boto
+
+from market_crm.config import DAP_EIP_S3_ARCHIVE_BUCKET
+
+from .cache import LRUCache
+from .deal_converter import DealConverter
+
+converted_deals = LRUCache(maxsize=256)
+
+_local = threading.local()
+
+
+def deal_key(dealer_id, deal_number):
+    return '/{0}/VehicleSales/FI-WIP*{1}'.format(dealer_id, deal_number)
+
+
+def get_bucket():
+    '''
+    The archive bucket on this thread's S3 connection, whose HTTP connections
+    boto keeps pooled between requests.
+    '''
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = _local.connection = boto.connect_s3()
+    return connection.get_bucket(DAP_EIP_S3_ARCHIVE_BUCKET, validate=False)
+
+
+def get_deal_item(dealer_id, deal_number):
+    '''
+    HEAD the deal XML.
+
+    :return: the S3 key, carrying the `etag`, or None if the deal has no XML
+    '''
+    return get_bucket().get_key(deal_key(dealer_id, deal_number))
+
+
+def convert_deal(s3_item, debug=False):
+    '''
+    Convert the deal XML, downloading it only if this ETag of the object
+    isn't in the cache yet.
+    '''
+    cache_key = (s3_item.bucket.name, s3_item.name, s3_item.etag, bool(debug))
+    representation = converted_deals.get(cache_key)
+    if representation is None:
+        deal = DealConverter(xml_string=s3_item.get_contents_as_string(), debug=debug)
+        representation = deal.to_representation()
+        converted_deals.set(cache_key, representation)
+    return representation
+
+
+def refresh_gross_profit(dao, dealer_id, deal_number, stored=None):
+    '''
+    Convert and store the gross profit of a deal unless the stored copy was
+    converted from the current XML. Call it when new deal XML lands.
+    '''
+    s3_item = get_deal_item(dealer_id, deal_number)
+    if s3_item is None:
+        # Store the miss, so views don't HEAD the XML again until DMS
+        # ingestion marks it stale or it ages out
+        dao.save_gross_profit(dealer_id, deal_number, None, {})
+        return {}
+
+    if stored and stored.get('etag') == s3_item.etag:
+        dao.save_gross_profit(dealer_id, deal_number, stored['etag'], stored['gross_profit'])
+        return stored['gross_profit']
+
+    gross_profit = convert_deal(s3_item)
+    dao.save_gross_profit(dealer_id, deal_number, s3_item.etag, gross_profit)
+    return gross_profit
+
+
+def is_current(stored, max_age):
+    '''
+    Whether a stored gross profit can be served without checking the ETag.
+    '''
+    if stored.get('stale') or not stored.get('updated'):
+        return False
+    return stored['updated'] >= datetime.utcnow() - timedelta(seconds=max_age)
+
+
+def deal_gross_profit(dao, dealer_id, deal_number):
+    '''
+    The stored gross profit of a deal, computed on first view and refreshed
+    once DMS ingestion marked it stale or it aged out.
+    '''
+    stored = dao.get_gross_profit(dealer_id, deal_number)
+    if stored and is_current(stored, dao.GROSS_PROFIT_MAX_AGE):
+        return stored['gross_profit']
+    return refresh_gross_profit(dao, dealer_id, deal_number, stored=stored)
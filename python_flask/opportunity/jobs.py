@@ -0,0 +1,161 @@
+"""
+Background jobs for slow opportunity operations.
+
+A job is recorded in the `opportunity_job` collection and its id is put on
+a queue; worker threads take ids off the queue and run the registered
+handler. The queue defaults to an in-process `Queue`, but anything with
+`put(item)` and `get()` (e.g. a broker client) can stand in for it.
+"""
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+
+class JobFailed(Exception):
+    """
+    Raised by a handler to fail its job with a message meant for the client.
+    """
+
+
+class JobRunner(object):
+    """
+    Runs registered job handlers on a pool of worker threads.
+    """
+
+    def __init__(self, dao_factory, workers=2, job_queue=None):
+        '''
+        :param dao_factory: callable returning the OpportunityDAO that job
+            state is kept in and that is passed to the handlers
+        '''
+        self.dao_factory = dao_factory
+        self.workers = workers
+        self.queue = job_queue or queue.Queue()
+        self.app = None
+        self.handlers = {}
+        self._progress_handlers = set()
+        self._contexts = {}
+        self._listeners = []
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def configure(self, workers=None, job_queue=None, app=None):
+        '''
+        :param app: Flask app whose context jobs run in
+        '''
+        if app is not None:
+            self.app = app
+        if workers is not None:
+            self.workers = workers
+        if job_queue is not None:
+            self.queue = job_queue
+
+    def register(self, name, handler, progress=False):
+        '''
+        :param handler: callable(dao, **params) returning the job result
+        :param progress: also pass the handler a `progress(value)` callable
+            that saves `value` on the job document
+        '''
+        self.handlers[name] = handler
+        if progress:
+            self._progress_handlers.add(name)
+        return handler
+
+    def subscribe(self, listener):
+        '''
+        Call listener(job) whenever a job finishes.
+        '''
+        self._listeners.append(listener)
+        return listener
+
+    def submit(self, name, organization_id=None, context=None, **params):
+        '''
+        :param context: dict of extra handler arguments that can't be stored
+            with the job, e.g. the submitting user. They only reach workers of
+            this process, so handlers must cope with them missing.
+        '''
+        if name not in self.handlers:
+            raise ValueError("Unknown job: {}".format(name))
+
+        job = self.dao_factory().create_job(name, params, organization_id=organization_id)
+        if context:
+            with self._lock:
+                self._contexts[job['_id']] = context
+        self._ensure_workers()
+        self.queue.put(job['_id'])
+        return job
+
+    def recover(self):
+        '''
+        Queue again the jobs left queued by a process that died, and fail
+        the ones it left running. Call it on startup.
+        :return: number of jobs queued again
+        '''
+        job_ids = self.dao_factory().recover_jobs()
+        for job_id in job_ids:
+            self.queue.put(job_id)
+        if job_ids:
+            self._ensure_workers()
+        return len(job_ids)
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='opportunity-job-worker')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                self.run(job_id)
+            except Exception:
+                logger.exception('Opportunity job %s could not be run', job_id)
+
+    def run(self, job_id):
+        '''
+        Run one queued job in the calling thread, inside an app context of
+        the configured `app`.
+        '''
+        if self.app is None:
+            return self._run(job_id)
+        with self.app.app_context():
+            return self._run(job_id)
+
+    def _run(self, job_id):
+        dao = self.dao_factory()
+        with self._lock:
+            context = self._contexts.pop(job_id, {})
+        job = dao.start_job(job_id)
+        if job is None:
+            # Already picked up by another worker
+            return
+
+        params = dict(job['params'], **context)
+        if job['name'] in self._progress_handlers:
+            params['progress'] = lambda value: dao.save_job_progress(job_id, value)
+
+        try:
+            result = self.handlers[job['name']](dao, **params)
+        except JobFailed as e:
+            job = dao.finish_job(job_id, error=str(e))
+        except Exception:
+            logger.exception('Opportunity job %s (%s) failed', job_id, job['name'])
+            job = dao.finish_job(job_id, error='Unexpected error')
+        else:
+            job = dao.finish_job(job_id, result=result)
+
+        for listener in self._listeners:
+            try:
+                listener(job)
+            except Exception:
+                logger.exception('Opportunity job listener %r failed', listener)
+        return job
@@ -0,0 +1,291 @@
+"""
+Live feed of opportunity changes for server-sent events.
+
+The feed turns each change into a compact change event, encoded once as an
+SSE frame and handed to every subscriber of the opportunity's
+(organization, dealer). Events carry no field values: clients apply status
+changes and deletions locally and fetch anything else through the regular,
+permission checked endpoints.
+
+Changes come either from the opportunity signals (`connect`), which only
+sees writes made by this process, or from MongoDB change streams on the
+opportunity and tombstone collections (`watch`), which sees the writes of
+every process and host and needs a replica set or sharded cluster. Use
+`watch` whenever the app runs more than one process.
+
+Each open stream holds its worker for as long as the client stays
+connected. On sync workers that is one worker per browser tab, so serve the
+live endpoint from gevent (or other async) workers, and size
+`max_subscribers` to what those workers can hold.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+RETRY_FRAME = 'retry: 5000\n\n'
+HEARTBEAT_FRAME = ': keepalive\n\n'
+# Sent when a subscriber fell too far behind and missed events
+RESET_FRAME = 'event: reset\ndata: {}\n\n'
+
+SIGNAL_EVENTS = (
+    ('opportunity_created', 'created'),
+    ('opportunity_updated', 'updated'),
+    ('opportunity_deleted', 'deleted'),
+    ('opportunity_status_updated', 'status_updated'),
+)
+
+# What the change streams need of an opportunity or tombstone change
+_EVENT_FIELDS = ('_id', 'opportunity_id', 'organization_id', 'dealer_id', 'status', 'updated')
+_OPPORTUNITY_STREAM = [
+    {'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}},
+    {'$project': dict([('operationType', 1), ('updateDescription.updatedFields', 1)] +
+                      [('fullDocument.' + field, 1) for field in _EVENT_FIELDS])},
+]
+_TOMBSTONE_STREAM = [
+    {'$match': {'operationType': 'insert'}},
+    {'$project': dict([('operationType', 1)] +
+                      [('fullDocument.' + field, 1) for field in _EVENT_FIELDS])},
+]
+
+
+class FeedFull(Exception):
+    pass
+
+
+def change_event(event_type, opportunity, delta=None):
+    event = {
+        'type': event_type,
+        'id': str(opportunity['_id']),
+        'dealer_id': opportunity.get('dealer_id'),
+        'status': opportunity.get('status'),
+        'updated': opportunity['updated'].isoformat() if opportunity.get('updated') else None,
+    }
+    if delta:
+        event['fields'] = sorted(delta)
+    return event
+
+
+def encode_frame(event):
+    return 'event: {}\ndata: {}\n\n'.format(event['type'], json.dumps(event, default=str))
+
+
+class Subscription(object):
+    """
+    Bounded buffer of frames for one client.
+    """
+
+    def __init__(self, organization_id, dealer_ids, maxsize):
+        self.organization_id = organization_id
+        self.dealer_ids = dealer_ids
+        self.maxsize = maxsize
+        self.overflowed = False
+        self._frames = deque()
+        self._condition = threading.Condition(threading.Lock())
+
+    def push(self, frame):
+        with self._condition:
+            if len(self._frames) >= self.maxsize:
+                # Drop the backlog; the client resyncs when it sees the reset
+                self._frames.clear()
+                self.overflowed = True
+            else:
+                self._frames.append(frame)
+            self._condition.notify()
+
+    def pull(self, timeout):
+        '''
+        Wait up to `timeout` seconds for frames.
+        :return: the pending frames, possibly none
+        '''
+        with self._condition:
+            if not self._frames and not self.overflowed:
+                self._condition.wait(timeout)
+            frames = list(self._frames)
+            self._frames.clear()
+            if self.overflowed:
+                self.overflowed = False
+                frames.insert(0, RESET_FRAME)
+        return frames
+
+    def reset(self):
+        '''
+        Tell the client it missed events, e.g. after the change stream broke.
+        '''
+        with self._condition:
+            self._frames.clear()
+            self.overflowed = True
+            self._condition.notify()
+
+
+class ChangeFeed(object):
+    """
+    Fans change events out to subscriptions indexed by (organization, dealer).
+    """
+
+    def __init__(self, queue_size=256, max_subscribers=5000, heartbeat=15):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._count = 0
+        self._receivers = []
+        self._dao_factory = None
+        self.app = None
+        self._watchers = {}
+        self.retry = 1.0
+        self.counters = {'published': 0, 'delivered': 0, 'stream_errors': 0}
+
+    def configure(self, queue_size=None, max_subscribers=None, heartbeat=None):
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if max_subscribers is not None:
+            self.max_subscribers = max_subscribers
+        if heartbeat is not None:
+            self.heartbeat = heartbeat
+
+    def connect(self, signals):
+        '''
+        Subscribe the feed to the opportunity signals of `signals`.
+        '''
+        for signal_name, event_type in SIGNAL_EVENTS:
+            receiver = self._receiver(event_type)
+            # Keep a reference, blinker only holds receivers weakly
+            self._receivers.append(receiver)
+            getattr(signals, signal_name).connect(receiver)
+
+    def _receiver(self, event_type):
+        def receive(sender, opportunity=None, delta=None, **kwargs):
+            if opportunity is not None:
+                self.publish(opportunity.get('organization_id'),
+                             change_event(event_type, opportunity, delta))
+        return receive
+
+    def watch(self, dao_factory, retry=1.0, app=None):
+        '''
+        Feed the events from change streams instead of signals. The streams
+        are opened with the first subscription.
+        :param dao_factory: callable returning the OpportunityDAO to watch
+        :param retry: seconds to wait before reopening a broken stream
+        :param app: Flask app whose context the watcher threads run in
+        '''
+        self._dao_factory = dao_factory
+        self.retry = retry
+        if app is not None:
+            self.app = app
+
+    def _ensure_watching(self):
+        if self._dao_factory is None:
+            return
+        with self._lock:
+            for name in ('opportunities', 'tombstones'):
+                watcher = self._watchers.get(name)
+                if watcher is None or not watcher.is_alive():
+                    watcher = threading.Thread(target=self._watch, args=(name,),
+                                               name='opportunity-live-{}'.format(name))
+                    watcher.daemon = True
+                    watcher.start()
+                    self._watchers[name] = watcher
+
+    def _watch(self, name):
+        if self.app is None:
+            return self._watch_stream(name)
+        with self.app.app_context():
+            return self._watch_stream(name)
+
+    def _watch_stream(self, name):
+        pipeline = _OPPORTUNITY_STREAM if name == 'opportunities' else _TOMBSTONE_STREAM
+        options = {'full_document': 'updateLookup'} if name == 'opportunities' else {}
+        resume_after = None
+        while True:
+            try:
+                collection = getattr(self._dao_factory(), name)
+                with collection.watch(pipeline, resume_after=resume_after, **options) as stream:
+                    for change in stream:
+                        resume_after = change['_id']
+                        self._publish_change(name, change)
+            except PyMongoError:
+                logger.exception('Live feed change stream on %s broke', name)
+                with self._lock:
+                    self.counters['stream_errors'] += 1
+                # The resume token may be gone from the oplog; start over and
+                # let every client catch up through the changes endpoint
+                resume_after = None
+                self.reset_all()
+                time.sleep(self.retry)
+
+    def _publish_change(self, name, change):
+        document = change.get('fullDocument')
+        if not document:
+            # Updated, then deleted before the lookup; the tombstone follows
+            return
+        if name == 'tombstones':
+            opportunity = dict(document, _id=document['opportunity_id'])
+            self.publish(document.get('organization_id'), change_event('deleted', opportunity))
+            return
+
+        if change['operationType'] == 'insert':
+            self.publish(document.get('organization_id'), change_event('created', document))
+            return
+        fields = (change.get('updateDescription') or {}).get('updatedFields') or {}
+        delta = set(field.split('.')[0] for field in fields)
+        self.publish(document.get('organization_id'), change_event('updated', document, delta))
+        if 'status' in delta:
+            self.publish(document.get('organization_id'),
+                         change_event('status_updated', document))
+
+    def reset_all(self):
+        with self._lock:
+            subscriptions = set()
+            for keyed in self._subscriptions.values():
+                subscriptions.update(keyed)
+        for subscription in subscriptions:
+            subscription.reset()
+
+    def subscribe(self, organization_id, dealer_ids):
+        self._ensure_watching()
+        subscription = Subscription(organization_id, list(dealer_ids), self.queue_size)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise FeedFull()
+            self._count += 1
+            for dealer_id in subscription.dealer_ids:
+                self._subscriptions.setdefault((organization_id, dealer_id), set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._count -= 1
+            for dealer_id in subscription.dealer_ids:
+                key = (subscription.organization_id, dealer_id)
+                subscriptions = self._subscriptions.get(key)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[key]
+
+    def publish(self, organization_id, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get((organization_id, event['dealer_id']), ()))
+        if not subscriptions:
+            return
+
+        frame = encode_frame(event)
+        for subscription in subscriptions:
+            subscription.push(frame)
+        with self._lock:
+            self.counters['published'] += 1
+            self.counters['delivered'] += len(subscriptions)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, subscribers=self._count)
+
+
+live_feed = ChangeFeed()
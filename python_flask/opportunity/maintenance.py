@@ -0,0 +1,150 @@
+"""
+Partitioned, resumable scans over all opportunities for maintenance jobs.
+
+The collection is split into `_id` ranges that are scanned on a process
+pool. Each partition checkpoints the last `_id` it finished in the
+`opportunity_maintenance_progress` collection, so a failed run picks up
+where it stopped instead of starting over.
+
+A worker holds a lease on its partition's progress document, renewed with
+every checkpoint, so two runs started at once never scan the same partition;
+the lease of a crashed worker expires after `lease` seconds. A new run
+reuses the previous run's split as long as its ranges are still balanced.
+"""
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+logger = logging.getLogger(__name__)
+
+
+def _scan_partition(args):
+    scan, partition = args
+    return scan.scan_partition(partition)
+
+
+class PartitionedScan(object):
+    """
+    :param name: name of the run; progress is kept per name
+    :param dao_factory: picklable callable returning an OpportunityDAO, called
+        in each worker process so every process has its own connection
+    :param process: picklable callable(dao, opportunities) run for each batch
+    :param projection: fields the scan reads, or None for whole documents
+    :param throttle: seconds each worker sleeps after a batch
+    :param lease: seconds a partition stays leased without a checkpoint;
+        must be well above the time one batch takes
+    :param max_skew: largest ratio of a range's size to the average range
+        size at which the previous split is reused
+    """
+
+    def __init__(self, name, dao_factory, process, partitions=8, processes=4,
+                 projection=None, batch_size=1000, throttle=0, lease=600, max_skew=2.0):
+        self.name = name
+        self.dao_factory = dao_factory
+        self.process = process
+        self.partitions = partitions
+        self.processes = processes
+        self.projection = projection
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.lease = lease
+        self.max_skew = max_skew
+
+    def plan(self, dao):
+        '''
+        The partitions of this run: the unfinished ones of an interrupted
+        run, or a fresh split of the collection.
+        '''
+        progress = dao.get_maintenance_progress(self.name)
+        if progress and not all(partition['done'] for partition in progress):
+            return [partition for partition in progress if not partition['done']]
+
+        ranges = self._previous_ranges(dao, progress)
+        if ranges is None:
+            ranges = dao.opportunity_id_ranges(self.partitions)
+        dao.reset_maintenance_progress(self.name)
+        return [dao.save_maintenance_progress(self.name, index, lower=lower, upper=upper,
+                                              last_id=None, processed=0, done=False)
+                for index, (lower, upper) in enumerate(ranges)]
+
+    def _previous_ranges(self, dao, progress):
+        '''
+        The ranges of the previous run if they still split the collection
+        evenly, which saves the $bucketAuto over every `_id`. New
+        opportunities all land in the last, open ended range.
+        '''
+        if len(progress) != self.partitions:
+            return None
+        ranges = [(partition['lower'], partition['upper']) for partition in progress]
+        counts = [dao.count_opportunity_range(lower, upper) for lower, upper in ranges]
+        average = float(sum(counts)) / len(counts)
+        if not average or max(counts) > self.max_skew * average:
+            return None
+        return ranges
+
+    def _owner(self):
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+    def _lease_expires(self):
+        return datetime.utcnow() + timedelta(seconds=self.lease)
+
+    def run(self):
+        '''
+        :return: number of opportunities processed by this run
+        '''
+        partitions = self.plan(self.dao_factory())
+        if not partitions:
+            return 0
+
+        pool = Pool(min(self.processes, len(partitions)))
+        try:
+            processed = pool.map(_scan_partition, [(self, partition) for partition in partitions])
+        finally:
+            pool.close()
+            pool.join()
+        return sum(processed)
+
+    def scan_partition(self, partition):
+        dao = self.dao_factory()
+        owner = self._owner()
+        index = partition['partition']
+        # Re-read under the lease: the planned copy may be behind
+        partition = dao.lease_maintenance_partition(self.name, index, owner, self.lease)
+        if partition is None:
+            logger.info('Maintenance %s: partition %s is leased or done, skipping',
+                        self.name, index)
+            return 0
+
+        processed = 0
+        last_id = partition.get('last_id')
+
+        while True:
+            batch = list(dao.iter_opportunity_range(
+                partition['lower'], partition['upper'], after=last_id,
+                projection=self.projection, limit=self.batch_size))
+            if not batch:
+                break
+
+            self.process(dao, batch)
+            last_id = batch[-1]['_id']
+            processed += len(batch)
+            saved = dao.save_maintenance_progress(self.name, index, owner=owner,
+                                                  last_id=last_id,
+                                                  processed=partition['processed'] + processed,
+                                                  lease_expires=self._lease_expires())
+            if saved is None:
+                logger.warning('Maintenance %s: lost the lease on partition %s, stopping',
+                               self.name, index)
+                return processed
+            if self.throttle:
+                time.sleep(self.throttle)
+
+        dao.save_maintenance_progress(self.name, index, owner=owner, done=True,
+                                      lease_expires=None)
+        logger.info('Maintenance %s: partition %s done, %s opportunities',
+                    self.name, partition['partition'], processed)
+        return processed
@@ -0,0 +1,129 @@
+"""
+Pivots of grouped report results into one row per dealer.
+
+Reports group by dealer and lead channel in the database and fold the groups
+into per-channel columns here. Channels with a fixed column keep it; any
+other channel is counted under `other_lead_channels`, so channel names can
+never collide with the row's own fields.
+"""
+
+# (lead_direction, lead_channel) pairs always present on the dealer report,
+# even when a dealer has no opportunities for them.
+LEAD_CHANNEL_COLUMNS = [
+    ('inbound', 'web'),
+    ('inbound', 'phone'),
+    ('inbound', 'walk'),
+    ('inbound', 'chat'),
+    ('inbound', 'sms'),
+    ('inbound', 'email'),
+    ('inbound', 'event'),
+    ('inbound', 'social'),
+    ('inbound', 'service'),
+    ('outbound', 'phone'),
+    ('outbound', 'sms'),
+    ('outbound', 'email'),
+]
+
+# Lead channels always present on the dealership status report.
+STATUS_REPORT_CHANNELS = ['chat', 'phone', 'email', 'sms']
+
+_LEAD_CHANNEL_COLUMNS = frozenset(LEAD_CHANNEL_COLUMNS)
+_STATUS_REPORT_CHANNELS = frozenset(STATUS_REPORT_CHANNELS)
+
+
+def lead_channel_columns():
+    '''
+    The lead channel fields of a new dealer report row, all zero.
+    '''
+    columns = dict(('total_{}_{}'.format(d, c), 0) for d, c in LEAD_CHANNEL_COLUMNS)
+    columns['other_lead_channels'] = {}
+    return columns
+
+
+def add_lead_channel(row, direction, channel, count):
+    if (direction, channel) in _LEAD_CHANNEL_COLUMNS:
+        row['total_{}_{}'.format(direction, channel)] += count
+    else:
+        channels = row['other_lead_channels'].setdefault(direction, {})
+        channels[channel] = channels.get(channel, 0) + count
+
+
+def pivot_lead_channels(groups):
+    '''
+    Fold (dealer_id, lead_direction, lead_channel, in_period) groups into one
+    row per dealer with a `total_<direction>_<channel>` column for each pair
+    created within the period.
+    '''
+    rows = {}
+    for group in groups:
+        key = group['_id']
+        dealer_id = key['dealer_id']
+        row = rows.get(dealer_id)
+        if row is None:
+            row = rows[dealer_id] = dict(
+                lead_channel_columns(),
+                _id={'dealer_id': dealer_id},
+                opportunity_ids=[],
+                total_opportunities=0,
+                total_open=0,
+                total_carryover=0,
+                total_this_period=0,
+                total_unassigned=0)
+
+        row['opportunity_ids'].extend(group['opportunity_ids'])
+        row['total_opportunities'] += group['count']
+        row['total_open'] += group['total_open']
+        row['total_carryover'] += group['total_carryover']
+        row['total_unassigned'] += group['total_unassigned']
+
+        if key.get('in_period'):
+            row['total_this_period'] += group['count']
+            direction = key.get('lead_direction')
+            channel = key.get('lead_channel')
+            if direction and channel:
+                add_lead_channel(row, direction, channel, group['count'])
+
+    return list(rows.values())
+
+
+def pivot_status_channels(groups):
+    '''
+    Fold (dealer_id, lead_channel) groups into one row per dealer with a
+    `total_<channel>` column for each lead channel.
+    '''
+    rows = {}
+    seen = {}
+    for group in groups:
+        key = group['_id']
+        dealer_id = key['dealer_id']
+        row = rows.get(dealer_id)
+        if row is None:
+            row = rows[dealer_id] = dict(
+                dict(('total_{}'.format(c), 0) for c in STATUS_REPORT_CHANNELS),
+                _id={'dealer_id': dealer_id},
+                opportunity_ids=[],
+                credit_applications=[],
+                other_lead_channels={},
+                total_completed=0,
+                total_count=0)
+            seen[dealer_id] = set()
+
+        row['opportunity_ids'].extend(group['opportunity_ids'])
+        # $addToSet of an array field: each item is the list of one opportunity
+        for credit_applications in group['credit_applications']:
+            item_key = tuple(credit_applications) if isinstance(
+                credit_applications, list) else credit_applications
+            if item_key not in seen[dealer_id]:
+                seen[dealer_id].add(item_key)
+                row['credit_applications'].append(credit_applications)
+        row['total_completed'] += group['total_completed']
+        row['total_count'] += group['count']
+
+        channel = key.get('lead_channel')
+        if channel in _STATUS_REPORT_CHANNELS:
+            row['total_{}'.format(channel)] += group['count']
+        elif channel:
+            other = row['other_lead_channels']
+            other[channel] = other.get(channel, 0) + group['count']
+
+    return list(rows.values())
@@ -0,0 +1,180 @@
+"""
+Batched propagation of customer changes onto their opportunities.
+
+In 'sync' mode the DAO writes every customer change right away. In 'async'
+mode the writes are queued: changes to the same customer within `window`
+seconds are debounced to the latest one, and the queue is applied as
+ordered `bulk_write` batches of at most `batch_size` operations.
+
+The queue lives in process memory. Writes still queued when a process
+crashes or is killed are lost, since the queue is only flushed by its
+flusher thread and at interpreter exit. Debouncing is per process: changes
+to one customer handled by different workers are applied separately. Use
+'async' only where a customer change that never reaches its opportunities
+is acceptable until the next change or a maintenance run rewrites it.
+"""
+import atexit
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending(object):
+    def __init__(self, collection, request, enqueued_at):
+        self.collection = collection
+        self.request = request
+        self.enqueued_at = enqueued_at
+
+
+class PropagationQueue(object):
+    """
+    Debounces write requests by key and applies them in order.
+    """
+
+    def __init__(self, mode='sync', window=1.0, batch_size=500):
+        self.mode = mode
+        self.window = window
+        self.batch_size = batch_size
+        self._pending = OrderedDict()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._flusher = None
+        self.counters = {
+            'enqueued': 0,
+            'debounced': 0,
+            'applied': 0,
+            'batches': 0,
+            'failed_batches': 0,
+            'apply_seconds_total': 0.0,
+        }
+
+    def configure(self, mode=None, window=None, batch_size=None):
+        if mode is not None:
+            if mode not in ('sync', 'async'):
+                raise ValueError("Unknown propagation mode: {}".format(mode))
+            if self.mode == 'async' and mode == 'sync':
+                self.flush()
+            self.mode = mode
+        if window is not None:
+            self.window = window
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+    @property
+    def is_async(self):
+        return self.mode == 'async'
+
+    def enqueue(self, collection, request, key=None):
+        '''
+        Queue a write request. A pending request with the same `key` is
+        replaced, and the new one moves behind everything queued so far.
+        '''
+        if key is None:
+            key = ('unkeyed', next(self._sequence))
+
+        with self._condition:
+            self.counters['enqueued'] += 1
+            pending = self._pending.pop(key, None)
+            if pending is not None:
+                self.counters['debounced'] += 1
+                enqueued_at = pending.enqueued_at
+            else:
+                enqueued_at = time.time()
+            self._pending[key] = _Pending(collection, request, enqueued_at)
+            self._ensure_flusher()
+            self._condition.notify()
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._run,
+                                             name='opportunity-customer-propagation')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _oldest(self):
+        return min(pending.enqueued_at for pending in self._pending.values())
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                remaining = self._oldest() + self.window - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                batch = self._take()
+            self._apply(batch)
+
+    def _take(self):
+        batch = list(self._pending.values())
+        self._pending = OrderedDict()
+        return batch
+
+    def _chunks(self, batch):
+        # Writes to the same collection, at most batch_size each. Writes are
+        # grouped by collection first: callers interleave opportunity and
+        # list row writes, which would otherwise make one chunk per write.
+        # Each collection's writes keep their order, and collections are
+        # written in the order they first appear in the batch.
+        groups = []
+        for pending in batch:
+            for collection, pendings in groups:
+                if collection == pending.collection:
+                    pendings.append(pending)
+                    break
+            else:
+                groups.append((pending.collection, [pending]))
+
+        for collection, pendings in groups:
+            for start in range(0, len(pendings), self.batch_size):
+                yield pendings[start:start + self.batch_size]
+
+    def _apply(self, batch):
+        for chunk in self._chunks(batch):
+            started = time.time()
+            try:
+                chunk[0].collection.bulk_write([pending.request for pending in chunk],
+                                               ordered=True)
+                counter = 'batches'
+            except Exception:
+                counter = 'failed_batches'
+                logger.exception('Customer propagation batch of %s writes failed', len(chunk))
+            with self._condition:
+                self.counters[counter] += 1
+                if counter == 'batches':
+                    self.counters['applied'] += len(chunk)
+                self.counters['apply_seconds_total'] += time.time() - started
+
+    def flush(self):
+        '''
+        Apply everything pending now, in the calling thread.
+        '''
+        with self._condition:
+            batch = self._take()
+        if batch:
+            self._apply(batch)
+
+    def lag(self):
+        '''
+        Seconds the oldest unapplied change has been waiting.
+        '''
+        with self._condition:
+            if not self._pending:
+                return 0.0
+            return time.time() - self._oldest()
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self.counters, pending=len(self._pending), lag=self.lag())
+        if stats['apply_seconds_total']:
+            stats['writes_per_second'] = stats['applied'] / stats['apply_seconds_total']
+        return stats
+
+
+customer_propagation = PropagationQueue()
+atexit.register(customer_propagation.flush)
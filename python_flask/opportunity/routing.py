@@ -0,0 +1,102 @@
+"""
+Shard key targeting of opportunity queries.
+
+The opportunity collections can be sharded on (organization_id, dealer_id).
+mongos sends a query only to the shards owning its chunks when the query
+pins the shard key prefix, and broadcasts it to every shard otherwise.
+`ShardRouting` classifies the queries the DAO runs, counts them per method
+and logs the broadcast ones.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SHARD_KEY = (('organization_id', 1), ('dealer_id', 1))
+
+# Both shard key fields pinned
+TARGETED = 'targeted'
+# Only organization_id pinned: still routed, to the shards of the organization
+ORGANIZATION = 'organization'
+# Broadcast to every shard
+SCATTER = 'scatter'
+
+
+class UntargetedQuery(Exception):
+    pass
+
+
+def _pinned(condition):
+    # Equality or $in, the conditions mongos can route on
+    if not isinstance(condition, dict):
+        return True
+    return bool(condition) and set(condition) <= set(('$eq', '$in'))
+
+
+def shard_key_conditions(query):
+    '''
+    The conditions of `query` on shard key fields, from its top level and
+    its top level $and.
+    '''
+    conditions = {}
+    for clause in [query] + list(query.get('$and', [])):
+        for field, _ in SHARD_KEY:
+            if field in clause:
+                conditions[field] = clause[field]
+    return conditions
+
+
+def targeting(query):
+    conditions = shard_key_conditions(query)
+    if 'organization_id' not in conditions or not _pinned(conditions['organization_id']):
+        return SCATTER
+    if 'dealer_id' in conditions and _pinned(conditions['dealer_id']):
+        return TARGETED
+    return ORGANIZATION
+
+
+class ShardRouting(object):
+    """
+    Counts queries by targeting and flags the scatter-gather ones.
+    """
+
+    def __init__(self, log_scatter=False, strict=False):
+        self.log_scatter = log_scatter
+        self.strict = strict
+        self._lock = threading.Lock()
+        self.counters = {}
+
+    def configure(self, log_scatter=None, strict=None):
+        '''
+        :param strict: raise UntargetedQuery instead of running scatter-gather
+            queries, e.g. against a test cluster
+        '''
+        if log_scatter is not None:
+            self.log_scatter = log_scatter
+        if strict is not None:
+            self.strict = strict
+
+    def note(self, name, query):
+        '''
+        Record a query the DAO method `name` is about to run.
+        :return: its targeting
+        '''
+        result = targeting(query)
+        with self._lock:
+            counters = self.counters.setdefault(name, {TARGETED: 0, ORGANIZATION: 0, SCATTER: 0})
+            counters[result] += 1
+
+        if result == SCATTER:
+            if self.strict:
+                raise UntargetedQuery('{} runs a query without the shard key: {}'.format(
+                    name, query))
+            if self.log_scatter:
+                logger.warning('Scatter-gather opportunity query in %s', name)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict((name, dict(counters)) for name, counters in self.counters.items())
+
+
+shard_routing = ShardRouting()
@@ -284,6 +284,60 @@ class OpportunitiesFilterSchema(StringifiedSchema):
     created_by = fields.List(fields.Str)
 
 
+class OpportunityBulkMutationSchema(Schema):
+    class Meta:
+        strict = True
+
+    filters = fields.Nested(OpportunitiesFilterSchema)
+    ids = fields.List(ObjectIdField)
+    operation = fields.Str(required=True, validate=validate.OneOf(
+        ['replace_assignee', 'set_status', 'set_reporting_period']))
+    assignee_from = fields.Str()
+    assignee_to = fields.Str(allow_none=True)
+    status = fields.Int()
+    reporting_period = fields.Nested(ReportingPeriodSchema)
+
+
+class StatusVelocityFilterSchema(StringifiedSchema):
+    class Meta:
+        strict = True
+
+    organization_id = fields.Str(required=True)
+    dealer_ids = fields.List(fields.Int, required=True)
+    changed = fields.Nested(DateFilterSchema)
+
+
+class OpportunitiesForLeadsSchema(Schema):
+    class Meta:
+        strict = True
+
+    lead_ids = fields.List(fields.Str(), required=True,
+                           validate=validate.Length(min=1, max=1000))
+    # Fields shared by all the new opportunities
+    opportunity = fields.Dict(missing=dict)
+
+
+class OpportunityChangesParamsSchema(StringifiedSchema):
+    class Meta:
+        strict = True
+
+    since = fields.Str()
+    dealer_ids = fields.List(fields.Int)
+    limit = fields.Int(missing=500, validate=validate.Range(min=1, max=1000))
+
+
+class OpportunityJobSchema(Schema):
+    _id = ObjectIdField(dump_only=True, simple=True)
+    name = fields.Str(dump_only=True)
+    status = fields.Str(dump_only=True)
+    progress = fields.Dict(dump_only=True)
+    result = fields.Dict(dump_only=True)
+    error = fields.Str(dump_only=True)
+    created = NaiveDateTime(dump_only=True)
+    started = NaiveDateTime(dump_only=True)
+    finished = NaiveDateTime(dump_only=True)
+
+
 class OpportunityCursorSchema(OpportunitySchema):
     customer_name = fields.Str(allow_none=True)
 
@@ -0,0 +1,212 @@
+"""
+Coalescing of identical concurrent queries.
+
+When several requests run the same report or list query at the same time,
+only the first one (the leader) executes it; the others wait for the leader
+and receive a copy of its result.
+"""
+import copy
+import fcntl
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from bson import json_util
+
+
+def fingerprint(name, *args, **kwargs):
+    '''
+    Canonical fingerprint of a query: equal for calls with equal arguments,
+    regardless of dict ordering.
+    '''
+    payload = json_util.dumps([name, args, kwargs], sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.payload = None
+        self.error = None
+
+
+def _share(result):
+    '''
+    Serialize a result once for all followers; unpickling is much cheaper
+    than a deep copy per follower.
+    '''
+    try:
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+class FileLockStore(object):
+    """
+    Coalesces identical queries across worker processes on one host.
+
+    The leader holds an exclusive file lock for the fingerprint while the query
+    runs. Workers register a marker file before they block on the lock; the
+    leader only writes its result next to the lock when it finds markers, and
+    whoever holds the lock last removes the result and the lock file, so the
+    directory only holds files for queries in flight. Markers left behind by
+    a crashed worker are ignored after `expire` seconds.
+    """
+
+    def __init__(self, directory, expire=3600):
+        self.directory = directory
+        self.expire = expire
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _waiting(self, key):
+        # Markers of the workers waiting for `key`, minus stale ones
+        prefix = key + '.wait.'
+        now = time.time()
+        waiting = 0
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix):
+                continue
+            marker = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(marker) > self.expire:
+                    os.remove(marker)
+                else:
+                    waiting += 1
+            except OSError:
+                pass
+        return waiting
+
+    def _acquire(self, lock_path):
+        # The lock file may be removed by its previous holder while we wait
+        # on it; only a lock on the file still at `lock_path` counts.
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    return lock_file
+            except OSError:
+                pass
+            lock_file.close()
+
+    def do(self, key, fn):
+        '''
+        :return: (result, shared) where shared is True if the result was
+            produced by another worker
+        '''
+        path = os.path.join(self.directory, key)
+        result_path = path + '.result'
+        marker = '{}.wait.{}-{}'.format(path, os.getpid(), threading.current_thread().ident)
+
+        waiting_since = time.time()
+        open(marker, 'w').close()
+        lock_file = self._acquire(path + '.lock')
+        try:
+            os.remove(marker)
+            # Only results finished while we were waiting count, so this
+            # coalesces in-flight queries without becoming a cache.
+            try:
+                if os.path.getmtime(result_path) >= waiting_since:
+                    with open(result_path, 'rb') as fp:
+                        return pickle.load(fp), True
+            except (OSError, IOError, EOFError, pickle.UnpicklingError):
+                pass
+
+            result = fn()
+
+            if self._waiting(key):
+                tmp = '{}.{}.tmp'.format(result_path, os.getpid())
+                with open(tmp, 'wb') as fp:
+                    pickle.dump(result, fp, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp, result_path)
+            return result, False
+        finally:
+            if not self._waiting(key):
+                for name in (result_path, path + '.lock'):
+                    try:
+                        os.remove(name)
+                    except OSError:
+                        pass
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+
+class SingleFlight(object):
+    """
+    Dedupes in-flight calls by key within the process, and optionally across
+    processes through a `FileLockStore`.
+    """
+
+    def __init__(self, lock_store=None):
+        self.lock_store = lock_store
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.counters = {
+            'executed': 0,
+            'coalesced': 0,
+            'coalesced_across_workers': 0,
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._calls))
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+                self.counters['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if call.payload is not None:
+                return pickle.loads(call.payload)
+            return copy.deepcopy(call.result)
+
+        shared = False
+        try:
+            if self.lock_store is not None:
+                call.result, shared = self.lock_store.do(key, fn)
+            else:
+                call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                # Remove the call before signalling so no new follower can
+                # attach to a finished call.
+                del self._calls[key]
+                followers = call.followers
+                if call.error is None:
+                    self.counters['coalesced_across_workers' if shared else 'executed'] += 1
+            if followers and call.error is None:
+                call.payload = _share(call.result)
+            call.done.set()
+
+        # Followers get their own copies, so the leader keeps the original
+        return call.result
+
+
+def coalesced(method):
+    '''
+    Decorator for DAO methods whose identical concurrent calls should share
+    one execution through the DAO's `single_flight`.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = fingerprint(method.__name__, *args, **kwargs)
+        return self.single_flight.do(key, lambda: method(self, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,498 @@
+"""
+Columnar snapshots of opportunities for historical reporting.
+
+Opportunities are exported per organization and month of `created`, the
+field the reports select periods by, into NumPy column files on local disk.
+`SnapshotReportEngine` reproduces the `aggregate_*` reports of
+`MongoOpportunity` over those columns so heavy historical queries don't
+touch the database. A snapshot holds the opportunities as they were when it
+was exported; `OpportunitySnapshotExporter.refresh_period` exports it again
+once any of them changed.
+"""
+import numbers
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from .pivots import add_lead_channel, lead_channel_columns
+
+# Versioned: partitions of an older layout are never read
+SNAPSHOT_FILENAME = 'opportunities-v2.npz'
+
+SNAPSHOT_PROJECTION = {
+    '_id': 1,
+    'organization_id': 1,
+    'dealer_id': 1,
+    'status': 1,
+    'created': 1,
+    'creator': 1,
+    'stock_type': 1,
+    'marketing.lead_direction': 1,
+    'marketing.lead_channel': 1,
+    'marketing.lead_source': 1,
+    'dms_deal.deal_type': 1,
+    'dms_deal.total_gross': 1,
+    'dms_deal.frontend_gross': 1,
+    'dms_deal.backend_gross': 1,
+    'sales_reps': 1,
+    'customer_reps': 1,
+    'sales_managers': 1,
+    'reporting_period': 1,
+}
+
+GROSS_COLUMNS = ('total_gross', 'frontend_gross', 'backend_gross')
+
+# Filters `SnapshotReportEngine.select` knows how to apply. Anything else
+# must go to the database, otherwise the report would silently ignore it.
+SUPPORTED_FILTERS = ('organization_id', 'dealer_ids', 'statuses', 'created',
+                     'lead_channel', 'lead_direction', 'lead_source',
+                     'stock_type', 'reporting_period')
+
+
+def _text(value):
+    return u'' if value is None else u'{}'.format(value)
+
+
+def _number(value):
+    return value if isinstance(value, (numbers.Integral, float)) else 0
+
+
+def _int(value):
+    return value if isinstance(value, numbers.Integral) else 0
+
+
+def month_start(year, month):
+    return datetime(year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+
+
+def created_months(created):
+    '''
+    The (year, month) partitions a bounded `created` filter covers, or None
+    if it is open ended.
+    '''
+    if not created or not created.get('date_from') or not created.get('date_to'):
+        return None
+    start, end = created['date_from'], created['date_to']
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append((year, month))
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+    return months
+
+
+def _columns_from_documents(documents):
+    rows = dict((name, []) for name in (
+        '_id', 'organization_id', 'dealer_id', 'status', 'created', 'creator',
+        'stock_type', 'lead_direction', 'lead_channel', 'lead_source', 'deal_type',
+        'reporting_year', 'reporting_month', 'reporting_quarter',
+        'assigned_count') + GROSS_COLUMNS + tuple(c + '_is_float' for c in GROSS_COLUMNS))
+
+    for doc in documents:
+        marketing = doc.get('marketing') or {}
+        dms_deal = doc.get('dms_deal') or {}
+        period = doc.get('reporting_period') or {}
+        rows['_id'].append(str(doc['_id']))
+        rows['organization_id'].append(_text(doc.get('organization_id')))
+        rows['dealer_id'].append(doc.get('dealer_id') or 0)
+        rows['status'].append(int(doc.get('status') or 0))
+        rows['created'].append(doc.get('created'))
+        rows['creator'].append(_text(doc.get('creator')))
+        rows['stock_type'].append(_text(doc.get('stock_type')))
+        rows['lead_direction'].append(_text(marketing.get('lead_direction')))
+        rows['lead_channel'].append(_text(marketing.get('lead_channel')))
+        rows['lead_source'].append(_text(marketing.get('lead_source')))
+        # Mirrors `{'$ifNull': ['$dms_deal.deal_type', 'Unknown']}`
+        deal_type = dms_deal.get('deal_type')
+        rows['deal_type'].append(u'Unknown' if deal_type is None else _text(deal_type))
+        for column in GROSS_COLUMNS:
+            value = _number(dms_deal.get(column))
+            rows[column].append(value)
+            # $sum only returns a double when it added one
+            rows[column + '_is_float'].append(isinstance(value, float))
+        rows['reporting_year'].append(_int(period.get('year')))
+        rows['reporting_month'].append(_int(period.get('month')))
+        rows['reporting_quarter'].append(_int(period.get('quarter')))
+        rows['assigned_count'].append(
+            len(doc.get('sales_reps') or []) +
+            len(doc.get('customer_reps') or []) +
+            len(doc.get('sales_managers') or []))
+
+    columns = dict(
+        _id=np.array(rows['_id'], dtype='U24'),
+        organization_id=np.array(rows['organization_id'], dtype='U'),
+        dealer_id=np.array(rows['dealer_id'], dtype=np.int64),
+        status=np.array(rows['status'], dtype=np.int64),
+        created=np.array(rows['created'], dtype='datetime64[ms]'),
+        creator=np.array(rows['creator'], dtype='U'),
+        stock_type=np.array(rows['stock_type'], dtype='U'),
+        lead_direction=np.array(rows['lead_direction'], dtype='U'),
+        lead_channel=np.array(rows['lead_channel'], dtype='U'),
+        lead_source=np.array(rows['lead_source'], dtype='U'),
+        deal_type=np.array(rows['deal_type'], dtype='U'),
+        reporting_year=np.array(rows['reporting_year'], dtype=np.int64),
+        reporting_month=np.array(rows['reporting_month'], dtype=np.int64),
+        reporting_quarter=np.array(rows['reporting_quarter'], dtype=np.int64),
+        assigned_count=np.array(rows['assigned_count'], dtype=np.int64),
+    )
+    for column in GROSS_COLUMNS:
+        columns[column] = np.array(rows[column], dtype=np.float64)
+        columns[column + '_is_float'] = np.array(rows[column + '_is_float'], dtype=bool)
+    return columns
+
+
+class OpportunitySnapshotExporter(object):
+    """
+    Writes opportunities to `<root>/<organization_id>/<year>-<month>/` as
+    NumPy column files, one partition per organization and month created.
+    """
+
+    def __init__(self, dao, root):
+        self.dao = dao
+        self.root = root
+
+    def partition_path(self, organization_id, year, month):
+        return partition_file(self.root, organization_id, year, month)
+
+    def _query(self, organization_id, year, month):
+        return {
+            'organization_id': organization_id,
+            'created': {'$gte': month_start(year, month),
+                        '$lt': month_start(year, month + 1)},
+        }
+
+    def _source(self, year, month):
+        # Archived opportunities are part of the history too
+        created = {'date_from': month_start(year, month)}
+        return self.dao._opportunity_source({'created': created})
+
+    def export_period(self, organization_id, year, month):
+        '''
+        Export the opportunities an organization created in one month,
+        replacing any previous snapshot of that partition.
+        :return: number of opportunities written
+        '''
+        started = time.time()
+        cursor = self._source(year, month).find(
+            self._query(organization_id, year, month), SNAPSHOT_PROJECTION, batch_size=5000)
+        columns = _columns_from_documents(cursor)
+
+        target = self.partition_path(organization_id, year, month)
+        path = os.path.dirname(target)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Write next to the final file and rename so readers never see a
+        # partially written partition. Its mtime is when the read started:
+        # anything updated after that is picked up by the next refresh.
+        tmp = target + '.tmp'
+        with open(tmp, 'wb') as fp:
+            np.savez_compressed(fp, **columns)
+        os.utime(tmp, (started, started))
+        os.rename(tmp, target)
+
+        return len(columns['_id'])
+
+    def refresh_period(self, organization_id, year, month):
+        '''
+        Export a partition again if any of its opportunities was updated or
+        deleted since it was exported, and mark it current otherwise.
+        :return: True if the partition was exported
+        '''
+        target = self.partition_path(organization_id, year, month)
+        if os.path.exists(target):
+            exported = os.path.getmtime(target)
+            since = datetime.utcfromtimestamp(exported)
+            query = dict(self._query(organization_id, year, month), updated={'$gte': since})
+            changed = self._source(year, month).find_one(query, {'_id': 1})
+            deleted = self.dao.tombstones.find_one(
+                {'organization_id': organization_id, 'deleted': {'$gte': since}}, {'_id': 1})
+            if changed is None and deleted is None:
+                now = time.time()
+                os.utime(target, (now, now))
+                return False
+
+        self.export_period(organization_id, year, month)
+        return True
+
+def partition_file(root, organization_id, year, month):
+    return os.path.join(root, str(organization_id), '{:04d}-{:02d}'.format(year, month),
+                        SNAPSHOT_FILENAME)
+
+
+def partition_age(root, organization_id, year, month):
+    '''
+    Seconds since a partition was exported or found current, None if it
+    was never exported.
+    '''
+    try:
+        return time.time() - os.path.getmtime(partition_file(root, organization_id, year, month))
+    except OSError:
+        return None
+
+
+def load_snapshot_columns(root, organization_id, periods):
+    '''
+    Load and concatenate the column files of the given reporting periods.
+    Periods without a snapshot raise IOError rather than being skipped, so a
+    report never silently misses a month.
+    '''
+    parts = []
+    for year, month in periods:
+        with np.load(partition_file(root, organization_id, year, month)) as data:
+            parts.append(dict((name, data[name]) for name in data.files))
+
+    if not parts:
+        return _columns_from_documents([])
+
+    return dict((name, np.concatenate([p[name] for p in parts]))
+                for name in parts[0])
+
+
+def _group_by(columns, mask, keys):
+    '''
+    Group the selected rows by one or more key columns.
+    :return: (list of key tuples, group index per selected row)
+    '''
+    codes = np.zeros(int(mask.sum()), dtype=np.int64)
+    for key in keys:
+        uniques, inverse = np.unique(columns[key][mask], return_inverse=True)
+        codes = codes * len(uniques) + inverse
+
+    _, first, group_of = np.unique(codes, return_index=True, return_inverse=True)
+    group_keys = zip(*[columns[key][mask][first].tolist() for key in keys])
+    return list(group_keys), group_of
+
+
+class SnapshotReportEngine(object):
+    """
+    Vectorized versions of the `MongoOpportunity.aggregate_*` reports over
+    snapshot columns. Results have the same shape as the database reports.
+    """
+
+    def __init__(self, columns, statuses):
+        '''
+        :param statuses: the status constants, `Opportunity.STATUS`
+        '''
+        self.columns = columns
+        self.statuses = statuses
+
+    @classmethod
+    def from_snapshots(cls, root, organization_id, periods, statuses):
+        return cls(load_snapshot_columns(root, organization_id, periods), statuses)
+
+    def __len__(self):
+        return len(self.columns['_id'])
+
+    def select(self, filters):
+        '''
+        Boolean mask of the rows matching `filters`, using the same filter
+        keys as `MongoOpportunity.make_query`.
+        '''
+        unsupported = set(filters) - set(SUPPORTED_FILTERS)
+        if unsupported:
+            raise ValueError(
+                "Filters not supported by snapshots: {}".format(sorted(unsupported)))
+
+        c = self.columns
+        mask = np.ones(len(self), dtype=bool)
+
+        if 'organization_id' in filters:
+            mask &= c['organization_id'] == _text(filters['organization_id'])
+
+        if filters.get('dealer_ids') is not None:
+            mask &= np.isin(c['dealer_id'], filters['dealer_ids'])
+
+        if filters.get('statuses') is not None:
+            mask &= np.isin(c['status'], filters['statuses'])
+
+        for key in ('lead_channel', 'lead_direction', 'lead_source'):
+            if key in filters:
+                mask &= c[key] == _text(filters[key])
+
+        if 'stock_type' in filters:
+            mask &= c['stock_type'] == _text(filters['stock_type'])
+
+        created = filters.get('created')
+        if created:
+            if created.get('date_from'):
+                mask &= c['created'] >= np.datetime64(created['date_from'], 'ms')
+            if created.get('date_to'):
+                # `get_date_filter` treats date_to as inclusive of the whole day
+                end = created['date_to'] + timedelta(days=1)
+                mask &= c['created'] < np.datetime64(end, 'ms')
+
+        period = filters.get('reporting_period')
+        if period:
+            for part in ('year', 'month', 'quarter'):
+                if part in period:
+                    mask &= c['reporting_' + part] == period[part]
+
+        return mask
+
+    def _status_counts(self, group_of, n_groups, status_mask, status):
+        return np.bincount(group_of, weights=(status_mask == status),
+                           minlength=n_groups)
+
+    def _sums(self, mask, group_of, n_groups, column):
+        '''
+        Per group sums of a gross column, typed like the result of $sum: an
+        int unless a double was added.
+        '''
+        sums = np.bincount(group_of, weights=self.columns[column][mask], minlength=n_groups)
+        floats = np.bincount(group_of, weights=self.columns[column + '_is_float'][mask],
+                             minlength=n_groups)
+        return [float(total) if has_float else int(total)
+                for total, has_float in zip(sums, floats)]
+
+    def sales_funnel(self, filters):
+        '''Equivalent of `aggregate_opportunity_sales_funnel_reports`.'''
+        mask = self.select(filters)
+        if not mask.any():
+            return []
+
+        STATUS = self.statuses
+        keys, group_of = _group_by(self.columns, mask, ['dealer_id'])
+        n = len(keys)
+        status = self.columns['status'][mask]
+        totals = dict(
+            (name, self._status_counts(group_of, n, status, value))
+            for name, value in [
+                ('total_fresh', STATUS.FRESH),
+                ('total_desk', STATUS.DESK),
+                ('total_fi', STATUS.FI),
+                ('total_posted', STATUS.POSTED),
+                ('total_delivered', STATUS.DELIVERED),
+                ('total_lost', STATUS.LOST),
+                ('total_pending', STATUS.PENDING),
+                ('total_approved', STATUS.APPROVED),
+                ('total_signed', STATUS.SIGNED),
+                ('total_tubed', STATUS.TUBED),
+                ('total_carryover', STATUS.CARRYOVER),
+            ])
+        totals['total_opportunities'] = np.bincount(group_of, minlength=n)
+        gross = self._sums(mask, group_of, n, 'total_gross')
+
+        results = []
+        for i, (dealer_id,) in enumerate(keys):
+            row = dict((name, int(values[i])) for name, values in totals.items())
+            row['_id'] = {'dealer_id': dealer_id}
+            row['total_gross'] = gross[i]
+            results.append(row)
+        return results
+
+    def deallog_recap(self, filters):
+        '''Equivalent of `aggregate_deallog_recap_reports`.'''
+        mask = self.select(filters)
+        if not mask.any():
+            return []
+
+        c = self.columns
+        keys, group_of = _group_by(c, mask, ['dealer_id'])
+        n = len(keys)
+        delivered = c['status'][mask] == self.statuses.DELIVERED
+        total = np.bincount(group_of, minlength=n)
+        total_delivered = np.bincount(group_of, weights=delivered, minlength=n)
+        sums = dict(
+            (name, self._sums(mask, group_of, n, column))
+            for name, column in [('total_gross', 'total_gross'),
+                                 ('total_frontgross', 'frontend_gross'),
+                                 ('total_endgross', 'backend_gross')])
+
+        ids = c['_id'][mask]
+        order = np.argsort(group_of, kind='mergesort')
+        ids_per_group = np.split(ids[order], np.cumsum(total)[:-1])
+
+        results = []
+        for i, (dealer_id,) in enumerate(keys):
+            row = dict((name, values[i]) for name, values in sums.items())
+            row.update({
+                '_id': {'dealer_id': dealer_id},
+                'opportunity_ids': [ObjectId(_id) for _id in ids_per_group[i]],
+                'total_opportunities': int(total[i]),
+                'total_deal_done': int(total[i] - total_delivered[i]),
+                'total_deal_delivered': int(total_delivered[i]),
+            })
+            results.append(row)
+        return results
+
+    def daily_operations(self, filters):
+        '''Equivalent of `aggregate_daily_operations_reports`.'''
+        mask = self.select(filters)
+        if not mask.any():
+            return []
+
+        STATUS = self.statuses
+        c = self.columns
+        keys, group_of = _group_by(c, mask, ['dealer_id', 'deal_type'])
+        n = len(keys)
+        status = c['status'][mask]
+        pending = np.isin(status, [STATUS.APPROVED, STATUS.PENDING, STATUS.SIGNED])
+        sold = np.isin(status, [STATUS.DELIVERED, STATUS.POSTED])
+
+        total = np.bincount(group_of, minlength=n)
+        total_pending = np.bincount(group_of, weights=pending, minlength=n)
+        total_sold = np.bincount(group_of, weights=sold, minlength=n)
+        gross = self._sums(mask, group_of, n, 'total_gross')
+
+        return [{
+            '_id': {'dealer_id': dealer_id, 'deal_type': deal_type},
+            'total_opportunities': int(total[i]),
+            'total_pending_for_deal_type': int(total_pending[i]),
+            'total_sold_for_deal_type': int(total_sold[i]),
+            'total_gross_for_deal_type': gross[i],
+        } for i, (dealer_id, deal_type) in enumerate(keys)]
+
+    def opportunity_data_by_dealer(self, dealer_ids, created):
+        '''
+        Equivalent of `aggregate_opportunity_data_by_dealer` for a closed
+        period, where no open opportunities are carried over.
+        '''
+        STATUS = self.statuses
+        c = self.columns
+        mask = self.select({'dealer_ids': dealer_ids, 'created': created})
+        mask &= np.isin(c['status'], STATUS.CLOSED)
+        if not mask.any():
+            return []
+
+        keys, group_of = _group_by(c, mask, ['dealer_id'])
+        n = len(keys)
+        is_open = np.isin(c['status'][mask], STATUS.OPEN)
+        unassigned = is_open & (c['assigned_count'][mask] == 0)
+        total = np.bincount(group_of, minlength=n)
+        total_open = np.bincount(group_of, weights=is_open, minlength=n)
+        total_unassigned = np.bincount(group_of, weights=unassigned, minlength=n)
+
+        ids = c['_id'][mask]
+        order = np.argsort(group_of, kind='mergesort')
+        ids_per_group = np.split(ids[order], np.cumsum(total)[:-1])
+
+        results = []
+        for i, (dealer_id,) in enumerate(keys):
+            results.append({
+                '_id': {'dealer_id': dealer_id},
+                'opportunity_ids': [ObjectId(_id) for _id in ids_per_group[i]],
+                'total_opportunities': int(total[i]),
+                'total_open': int(total_open[i]),
+                'total_carryover': 0,
+                'total_this_period': int(total[i]),
+                'total_unassigned': int(total_unassigned[i]),
+            })
+
+        # Every matched row is in the period, so each (direction, channel)
+        # pair becomes a column exactly like the database pivot.
+        rows = dict((row['_id']['dealer_id'], row) for row in results)
+        for row in results:
+            row.update(lead_channel_columns())
+
+        pair_keys, pair_of = _group_by(
+            c, mask, ['dealer_id', 'lead_direction', 'lead_channel'])
+        pair_totals = np.bincount(pair_of, minlength=len(pair_keys))
+        for i, (dealer_id, direction, channel) in enumerate(pair_keys):
+            if direction and channel:
+                add_lead_channel(rows[dealer_id], direction, channel, int(pair_totals[i]))
+
+        return results
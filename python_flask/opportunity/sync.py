@@ -0,0 +1,49 @@
+"""
+Opaque tokens for delta sync of opportunities.
+
+A token holds the position a client has synced up to: the `updated`
+timestamp and `_id` of the last change it received, and the `deleted`
+timestamp of the last tombstone.
+"""
+import base64
+import json
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class InvalidSyncToken(Exception):
+    def __init__(self, message=None):
+        message = message or 'Invalid or expired sync token, please reload.'
+        super(InvalidSyncToken, self).__init__(message)
+        self.message = message
+
+
+class SyncPosition(object):
+
+    def __init__(self, updated, last_id=None, deleted=None):
+        self.updated = updated
+        self.last_id = last_id
+        self.deleted = deleted or updated
+
+
+def encode_token(position):
+    payload = {
+        'u': position.updated.strftime(_DATE_FORMAT),
+        'i': str(position.last_id) if position.last_id else None,
+        'd': position.deleted.strftime(_DATE_FORMAT),
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        return SyncPosition(
+            datetime.strptime(payload['u'], _DATE_FORMAT),
+            ObjectId(payload['i']) if payload.get('i') else None,
+            datetime.strptime(payload['d'], _DATE_FORMAT))
+    except Exception:
+        raise InvalidSyncToken()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+_TESTS = os.path.dirname(os.path.abspath(__file__))
+
+# The pure python modules of the package import without the application, and
+# the ones with relative imports as `opportunity.<module>`
+sys.path.insert(0, os.path.dirname(_TESTS))
+sys.path.insert(0, os.path.dirname(os.path.dirname(_TESTS)))
@@ -0,0 +1,35 @@
+import time
+
+from cache import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    cache = LRUCache(ttl=10)
+    cache.set('a', 1)
+
+    now[0] += 5
+    assert cache.get('a') == 1
+    now[0] += 6
+    assert cache.get('a', 'gone') == 'gone'
+
+
+def test_cached_none_is_a_hit():
+    cache = LRUCache()
+    cache.set('a', None)
+    assert cache.get('a', 'default') is None
+    assert cache.stats() == {'hits': 1, 'misses': 0, 'evictions': 0, 'size': 1}
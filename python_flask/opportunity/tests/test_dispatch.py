@@ -0,0 +1,72 @@
+from dispatch import SignalDispatcher
+
+
+class FakeSignal(object):
+    # The parts of a blinker signal the dispatcher uses
+    def __init__(self, name):
+        self.name = name
+        self.receivers = []
+
+    def connect(self, receiver, **kwargs):
+        self.receivers.append(receiver)
+
+    def receivers_for(self, sender):
+        return list(self.receivers)
+
+    def send(self, sender, **kwargs):
+        for receiver in self.receivers:
+            receiver(sender, **kwargs)
+
+
+def _async_dispatcher():
+    # A long window keeps the flusher thread out of the way of `flush`
+    dispatcher = SignalDispatcher(window=60, workers=1)
+    dispatcher.configure(mode='async')
+    return dispatcher
+
+
+def test_updates_of_one_opportunity_coalesce():
+    updated, created = FakeSignal('opportunity_updated'), FakeSignal('opportunity_created')
+    received = []
+    updated.connect(lambda sender, **kw: received.append(('updated', kw)))
+    created.connect(lambda sender, **kw: received.append(('created', kw)))
+
+    dispatcher = _async_dispatcher()
+    opportunity = {'_id': 1, 'status': 1}
+    dispatcher.send(updated, None, opportunity=opportunity, delta={'status': 1})
+    dispatcher.send(created, None, opportunity={'_id': 2})
+    opportunity['status'] = 2
+    dispatcher.send(updated, None, opportunity=dict(opportunity, note='x'),
+                    delta={'note': 'x'})
+    dispatcher.flush()
+
+    assert [name for name, _ in received] == ['created', 'updated']
+    assert received[1][1]['opportunity'] == {'_id': 1, 'status': 2, 'note': 'x'}
+    assert received[1][1]['delta'] == {'status': 1, 'note': 'x'}
+    assert dispatcher.stats()['coalesced'] == 1
+
+
+def test_sync_receivers_run_inline():
+    signal = FakeSignal('opportunity_updated')
+    received = []
+    dispatcher = _async_dispatcher()
+    dispatcher.connect_sync(signal, lambda sender, **kw: received.append('sync'))
+    signal.connect(lambda sender, **kw: received.append('deferred'))
+
+    dispatcher.send(signal, None, opportunity={'_id': 1})
+    assert received == ['sync']
+    dispatcher.flush()
+    assert received == ['sync', 'deferred']
+
+
+def test_sent_arguments_are_copied():
+    signal = FakeSignal('opportunity_updated')
+    received = []
+    signal.connect(lambda sender, **kw: received.append(kw['opportunity']))
+    dispatcher = _async_dispatcher()
+
+    opportunity = {'_id': 1, 'status': 1}
+    dispatcher.send(signal, None, opportunity=opportunity)
+    opportunity['status'] = 3
+    dispatcher.flush()
+    assert received == [{'_id': 1, 'status': 1}]
@@ -0,0 +1,157 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+gross_profit = pytest.importorskip('market_crm.opportunities.gross_profit')
+
+
+class FakeKey(object):
+    # The parts of a boto S3 key the module reads
+    def __init__(self, bucket, name, etag, body):
+        self.bucket = bucket
+        self.name = name
+        self.etag = etag
+        self.body = body
+        self.downloads = 0
+
+    def get_contents_as_string(self):
+        self.downloads += 1
+        return self.body
+
+
+class FakeBucket(object):
+    name = 'archive'
+
+    def __init__(self):
+        self.keys = {}
+        self.heads = 0
+
+    def put(self, dealer_id, deal_number, etag, body):
+        name = gross_profit.deal_key(dealer_id, deal_number)
+        self.keys[name] = FakeKey(self, name, etag, body)
+        return self.keys[name]
+
+    def get_key(self, name):
+        self.heads += 1
+        return self.keys.get(name)
+
+
+class FakeConverter(object):
+    def __init__(self, xml_string, debug=False):
+        self.xml_string = xml_string
+
+    def to_representation(self):
+        return {'front_gross': len(self.xml_string)}
+
+
+class FakeDAO(object):
+    GROSS_PROFIT_MAX_AGE = 3600
+
+    def __init__(self):
+        self.stored = {}
+
+    def get_gross_profit(self, dealer_id, deal_number):
+        return self.stored.get((dealer_id, deal_number))
+
+    def save_gross_profit(self, dealer_id, deal_number, etag, value):
+        self.stored[(dealer_id, deal_number)] = {
+            'etag': etag, 'gross_profit': value, 'stale': False,
+            'updated': datetime.utcnow()}
+
+    def mark_gross_profits_stale(self, deals):
+        for deal in deals:
+            if deal in self.stored:
+                self.stored[deal]['stale'] = True
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = FakeBucket()
+    monkeypatch.setattr(gross_profit, 'get_bucket', lambda: bucket)
+    monkeypatch.setattr(gross_profit, 'DealConverter', FakeConverter)
+    gross_profit.converted_deals.clear()
+    return bucket
+
+
+def test_first_view_converts_and_stores(bucket):
+    dao = FakeDAO()
+    key = bucket.put(1, 'D1', '"a"', 'xml')
+
+    assert gross_profit.deal_gross_profit(dao, 1, 'D1') == {'front_gross': 3}
+    assert dao.stored[(1, 'D1')]['etag'] == '"a"'
+    assert key.downloads == 1
+
+
+def test_current_copy_skips_s3(bucket):
+    dao = FakeDAO()
+    bucket.put(1, 'D1', '"a"', 'xml')
+    gross_profit.deal_gross_profit(dao, 1, 'D1')
+    heads = bucket.heads
+
+    gross_profit.deal_gross_profit(dao, 1, 'D1')
+    assert bucket.heads == heads
+
+
+def test_stale_copy_with_same_etag_is_not_downloaded(bucket):
+    dao = FakeDAO()
+    key = bucket.put(1, 'D1', '"a"', 'xml')
+    gross_profit.deal_gross_profit(dao, 1, 'D1')
+    gross_profit.converted_deals.clear()
+
+    dao.mark_gross_profits_stale([(1, 'D1')])
+    assert gross_profit.deal_gross_profit(dao, 1, 'D1') == {'front_gross': 3}
+    assert key.downloads == 1
+    assert not dao.stored[(1, 'D1')]['stale']
+
+
+def test_aged_copy_picks_up_new_xml(bucket):
+    dao = FakeDAO()
+    bucket.put(1, 'D1', '"a"', 'xml')
+    gross_profit.deal_gross_profit(dao, 1, 'D1')
+
+    # New XML landed without going through DMS ingestion
+    bucket.put(1, 'D1', '"b"', 'longer xml')
+    assert gross_profit.deal_gross_profit(dao, 1, 'D1') == {'front_gross': 3}
+
+    dao.stored[(1, 'D1')]['updated'] -= timedelta(seconds=dao.GROSS_PROFIT_MAX_AGE + 1)
+    assert gross_profit.deal_gross_profit(dao, 1, 'D1') == {'front_gross': 10}
+    assert dao.stored[(1, 'D1')]['etag'] == '"b"'
+
+
+def test_missing_xml_is_remembered(bucket):
+    dao = FakeDAO()
+    assert gross_profit.deal_gross_profit(dao, 1, 'D2') == {}
+    heads = bucket.heads
+
+    assert gross_profit.deal_gross_profit(dao, 1, 'D2') == {}
+    assert bucket.heads == heads
+
+    bucket.put(1, 'D2', '"a"', 'xml')
+    dao.mark_gross_profits_stale([(1, 'D2')])
+    assert gross_profit.deal_gross_profit(dao, 1, 'D2') == {'front_gross': 3}
+
+
+def test_connection_per_thread(monkeypatch):
+    connections = []
+
+    class FakeConnection(object):
+        def get_bucket(self, name, validate=True):
+            return self
+
+    def connect_s3():
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(gross_profit, '_local', threading.local())
+    monkeypatch.setattr(gross_profit.boto, 'connect_s3', connect_s3)
+
+    first = gross_profit.get_bucket()
+    assert gross_profit.get_bucket() is first
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(gross_profit.get_bucket()))
+    thread.start()
+    thread.join()
+    assert len(connections) == 2
+    assert other[0] is not first
@@ -0,0 +1,138 @@
+import random
+from collections import defaultdict
+
+from pivots import (LEAD_CHANNEL_COLUMNS, STATUS_REPORT_CHANNELS,
+                    pivot_lead_channels, pivot_status_channels)
+
+DIRECTIONS = ['inbound', 'outbound', '']
+CHANNELS = ['web', 'phone', 'walk', 'chat', 'sms', 'email', 'event', 'social',
+            'service', 'fax', 'count', 'completed', 'opportunities', '']
+
+
+def _opportunities(count=500, seed=7):
+    rng = random.Random(seed)
+    return [{
+        '_id': i,
+        'dealer_id': rng.choice([1, 2, 3]),
+        'lead_direction': rng.choice(DIRECTIONS),
+        'lead_channel': rng.choice(CHANNELS),
+        'in_period': rng.random() < 0.7,
+        'is_open': rng.choice([0, 1]),
+        'is_carryover': rng.choice([0, 1]),
+        'is_unassigned': rng.choice([0, 1]),
+        'completed': rng.choice([0, 1]),
+        'credit_applications': rng.choice([[], ['a'], ['a', 'b'], ['c']]),
+    } for i in range(count)]
+
+
+def _group(opportunities, key_fields, sums):
+    # What the $group stage of the report returns
+    groups = {}
+    for opportunity in opportunities:
+        key = tuple(opportunity[field] for field in key_fields)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = dict(
+                dict((name, 0) for name in sums),
+                _id=dict(zip(key_fields, key)), opportunity_ids=[], count=0,
+                credit_applications=[])
+        group['opportunity_ids'].append(opportunity['_id'])
+        group['count'] += 1
+        for name, field in sums.items():
+            group[name] += opportunity[field]
+        if opportunity['credit_applications'] not in group['credit_applications']:
+            group['credit_applications'].append(opportunity['credit_applications'])
+    return list(groups.values())
+
+
+def _old_dealer_report(opportunities):
+    # The per-document $cond columns the report used before pivoting
+    rows = {}
+    for opportunity in opportunities:
+        row = rows.setdefault(opportunity['dealer_id'], defaultdict(int))
+        row['total_opportunities'] += 1
+        row['total_open'] += opportunity['is_open']
+        row['total_carryover'] += opportunity['is_carryover']
+        row['total_unassigned'] += opportunity['is_unassigned']
+        row['total_this_period'] += opportunity['in_period']
+        for direction, channel in LEAD_CHANNEL_COLUMNS:
+            if (opportunity['in_period'] and opportunity['lead_direction'] == direction and
+                    opportunity['lead_channel'] == channel):
+                row['total_{}_{}'.format(direction, channel)] += 1
+    return rows
+
+
+def _old_status_report(opportunities):
+    rows = {}
+    for opportunity in opportunities:
+        row = rows.setdefault(opportunity['dealer_id'], defaultdict(int))
+        row['total_count'] += 1
+        row['total_completed'] += opportunity['completed']
+        for channel in STATUS_REPORT_CHANNELS:
+            row['total_{}'.format(channel)] += opportunity['lead_channel'] == channel
+    return rows
+
+
+def test_lead_channel_pivot_matches_the_old_report():
+    opportunities = _opportunities()
+    groups = _group(opportunities,
+                    ['dealer_id', 'lead_direction', 'lead_channel', 'in_period'],
+                    {'total_open': 'is_open', 'total_carryover': 'is_carryover',
+                     'total_unassigned': 'is_unassigned'})
+    expected = _old_dealer_report(opportunities)
+
+    rows = pivot_lead_channels(groups)
+    assert len(rows) == len(expected)
+    for row in rows:
+        old = expected[row['_id']['dealer_id']]
+        assert sorted(row['opportunity_ids']) == sorted(
+            o['_id'] for o in opportunities if o['dealer_id'] == row['_id']['dealer_id'])
+        for column in ['total_opportunities', 'total_open', 'total_carryover',
+                       'total_unassigned', 'total_this_period']:
+            assert row[column] == old[column], column
+        for direction, channel in LEAD_CHANNEL_COLUMNS:
+            column = 'total_{}_{}'.format(direction, channel)
+            assert row[column] == old[column], column
+
+
+def test_status_channel_pivot_matches_the_old_report():
+    opportunities = _opportunities()
+    groups = _group(opportunities, ['dealer_id', 'lead_channel'],
+                    {'total_completed': 'completed'})
+    expected = _old_status_report(opportunities)
+
+    rows = pivot_status_channels(groups)
+    assert len(rows) == len(expected)
+    for row in rows:
+        dealer_id = row['_id']['dealer_id']
+        old = expected[dealer_id]
+        for column in ['total_count', 'total_completed'] + [
+                'total_{}'.format(c) for c in STATUS_REPORT_CHANNELS]:
+            assert row[column] == old[column], column
+        unique = []
+        for o in opportunities:
+            if o['dealer_id'] == dealer_id and o['credit_applications'] not in unique:
+                unique.append(o['credit_applications'])
+        assert sorted(row['credit_applications']) == sorted(unique)
+
+
+def test_other_channels_do_not_collide_with_row_fields():
+    groups = [
+        {'_id': {'dealer_id': 1, 'lead_channel': 'count'}, 'opportunity_ids': [1, 2],
+         'credit_applications': [], 'total_completed': 0, 'count': 2},
+        {'_id': {'dealer_id': 1, 'lead_channel': 'completed'}, 'opportunity_ids': [3],
+         'credit_applications': [], 'total_completed': 1, 'count': 1},
+    ]
+    row, = pivot_status_channels(groups)
+    assert row['total_count'] == 3
+    assert row['total_completed'] == 1
+    assert row['other_lead_channels'] == {'count': 2, 'completed': 1}
+
+    row, = pivot_lead_channels([
+        {'_id': {'dealer_id': 1, 'lead_direction': 'inbound', 'lead_channel': 'fax',
+                 'in_period': True},
+         'opportunity_ids': [1], 'count': 1, 'total_open': 1, 'total_carryover': 0,
+         'total_unassigned': 0},
+    ])
+    assert row['other_lead_channels'] == {'inbound': {'fax': 1}}
+    assert 'total_inbound_fax' not in row
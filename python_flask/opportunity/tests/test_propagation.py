@@ -0,0 +1,47 @@
+from propagation import PropagationQueue
+
+
+class FakeCollection(object):
+    def __init__(self):
+        self.batches = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.batches.append(list(requests))
+
+
+def test_propagation_debounces_by_key():
+    opportunities, list_rows = FakeCollection(), FakeCollection()
+    queue = PropagationQueue(mode='async', window=60)
+
+    queue.enqueue(opportunities, 'first a', key='a')
+    queue.enqueue(list_rows, 'row a', key=('row', 'a'))
+    queue.enqueue(opportunities, 'b', key='b')
+    queue.enqueue(opportunities, 'second a', key='a')
+    queue.enqueue(opportunities, 'unkeyed')
+    queue.flush()
+
+    # The replaced write moves behind everything queued before it
+    assert list_rows.batches == [['row a']]
+    assert opportunities.batches == [['b', 'second a', 'unkeyed']]
+    assert queue.stats()['debounced'] == 1
+
+
+def test_propagation_batches_are_bounded():
+    collection = FakeCollection()
+    queue = PropagationQueue(mode='async', window=60, batch_size=2)
+    for i in range(5):
+        queue.enqueue(collection, i)
+    queue.flush()
+    assert collection.batches == [[0, 1], [2, 3], [4]]
+
+
+def test_interleaved_collections_are_batched():
+    opportunities, list_rows = FakeCollection(), FakeCollection()
+    queue = PropagationQueue(mode='async', window=60)
+    for customer_id in range(3):
+        queue.enqueue(opportunities, ('opportunity', customer_id), key=customer_id)
+        queue.enqueue(list_rows, ('row', customer_id), key=('row', customer_id))
+    queue.flush()
+
+    assert opportunities.batches == [[('opportunity', 0), ('opportunity', 1), ('opportunity', 2)]]
+    assert list_rows.batches == [[('row', 0), ('row', 1), ('row', 2)]]
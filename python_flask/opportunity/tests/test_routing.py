@@ -0,0 +1,26 @@
+import pytest
+
+from routing import (ORGANIZATION, SCATTER, TARGETED, ShardRouting, UntargetedQuery,
+                     targeting)
+
+
+def test_targeting():
+    assert targeting({'organization_id': 'o', 'dealer_id': 1}) == TARGETED
+    assert targeting({'organization_id': 'o', 'dealer_id': {'$in': [1, 2]}}) == TARGETED
+    assert targeting({'$and': [{'organization_id': 'o'}, {'dealer_id': 1}]}) == TARGETED
+    assert targeting({'organization_id': 'o'}) == ORGANIZATION
+    assert targeting({'organization_id': 'o', 'dealer_id': {'$gt': 1}}) == ORGANIZATION
+    assert targeting({'dealer_id': 1}) == SCATTER
+    assert targeting({'organization_id': {'$ne': 'o'}, 'dealer_id': 1}) == SCATTER
+    assert targeting({'organization_id': {}}) == SCATTER
+
+
+def test_counts_and_strict_mode():
+    routing = ShardRouting()
+    routing.note('get', {'organization_id': 'o', 'dealer_id': 1})
+    routing.note('get', {'_id': 1})
+    assert routing.stats() == {'get': {TARGETED: 1, ORGANIZATION: 0, SCATTER: 1}}
+
+    routing.configure(strict=True)
+    with pytest.raises(UntargetedQuery):
+        routing.note('get', {'_id': 1})
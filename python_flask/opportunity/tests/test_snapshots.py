@@ -0,0 +1,70 @@
+from datetime import datetime
+
+import pytest
+
+from opportunity import snapshots
+
+
+class STATUS(object):
+    # The parts of `Opportunity.STATUS` the engine reads
+    FRESH, DESK, FI, POSTED, DELIVERED, LOST, PENDING, APPROVED, SIGNED, TUBED, \
+        CARRYOVER = range(1, 12)
+    OPEN = [FRESH, DESK, FI, PENDING, APPROVED, SIGNED, CARRYOVER]
+    CLOSED = [POSTED, DELIVERED, LOST, TUBED]
+
+
+def _engine():
+    documents = [
+        {'_id': '5a0000000000000000000001', 'organization_id': 'org', 'dealer_id': 1,
+         'status': STATUS.DELIVERED, 'created': datetime(2017, 3, 1, 10),
+         'marketing': {'lead_channel': 'web', 'lead_direction': 'inbound'},
+         'reporting_period': {'year': 2017, 'month': 3, 'quarter': 1}},
+        {'_id': '5a0000000000000000000002', 'organization_id': 'org', 'dealer_id': 2,
+         'status': STATUS.FRESH, 'created': datetime(2017, 3, 31, 23, 59),
+         'marketing': {'lead_channel': 'phone', 'lead_direction': 'inbound'},
+         'reporting_period': {'year': 2017, 'month': 3, 'quarter': 1}},
+        {'_id': '5a0000000000000000000003', 'organization_id': 'org', 'dealer_id': 1,
+         'status': STATUS.LOST, 'created': datetime(2017, 4, 1),
+         'marketing': {'lead_channel': 'fax', 'lead_direction': 'inbound'},
+         'reporting_period': {'year': 2017, 'month': 4, 'quarter': 2}},
+    ]
+    return snapshots.SnapshotReportEngine(snapshots._columns_from_documents(documents), STATUS)
+
+
+def test_select_filters():
+    engine = _engine()
+    assert list(engine.select({})) == [True, True, True]
+    assert list(engine.select({'dealer_ids': [1]})) == [True, False, True]
+    assert list(engine.select({'statuses': [STATUS.FRESH]})) == [False, True, False]
+    assert list(engine.select({'lead_channel': 'web'})) == [True, False, False]
+    assert list(engine.select({'reporting_period': {'month': 3}})) == [True, True, False]
+
+
+def test_date_to_covers_the_whole_day():
+    created = {'date_from': datetime(2017, 3, 1), 'date_to': datetime(2017, 3, 31)}
+    assert list(_engine().select({'created': created})) == [True, True, False]
+
+
+def test_unsupported_filter():
+    with pytest.raises(ValueError):
+        _engine().select({'customer_id': 1})
+
+
+def test_created_months():
+    created = {'date_from': datetime(2016, 11, 5), 'date_to': datetime(2017, 2, 1)}
+    assert snapshots.created_months(created) == [
+        (2016, 11), (2016, 12), (2017, 1), (2017, 2)]
+    assert snapshots.created_months({'date_from': datetime(2017, 1, 1)}) is None
+
+
+def test_opportunity_data_by_dealer_counts_closed_opportunities():
+    created = {'date_from': datetime(2017, 3, 1), 'date_to': datetime(2017, 4, 30)}
+    rows = _engine().opportunity_data_by_dealer([1, 2], created)
+
+    assert len(rows) == 1
+    row = rows[0]
+    assert row['_id'] == {'dealer_id': 1}
+    assert row['total_opportunities'] == row['total_this_period'] == 2
+    assert row['total_open'] == row['total_carryover'] == 0
+    assert row['total_inbound_web'] == 1
+    assert row['other_lead_channels'] == {'inbound': {'fax': 1}}